@@ -0,0 +1,105 @@
+"""Times the elementary step and the Neumann hyper step of train_augment_net2.py with the UNet and the parametric
+augmentation networks, and counts their hyperparameters.
+
+The hyper step follows hyper_step in train_augment_net2.py: the training loss gradient (with its graph), the
+validation loss and augmentation regularizer gradients, the Neumann series and the mixed second derivative with
+respect to the augmentation network.
+
+Usage: python benchmark_augment_net.py --model resnet18 --batch_size 32 --num_neumann_terms 1
+"""
+import argparse
+import time
+
+import torch
+import torch.nn.functional as F
+import torch.optim as optim
+from torch.autograd import grad
+
+from models.parametric_augment import ParametricAugmentNet
+from models.resnet import ResNet18
+from models.simple_models import Net
+from models.unet import UNet
+from train_augment_net2 import neumann_hyperstep_preconditioner, sample_augmentations
+from utils.device import add_device_arguments, device_policy
+from utils.util import gather_flat_grad
+
+
+parser = argparse.ArgumentParser(description='Augmentation network benchmark')
+parser.add_argument('--model', type=str, default='resnet18', choices=['resnet18', 'mlp'], help='elementary model')
+parser.add_argument('--batch_size', type=int, default=32, help='input batch size')
+parser.add_argument('--num_neumann_terms', type=int, default=1, help='number of Neumann terms in the hyper step')
+parser.add_argument('--num_aug_samples', type=int, default=10,
+                    help='number of augmentations per image for the regularizer')
+parser.add_argument('--reg_weight', type=float, default=0.5, help='weight of the augmentation regularizer')
+parser.add_argument('--iters', type=int, default=5, help='number of timed steps per augmentation network')
+parser.add_argument('--warmup', type=int, default=1, help='number of untimed steps per augmentation network')
+parser.add_argument('--seed', type=int, default=0, help='random seed')
+add_device_arguments(parser)
+
+augment_net_specs = {
+    'unet': lambda in_channel: UNet(in_channels=in_channel, n_classes=in_channel, depth=2, wf=3, padding=True,
+                                    batch_norm=False, do_noise_channel=True, up_mode='upconv',
+                                    use_identity_residual=True),
+    'parametric': lambda in_channel: ParametricAugmentNet(in_channels=in_channel),
+}
+
+
+def elementary_step(model, augment_net, optimizer, x, y):
+    optimizer.zero_grad()
+    loss = F.cross_entropy(model(augment_net(x, class_label=y)), y)
+    loss.backward()
+    optimizer.step()
+
+
+def hyper_step(model, augment_net, x, y, val_x, val_y, args):
+    train_loss = F.cross_entropy(model(augment_net(x, class_label=y)), y)
+    d_train_loss_d_w = gather_flat_grad(grad(train_loss, model.parameters(), create_graph=True))
+
+    val_loss = F.cross_entropy(model(val_x), val_y)
+    xs = sample_augmentations(augment_net, val_x, args.num_aug_samples, class_label=val_y)
+    val_loss = val_loss + args.reg_weight * (torch.mean(torch.abs(torch.mean(xs, dim=0) - val_x))
+                                             - torch.mean(torch.std(xs, dim=0)))
+    d_val_loss_d_theta = gather_flat_grad(grad(val_loss, model.parameters(), retain_graph=True))
+    direct_grad = gather_flat_grad(grad(val_loss, augment_net.parameters(), allow_unused=True))
+
+    preconditioner = neumann_hyperstep_preconditioner(d_val_loss_d_theta, d_train_loss_d_w, 0.1,
+                                                      args.num_neumann_terms, model)
+    indirect_grad = gather_flat_grad(grad(d_train_loss_d_w, augment_net.parameters(), grad_outputs=preconditioner))
+    return direct_grad - indirect_grad
+
+
+def time_steps(step, iters, warmup, policy):
+    for _ in range(warmup):
+        step()
+    policy.synchronize()
+    start_time = time.time()
+    for _ in range(iters):
+        step()
+    policy.synchronize()
+    return (time.time() - start_time) / iters
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    policy = device_policy(args, double_backward=True)
+    print(policy)
+    in_channel, imsize = (3, 32) if args.model == 'resnet18' else (1, 28)
+
+    print('{:12s} {:>12s} {:>16s} {:>14s}'.format('augment_net', 'num hypers', 'elementary ms', 'hyper step ms'))
+    for name, make_augment_net in augment_net_specs.items():
+        policy.manual_seed(args.seed)
+        if args.model == 'resnet18':
+            model = ResNet18(num_classes=10)
+        else:
+            model = Net(2, 0., imsize, in_channel, 0.)
+        model, augment_net = policy.module(model), policy.module(make_augment_net(in_channel))
+        optimizer = optim.SGD(model.parameters(), lr=0.01, momentum=0.9, nesterov=True)
+        x, val_x = policy.batch(torch.randn(2, args.batch_size, in_channel, imsize, imsize)).unbind(0)
+        y, val_y = policy.batch(torch.randint(0, 10, (2, args.batch_size))).unbind(0)
+
+        num_hypers = sum(p.numel() for p in augment_net.parameters())
+        elementary_time = time_steps(lambda: elementary_step(model, augment_net, optimizer, x, y),
+                                     args.iters, args.warmup, policy)
+        hyper_time = time_steps(lambda: hyper_step(model, augment_net, x, y, val_x, val_y, args),
+                                args.iters, args.warmup, policy)
+        print('{:12s} {:12d} {:16.1f} {:14.1f}'.format(name, num_hypers, elementary_time * 1e3, hyper_time * 1e3))
@@ -0,0 +1,102 @@
+"""Times the steady-state first-order training step (augment, forward, cross-entropy plus the per-parameter L2
+penalty, backward, SGD update) of ResNet18, a WideResNet and an MLP, eagerly and through torch.compile.
+
+Compilation happens during the warmup iterations, so its cost is reported separately from the step times.
+
+Usage: python benchmark_elementary_step.py --batch_size 32 --iters 10 --use_augment_net
+"""
+import argparse
+import copy
+import time
+
+import torch
+import torch.nn.functional as F
+import torch.optim as optim
+
+from models.resnet import ResNet18
+from models.simple_models import Net, weighted_squared_norm
+from models.unet import UNet
+from models.wide_resnet import WideResNet
+from utils.device import add_device_arguments, device_policy
+from utils.elementary_step import ElementaryStep
+
+
+parser = argparse.ArgumentParser(description='Elementary step benchmark')
+parser.add_argument('--models', type=str, default='resnet18,wideresnet,mlp',
+                    help='comma-separated list of models to time (resnet18, wideresnet, mlp)')
+parser.add_argument('--batch_size', type=int, default=32, help='input batch size')
+parser.add_argument('--iters', type=int, default=10, help='number of timed steps per model and mode')
+parser.add_argument('--warmup', type=int, default=3, help='number of untimed steps per model and mode')
+parser.add_argument('--wrn_depth', type=int, default=16, help='depth of the WideResNet')
+parser.add_argument('--wrn_widen_factor', type=int, default=4, help='widen factor of the WideResNet')
+parser.add_argument('--use_augment_net', action='store_true', default=False,
+                    help='augment every batch with a UNet, as train_augment_net2.py does')
+parser.add_argument('--seed', type=int, default=0, help='random seed')
+add_device_arguments(parser)
+
+# (name, model constructor, input size without the batch dimension)
+model_specs = {
+    'resnet18': (lambda args: ResNet18(num_classes=10), (3, 32, 32)),
+    'wideresnet': (lambda args: WideResNet(depth=args.wrn_depth, num_classes=10, widen_factor=args.wrn_widen_factor),
+                   (3, 32, 32)),
+    'mlp': (lambda args: Net(num_layers=2, dropout=0., size=28, channel=1, weight_decay=0.), (1, 28, 28)),
+}
+
+
+def make_step(model, augment_net, log_decay, policy, compile):
+    optimizer = optim.SGD(model.parameters(), lr=0.01, momentum=0.9, nesterov=True)
+
+    def train_loss_func(x, y):
+        x, y = policy.batch(x, y)
+        if augment_net is not None:
+            x = augment_net(x, class_label=y)
+        pred = model(x)
+        return F.cross_entropy(pred, y) + weighted_squared_norm(model.parameters(), log_decay), pred
+
+    return ElementaryStep(train_loss_func, optimizer, compile=compile)
+
+
+def time_steps(step, x, y, iters, warmup, policy):
+    start_time = time.time()
+    for _ in range(warmup):
+        loss, _ = step(x, y)
+    policy.synchronize()
+    warmup_time = time.time() - start_time
+    start_time = time.time()
+    for _ in range(iters):
+        loss, _ = step(x, y)
+    policy.synchronize()
+    return (time.time() - start_time) / iters, warmup_time, loss.item()
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    policy = device_policy(args)
+    print(policy)
+
+    print('{:10s} {:>10s} {:>13s} {:>8s} {:>10s} {:>10s} {:>10s}'.format(
+        'model', 'eager ms', 'compiled ms', 'speedup', 'compile s', 'eager loss', 'comp loss'))
+    for name in args.models.split(','):
+        make_model, input_size = model_specs[name]
+        policy.manual_seed(args.seed)
+        model = policy.module(make_model(args))
+        augment_net = None
+        if args.use_augment_net and len(input_size) == 3:
+            augment_net = policy.module(UNet(in_channels=input_size[0], n_classes=input_size[0], depth=2, wf=3,
+                                             padding=True, batch_norm=False, do_noise_channel=True, up_mode='upconv',
+                                             use_identity_residual=True))
+        num_weights = sum(p.numel() for p in model.parameters())
+        log_decay = (policy.zeros(num_weights) - 4.).requires_grad_()
+        x = torch.randn(args.batch_size, *input_size)
+        y = torch.randint(0, 10, (args.batch_size,))
+
+        results = []
+        for compile in [False, True]:
+            # Both modes start from the same weights
+            step = make_step(copy.deepcopy(model), augment_net, log_decay, policy, compile)
+            policy.manual_seed(args.seed)
+            results.append(time_steps(step, x, y, args.iters, args.warmup, policy))
+        (eager_time, eager_warmup, eager_loss), (compiled_time, compiled_warmup, compiled_loss) = results
+        print('{:10s} {:10.1f} {:13.1f} {:7.2f}x {:10.1f} {:10.4f} {:10.4f}'.format(
+            name, eager_time * 1e3, compiled_time * 1e3, eager_time / compiled_time,
+            compiled_warmup - eager_warmup, eager_loss, compiled_loss))
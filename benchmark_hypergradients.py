@@ -0,0 +1,286 @@
+"""Benchmarks the hypergradient estimators against the exact hypergradient on synthetic problems.
+
+Every problem tunes one weight decay per weight, log_decay, with the training loss
+    data loss + sum(exp(log_decay) * w ** 2)
+as in train_augment_net2.py, and the data loss on held-out data as the validation loss.  At the optimum w* of the
+training loss the implicit function theorem gives
+    d val_loss / d log_decay = -2 exp(log_decay) * w* * (H^-1 d val_loss / d w)
+where H is the Hessian of the training loss.  The problems are
+    ridge       linear regression, where w* and H have a closed form
+    logistic    logistic regression with a bias, solved by Newton's method, where H has a closed form
+    mlp         a one hidden layer tanh network fit by L-BFGS, where H is computed exactly with autograd
+with --sizes input features, and the ground truth is computed in float64.
+
+The estimators replace H^-1 in the formula the way the training scripts do:
+    identity        H^-1 ~ I
+    neumann_k       neumann_hyperstep_preconditioner with k terms, at --neumann_lr (1 / the largest absolute
+                    eigenvalue of H by default)
+    cg_k            cg_batch with at most k iterations
+    kfac            KFACOptimizer._get_natural_grad per layer, with the factors of the current training batch, as in
+                    KFAC_optimize in mnist_test.py
+    true_inverse    pinverse of the Hessian from eval_hessian
+
+Each row of the --output CSV file holds the mean wall time of a problem, size and estimator, the peak memory above
+its starting level (see PeakMemory), the number of Hessian-vector products including the mixed-partial one (see
+HVPCounter), and the cosine similarity and relative error to the exact hypergradient.
+
+Usage: python benchmark_hypergradients.py --problems ridge,logistic,mlp --sizes 10,50,200 --output hypergradients.csv
+"""
+import argparse
+import copy
+import time
+
+import torch
+import torch.nn.functional as F
+from torch import nn
+from torch.autograd import grad
+
+from kfac import KFACOptimizer
+from models.simple_models import weighted_squared_norm
+from train_augment_net2 import cg_batch, neumann_hyperstep_preconditioner
+from utils.csv_logger import CSVLogger
+from utils.device import DevicePolicy, add_device_arguments, device_policy
+from utils.profiling import HVPCounter, PeakMemory
+from utils.util import eval_hessian, gather_flat_grad
+
+
+parser = argparse.ArgumentParser(description='Hypergradient estimator benchmark')
+parser.add_argument('--problems', type=str, default='ridge,logistic,mlp',
+                    help='comma-separated list of problems (ridge, logistic, mlp)')
+parser.add_argument('--sizes', type=str, default='10,50,200', help='comma-separated list of input feature counts')
+parser.add_argument('--estimators', type=str, default='identity,neumann,cg,kfac,true_inverse',
+                    help='comma-separated list of estimators (identity, neumann, cg, kfac, true_inverse)')
+parser.add_argument('--neumann_terms', type=str, default='1,5,20,100',
+                    help='comma-separated list of Neumann term counts')
+parser.add_argument('--neumann_lr', type=float, default=0.,
+                    help='step size of the Neumann series (0 for 1 / the largest absolute eigenvalue of H)')
+parser.add_argument('--cg_iters', type=str, default='1,5,20', help='comma-separated list of CG iteration counts')
+parser.add_argument('--kfac_damping', type=float, default=1e-3, help='damping of the K-FAC inverse')
+parser.add_argument('--max_true_inverse_weights', type=int, default=4000,
+                    help='skip true_inverse on problems with more weights than this')
+parser.add_argument('--num_train', type=int, default=1000, help='number of training examples')
+parser.add_argument('--num_val', type=int, default=500, help='number of validation examples')
+parser.add_argument('--mlp_hidden', type=int, default=16, help='hidden units of the mlp problem')
+parser.add_argument('--log_decay_mean', type=float, default=-4., help='mean of the random per-weight log decays')
+parser.add_argument('--log_decay_std', type=float, default=1., help='standard deviation of the log decays')
+parser.add_argument('--iters', type=int, default=3, help='number of timed runs per estimator')
+parser.add_argument('--warmup', type=int, default=1,
+                    help='number of untimed runs per estimator, the first of which measures the memory')
+parser.add_argument('--output', type=str, default='hypergradient_benchmark.csv', help='CSV file for the results')
+parser.add_argument('--seed', type=int, default=0, help='random seed')
+add_device_arguments(parser)
+
+
+class Problem():
+    """A synthetic problem, fit to its training optimum in float64, with its exact Hessian and hypergradient."""
+
+    def __init__(self, name, size, args):
+        self.name = name
+        n = args.num_train + args.num_val
+        x = torch.randn(n, size, dtype=torch.float64)
+        if name == 'ridge':
+            self.model = nn.Linear(size, 1, bias=False)
+            y = x @ torch.randn(size, 1, dtype=torch.float64) + 0.5 * torch.randn(n, 1, dtype=torch.float64)
+        elif name == 'logistic':
+            self.model = nn.Linear(size, 1)
+            y = torch.bernoulli(torch.sigmoid(x @ torch.randn(size, 1, dtype=torch.float64)))
+        else:
+            self.model = nn.Sequential(nn.Linear(size, args.mlp_hidden), nn.Tanh(), nn.Linear(args.mlp_hidden, 1))
+            teacher = nn.Sequential(nn.Linear(size, args.mlp_hidden), nn.Tanh(), nn.Linear(args.mlp_hidden, 1))
+            with torch.no_grad():
+                y = teacher.double()(x) + 0.1 * torch.randn(n, 1, dtype=torch.float64)
+        self.model.double()
+        self.x, self.val_x = x[:args.num_train], x[args.num_train:]
+        self.y, self.val_y = y[:args.num_train], y[args.num_train:]
+        self.num_weights = sum(p.numel() for p in self.model.parameters())
+        self.log_decay = args.log_decay_mean + args.log_decay_std * torch.randn(self.num_weights, dtype=torch.float64)
+
+        self.fit()
+        self.hessian = self.train_hessian()
+        val_loss = self.data_loss(self.model(self.val_x), self.val_y)
+        d_val_loss_d_w = gather_flat_grad(grad(val_loss, self.model.parameters()))
+        w = gather_flat_grad(self.model.parameters()).detach()
+        self.hypergradient = -2 * torch.exp(self.log_decay) * w * torch.linalg.solve(self.hessian, d_val_loss_d_w)
+
+    def data_loss(self, pred, y):
+        if self.name == 'logistic':
+            return F.binary_cross_entropy_with_logits(pred, y)
+        return F.mse_loss(pred, y)
+
+    def train_loss(self, model, log_decay, x, y):
+        return self.data_loss(model(x), y) + weighted_squared_norm(model.parameters(), log_decay)
+
+    def design_matrix(self):
+        if self.name == 'logistic':
+            return torch.cat([self.x, torch.ones(self.x.shape[0], 1, dtype=self.x.dtype)], 1)
+        return self.x
+
+    def set_weights(self, w):
+        with torch.no_grad():
+            self.model.weight.copy_(w[:self.model.weight.numel()].view_as(self.model.weight))
+            if self.model.bias is not None:
+                self.model.bias.copy_(w[self.model.weight.numel():])
+
+    def fit(self):
+        n, decay = self.x.shape[0], torch.exp(self.log_decay)
+        if self.name == 'ridge':
+            # (X^T X / n + diag(decay)) w = X^T y / n
+            z = self.design_matrix()
+            self.set_weights(torch.linalg.solve(z.t() @ z / n + torch.diag(decay), z.t() @ self.y.view(-1) / n))
+        elif self.name == 'logistic':
+            z, w = self.design_matrix(), torch.zeros(self.num_weights, dtype=torch.float64)
+            for _ in range(50):
+                p = torch.sigmoid(z @ w)
+                gradient = z.t() @ (p - self.y.view(-1)) / n + 2 * decay * w
+                if gradient.norm() < 1e-12:
+                    break
+                self.set_weights(w)
+                w = w - torch.linalg.solve(self.train_hessian(), gradient)
+            self.set_weights(w)
+        else:
+            optimizer = torch.optim.LBFGS(self.model.parameters(), lr=1, max_iter=2000, tolerance_grad=1e-10,
+                                          tolerance_change=1e-14, line_search_fn='strong_wolfe')
+
+            def closure():
+                optimizer.zero_grad()
+                loss = self.train_loss(self.model, self.log_decay, self.x, self.y)
+                loss.backward()
+                return loss
+
+            optimizer.step(closure)
+
+    def train_hessian(self):
+        n, decay = self.x.shape[0], torch.exp(self.log_decay)
+        if self.name == 'ridge':
+            z = self.design_matrix()
+            return 2 * (z.t() @ z / n + torch.diag(decay))
+        if self.name == 'logistic':
+            z = self.design_matrix()
+            with torch.no_grad():
+                p = torch.sigmoid(self.model(self.x)).view(-1)
+            return z.t() @ (z * (p * (1 - p)).view(-1, 1)) / n + 2 * torch.diag(decay)
+        train_loss = self.train_loss(self.model, self.log_decay, self.x, self.y)
+        d_train_loss_d_w = gather_flat_grad(grad(train_loss, self.model.parameters(), create_graph=True))
+        return eval_hessian(d_train_loss_d_w, self.model, DevicePolicy('cpu', dtype=torch.float64))
+
+
+def kfac_preconditioner(kfac_opt, d_val_loss_d_w, damping):
+    """K-FAC inverse of every layer applied to its [weight | bias] block of the flat validation gradient."""
+    preconditioner, current = [], 0
+    for m in kfac_opt.modules:
+        block = d_val_loss_d_w[current:current + m.weight.numel()].view(m.weight.shape[0], -1)
+        current += m.weight.numel()
+        if m.bias is not None:
+            block = torch.cat([block, d_val_loss_d_w[current:current + m.bias.numel()].view(-1, 1)], 1)
+            current += m.bias.numel()
+        v = kfac_opt._get_natural_grad(m, block, damping)
+        preconditioner += [v[:, :-1], v[:, -1]] if m.bias is not None else [v]
+    return gather_flat_grad(preconditioner)
+
+
+def make_estimators(problem, policy, args):
+    """Maps every estimator name to a function of (d_val_loss_d_w, d_train_loss_d_w, model, x, y) returning its
+    approximation of H^-1 d_val_loss_d_w."""
+    names = args.estimators.split(',')
+    estimators = {}
+    if 'identity' in names:
+        estimators['identity'] = lambda d_val_loss_d_w, d_train_loss_d_w, model, x, y: d_val_loss_d_w
+    if 'neumann' in names:
+        lr = args.neumann_lr or 1. / torch.linalg.eigvalsh(problem.hessian).abs().max().item()
+        for k in map(int, args.neumann_terms.split(',')):
+            estimators[f'neumann_{k}'] = lambda d_val_loss_d_w, d_train_loss_d_w, model, x, y, k=k: \
+                neumann_hyperstep_preconditioner(d_val_loss_d_w, d_train_loss_d_w, lr, k, model)
+    if 'cg' in names:
+        for k in map(int, args.cg_iters.split(',')):
+            def cg_estimator(d_val_loss_d_w, d_train_loss_d_w, model, x, y, k=k):
+                def A_vector_multiply_func(vec):
+                    return gather_flat_grad(grad(d_train_loss_d_w, model.parameters(), grad_outputs=vec.view(-1),
+                                                 retain_graph=True)).view(1, -1, 1)
+
+                preconditioner, _ = cg_batch(A_vector_multiply_func, d_val_loss_d_w.view(1, -1, 1), maxiter=k,
+                                             verbose=False)
+                return preconditioner.view(-1)
+
+            estimators[f'cg_{k}'] = cg_estimator
+    if 'kfac' in names:
+        kfac_opts = {}
+
+        def kfac_estimator(d_val_loss_d_w, d_train_loss_d_w, model, x, y):
+            # The factors of this batch only, like a K-FAC step with stat_decay 0
+            if model not in kfac_opts:
+                kfac_opts[model] = KFACOptimizer(model, damping=args.kfac_damping, stat_decay=0., TCov=1, TInv=1)
+            kfac_opt = kfac_opts[model]
+            kfac_opt.zero_grad()
+            problem.data_loss(model(x), y).backward()
+            kfac_opt.fake_step()
+            return kfac_preconditioner(kfac_opt, d_val_loss_d_w, args.kfac_damping)
+
+        estimators['kfac'] = kfac_estimator
+    if 'true_inverse' in names and problem.num_weights <= args.max_true_inverse_weights:
+        estimators['true_inverse'] = lambda d_val_loss_d_w, d_train_loss_d_w, model, x, y: \
+            d_val_loss_d_w @ torch.pinverse(eval_hessian(d_train_loss_d_w, model, policy))
+    return estimators
+
+
+def estimate_hypergradient(estimator, problem, model, log_decay, data):
+    """One hyper step with the given estimator, returning the hypergradient and the number of HVPs it took."""
+    x, y, val_x, val_y = data
+    val_loss = problem.data_loss(model(val_x), val_y)
+    d_val_loss_d_w = gather_flat_grad(grad(val_loss, model.parameters()))
+    train_loss = problem.train_loss(model, log_decay, x, y)
+    d_train_loss_d_w = gather_flat_grad(grad(train_loss, model.parameters(), create_graph=True))
+    hvp_counter = HVPCounter(d_train_loss_d_w)
+
+    preconditioner = estimator(d_val_loss_d_w, d_train_loss_d_w, model, x, y)
+    # The validation loss does not depend on log_decay, so there is no direct gradient
+    hypergradient = -gather_flat_grad(grad(d_train_loss_d_w, log_decay, grad_outputs=preconditioner.view(-1)))
+    return hypergradient, hvp_counter.count
+
+
+def benchmark(name, estimator, problem, policy, args):
+    model = policy.module(copy.deepcopy(problem.model))
+    log_decay = policy.to(problem.log_decay, dtype=policy.dtype).requires_grad_()
+    data = policy.batch(problem.x, problem.y, problem.val_x, problem.val_y)
+
+    # The first run is measured for memory, before the allocator has cached blocks of the right sizes, and is
+    # followed by the untimed warmup runs
+    with PeakMemory(policy.device) as memory:
+        hypergradient, hvps = estimate_hypergradient(estimator, problem, model, log_decay, data)
+    for _ in range(args.warmup - 1):
+        estimate_hypergradient(estimator, problem, model, log_decay, data)
+    policy.synchronize()
+    start_time = time.time()
+    for _ in range(args.iters):
+        estimate_hypergradient(estimator, problem, model, log_decay, data)
+    policy.synchronize()
+    run_time = (time.time() - start_time) / args.iters
+
+    hypergradient = hypergradient.detach().cpu().double()
+    exact = problem.hypergradient
+    return {'problem': problem.name, 'size': problem.x.shape[1], 'num_weights': problem.num_weights,
+            'estimator': name, 'time_ms': run_time * 1e3,
+            'peak_memory_mb': memory.peak_bytes / 2 ** 20 if memory.peak_bytes is not None else '',
+            'hvps': hvps, 'cosine': F.cosine_similarity(hypergradient, exact, dim=0).item(),
+            'relative_error': ((hypergradient - exact).norm() / exact.norm()).item()}
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    policy = device_policy(args, double_backward=True)
+    print(policy)
+
+    csv_logger = CSVLogger(fieldnames=['problem', 'size', 'num_weights', 'estimator', 'time_ms', 'peak_memory_mb',
+                                       'hvps', 'cosine', 'relative_error'], filename=args.output)
+    print('{:9s} {:>5s} {:>8s} {:14s} {:>10s} {:>9s} {:>6s} {:>8s} {:>10s}'.format(
+        'problem', 'size', 'weights', 'estimator', 'time ms', 'peak MB', 'HVPs', 'cosine', 'rel error'))
+    for problem_name in args.problems.split(','):
+        for size in map(int, args.sizes.split(',')):
+            torch.manual_seed(args.seed)
+            problem = Problem(problem_name, size, args)
+            for name, estimator in make_estimators(problem, policy, args).items():
+                row = benchmark(name, estimator, problem, policy, args)
+                csv_logger.writerow(row)
+                print('{problem:9s} {size:5d} {num_weights:8d} {estimator:14s} {time_ms:10.2f} {peak:>9s} {hvps:6d} '
+                      '{cosine:8.4f} {relative_error:10.3e}'.format(
+                          peak='' if row['peak_memory_mb'] == '' else '{:.1f}'.format(row['peak_memory_mb']), **row))
+    csv_logger.close()
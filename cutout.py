@@ -41,3 +41,60 @@ class Cutout(object):
         img = img * mask
 
         return img
+
+
+class BatchCutout(object):
+    """Randomly mask out one or more patches from every image of a batch at once.
+
+    All hole centers are drawn in one call and the masks are built with broadcast comparisons, so there
+    is no per-image or per-hole Python loop and the batch never leaves its device.
+
+    Args:
+        n_holes (int or Tensor): Number of patches to cut out of each image, or a (B,) tensor with one
+            count per image.
+        length (int or Tensor): The length (in pixels) of each square patch, or a (B,) tensor with one
+            length per image.
+    """
+    def __init__(self, n_holes, length):
+        self.n_holes = n_holes
+        self.length = length
+
+    def __call__(self, img, n_holes=None, length=None):
+        """
+        Args:
+            img (Tensor): Tensor batch of size (B, C, H, W).
+            n_holes (int or Tensor, optional): Overrides self.n_holes for this call.
+            length (int or Tensor, optional): Overrides self.length for this call.
+        Returns:
+            Tensor: Batch with n_holes of dimension length x length cut out of each image.
+        """
+        n_holes = self.n_holes if n_holes is None else n_holes
+        length = self.length if length is None else length
+
+        b, h, w = img.size(0), img.size(2), img.size(3)
+        n_holes = torch.as_tensor(n_holes, device=img.device).long().expand(b)
+        length = torch.as_tensor(length, device=img.device).long().expand(b)
+
+        max_holes = int(n_holes.max())
+        if max_holes <= 0:
+            return img
+
+        y = torch.randint(0, h, (b, max_holes), device=img.device, dtype=torch.long)
+        x = torch.randint(0, w, (b, max_holes), device=img.device, dtype=torch.long)
+        half = (length // 2).view(b, 1)
+
+        y1 = torch.clamp(y - half, 0, h).view(b, max_holes, 1, 1)
+        y2 = torch.clamp(y + half, 0, h).view(b, max_holes, 1, 1)
+        x1 = torch.clamp(x - half, 0, w).view(b, max_holes, 1, 1)
+        x2 = torch.clamp(x + half, 0, w).view(b, max_holes, 1, 1)
+
+        rows = torch.arange(h, device=img.device).view(1, 1, h, 1)
+        cols = torch.arange(w, device=img.device).view(1, 1, 1, w)
+        holes = (rows >= y1) & (rows < y2) & (cols >= x1) & (cols < x2)
+
+        # Images with fewer holes than max_holes ignore their extra hole slots
+        used = torch.arange(max_holes, device=img.device).view(1, max_holes) < n_holes.view(b, 1)
+        holes = holes & used.view(b, max_holes, 1, 1)
+
+        mask = 1 - holes.any(dim=1, keepdim=True).to(img.dtype)
+        return img * mask
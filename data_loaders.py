@@ -39,7 +39,8 @@ def load_boston(batch_size, val_split=True, subset=[-1, -1, -1], num_train=50000
     return train_dataloader, val_dataloader, test_dataloader
 
 
-def load_mnist(batch_size, val_split=True, subset=[-1, -1, -1], num_train=50000, only_split_train=False):
+def load_mnist(batch_size, val_split=True, subset=[-1, -1, -1], num_train=50000, only_split_train=False,
+               pin_memory=True):
     transformations = [transforms.ToTensor()]
     transformations.append(transforms.Normalize((0.1307,), (0.3081,)))
     transform = transforms.Compose(transformations)
@@ -77,9 +78,9 @@ def load_mnist(batch_size, val_split=True, subset=[-1, -1, -1], num_train=50000,
             if subset[1] != -1:
                 valset = getSubset(valset, subset[1])
 
-        train_dataloader = DataLoader(trainset, batch_size=batch_size, shuffle=True, pin_memory=True,
+        train_dataloader = DataLoader(trainset, batch_size=batch_size, shuffle=True, pin_memory=pin_memory,
                                       num_workers=0)  # 50,000 images
-        val_dataloader = DataLoader(valset, batch_size=batch_size, shuffle=True, pin_memory=True,
+        val_dataloader = DataLoader(valset, batch_size=batch_size, shuffle=True, pin_memory=pin_memory,
                                     num_workers=0)  # 10,000 images
         test_dataloader = DataLoader(testset, batch_size=batch_size, shuffle=True, pin_memory=False,
                                      num_workers=0)  # 10,000 images
@@ -94,9 +95,9 @@ def load_mnist(batch_size, val_split=True, subset=[-1, -1, -1], num_train=50000,
         if subset[2] != -1:
             testset = getSubset(testset, subset[2])
 
-        train_dataloader = DataLoader(trainset, batch_size=batch_size, pin_memory=True, shuffle=True,
+        train_dataloader = DataLoader(trainset, batch_size=batch_size, pin_memory=pin_memory, shuffle=True,
                                       num_workers=0)  # 50,000 images
-        test_dataloader = DataLoader(testset, batch_size=batch_size, pin_memory=True, shuffle=False,
+        test_dataloader = DataLoader(testset, batch_size=batch_size, pin_memory=pin_memory, shuffle=False,
                                      num_workers=0)  # 10,000 images
         return train_dataloader, None, test_dataloader
 
@@ -146,7 +147,7 @@ def load_fashion_mnist(batch_size, val_split=True, subset=[-1, -1, -1]):
 
 
 def load_cifar10(batch_size, num_train=45000, val_split=True, augmentation=False, subset=[-1, -1, -1],
-                 only_split_train=False):
+                 only_split_train=False, pin_memory=True):
     train_transforms = []
     test_transforms = []
 
@@ -197,11 +198,11 @@ def load_cifar10(batch_size, num_train=45000, val_split=True, augmentation=False
             if subset[1] != -1:
                 valset = getSubset(valset, subset[1])
 
-        train_dataloader = DataLoader(trainset, batch_size=batch_size, shuffle=True, pin_memory=True,
+        train_dataloader = DataLoader(trainset, batch_size=batch_size, shuffle=True, pin_memory=pin_memory,
                                       num_workers=0)  # 45,000 images
-        val_dataloader = DataLoader(valset, batch_size=batch_size, shuffle=True, pin_memory=True,
+        val_dataloader = DataLoader(valset, batch_size=batch_size, shuffle=True, pin_memory=pin_memory,
                                     num_workers=0)  # 5,000 images
-        test_dataloader = DataLoader(testset, batch_size=batch_size, shuffle=False, pin_memory=True,
+        test_dataloader = DataLoader(testset, batch_size=batch_size, shuffle=False, pin_memory=pin_memory,
                                      num_workers=0)  # 10,000 images
 
         return train_dataloader, val_dataloader, test_dataloader
@@ -214,15 +215,16 @@ def load_cifar10(batch_size, num_train=45000, val_split=True, augmentation=False
         if subset[2] != -1:
             testset = getSubset(testset, subset[2])
 
-        train_dataloader = DataLoader(trainset, batch_size=batch_size, shuffle=True, pin_memory=True,
+        train_dataloader = DataLoader(trainset, batch_size=batch_size, shuffle=True, pin_memory=pin_memory,
                                       num_workers=2)  # 50,000 images
-        test_dataloader = DataLoader(testset, batch_size=batch_size, shuffle=False, pin_memory=True,
+        test_dataloader = DataLoader(testset, batch_size=batch_size, shuffle=False, pin_memory=pin_memory,
                                      num_workers=2)  # 10,000 images
 
         return train_dataloader, None, test_dataloader
 
 
-def load_cifar100(batch_size, num_train=45000, val_split=True, augmentation=False, subset=[-1, -1, -1]):
+def load_cifar100(batch_size, num_train=45000, val_split=True, augmentation=False, subset=[-1, -1, -1],
+                  pin_memory=False):
     train_transforms = []
     test_transforms = []
 
@@ -260,9 +262,12 @@ def load_cifar100(batch_size, num_train=45000, val_split=True, augmentation=Fals
         if subset[1] != -1:
             valset = getSubset(valset, subset[1])
 
-        train_dataloader = DataLoader(trainset, batch_size=batch_size, shuffle=True, num_workers=0)  # 45,000 images
-        val_dataloader = DataLoader(valset, batch_size=batch_size, shuffle=True, num_workers=0)  # 5,000 images
-        test_dataloader = DataLoader(testset, batch_size=batch_size, shuffle=False, num_workers=0)  # 10,000 images
+        train_dataloader = DataLoader(trainset, batch_size=batch_size, shuffle=True, pin_memory=pin_memory,
+                                      num_workers=0)  # 45,000 images
+        val_dataloader = DataLoader(valset, batch_size=batch_size, shuffle=True, pin_memory=pin_memory,
+                                    num_workers=0)  # 5,000 images
+        test_dataloader = DataLoader(testset, batch_size=batch_size, shuffle=False, pin_memory=pin_memory,
+                                     num_workers=0)  # 10,000 images
 
         return train_dataloader, val_dataloader, test_dataloader
     else:
@@ -274,13 +279,15 @@ def load_cifar100(batch_size, num_train=45000, val_split=True, augmentation=Fals
         if subset[2] != -1:
             testset = getSubset(testset, subset[2])
 
-        train_dataloader = DataLoader(trainset, batch_size=batch_size, shuffle=True, num_workers=0)  # 50,000 images
-        test_dataloader = DataLoader(testset, batch_size=batch_size, shuffle=False, num_workers=0)  # 10,000 images
+        train_dataloader = DataLoader(trainset, batch_size=batch_size, shuffle=True, pin_memory=pin_memory,
+                                      num_workers=0)  # 50,000 images
+        test_dataloader = DataLoader(testset, batch_size=batch_size, shuffle=False, pin_memory=pin_memory,
+                                     num_workers=0)  # 10,000 images
 
         return train_dataloader, None, test_dataloader
 
 
-def load_ham(batch_size, val_split=True, augmentation=False, subset=[-1, -1, -1]):
+def load_ham(batch_size, val_split=True, augmentation=False, subset=[-1, -1, -1], pin_memory=True):
     train_transforms = []
     test_transforms = []
 
@@ -336,11 +343,11 @@ def load_ham(batch_size, val_split=True, augmentation=False, subset=[-1, -1, -1]
         if subset[1] != -1:
             valset = getSubset(valset, subset[1])
 
-        train_dataloader = DataLoader(trainset, batch_size=batch_size, shuffle=True, pin_memory=True,
+        train_dataloader = DataLoader(trainset, batch_size=batch_size, shuffle=True, pin_memory=pin_memory,
                                       num_workers=0)  # 45,000 images
-        val_dataloader = DataLoader(valset, batch_size=batch_size, shuffle=True, pin_memory=True,
+        val_dataloader = DataLoader(valset, batch_size=batch_size, shuffle=True, pin_memory=pin_memory,
                                     num_workers=0)  # 5,000 images
-        test_dataloader = DataLoader(testset, batch_size=batch_size, shuffle=False, pin_memory=True,
+        test_dataloader = DataLoader(testset, batch_size=batch_size, shuffle=False, pin_memory=pin_memory,
                                      num_workers=0)  # 10,000 images
 
         return train_dataloader, val_dataloader, test_dataloader
@@ -356,9 +363,9 @@ def load_ham(batch_size, val_split=True, augmentation=False, subset=[-1, -1, -1]
         if subset[2] != -1:
             testset = getSubset(testset, subset[2])
 
-        train_dataloader = DataLoader(trainset, batch_size=batch_size, shuffle=True, pin_memory=True,
+        train_dataloader = DataLoader(trainset, batch_size=batch_size, shuffle=True, pin_memory=pin_memory,
                                       num_workers=2)  # 50,000 images
-        test_dataloader = DataLoader(testset, batch_size=batch_size, shuffle=False, pin_memory=True,
+        test_dataloader = DataLoader(testset, batch_size=batch_size, shuffle=False, pin_memory=pin_memory,
                                      num_workers=2)  # 10,000 images
 
         return train_dataloader, None, test_dataloader
@@ -11,7 +11,8 @@ import torch.nn.functional as F
 
 # Local imports
 import data_loaders
-from csv_logger import CSVLogger
+from utils.csv_logger import CSVLogger
+from utils.device import add_device_arguments, device_policy
 
 
 parser = argparse.ArgumentParser(description='CNN Hyperparameter Fine-tuning')
@@ -35,7 +36,9 @@ parser.add_argument('--load_checkpoint', type=str,
                     help='Path to pre-trained checkpoint to load and finetune')
 parser.add_argument('--save_dir', type=str, default='finetuned_checkpoints',
                     help='Save directory for the fine-tuned checkpoint')
+add_device_arguments(parser)
 args = parser.parse_args()
+policy = device_policy(args)
 
 
 if not os.path.exists(args.save_dir):
@@ -46,7 +49,8 @@ filename = os.path.join(args.save_dir, test_id + '.csv')
 csv_logger = CSVLogger(fieldnames=['epoch', 'train_loss', 'train_acc', 'val_loss', 'val_acc', 'test_loss', 'test_acc'],
                        filename=filename)
 
-model = torch.load(args.load_checkpoint)
+# The checkpoint is a whole pickled model, not a state dict
+model = policy.module(torch.load(args.load_checkpoint, map_location=policy.device, weights_only=False))
 
 
 # TODO(PV): Load saved optimizer from the training run
@@ -56,10 +60,14 @@ optimizer = optim.SGD(model.parameters(), lr=args.lr, momentum=0.9, nesterov=Tru
 # data_augmentation_hparams = {}  # Random values for hue, saturation, brightness, contrast, rotation, etc.
 if args.dataset == 'cifar10':
     num_classes = 10
-    train_loader, val_loader, test_loader = data_loaders.load_cifar10(args.batch_size, val_split=True, augmentation=args.data_augmentation)
+    train_loader, val_loader, test_loader = data_loaders.load_cifar10(args.batch_size, val_split=True,
+                                                                      augmentation=args.data_augmentation,
+                                                                      pin_memory=policy.pin_memory)
 elif args.dataset == 'cifar100':
     num_classes = 100
-    train_loader, val_loader, test_loader = data_loaders.load_cifar100(args.batch_size, val_split=True, augmentation=args.data_augmentation)
+    train_loader, val_loader, test_loader = data_loaders.load_cifar100(args.batch_size, val_split=True,
+                                                                       augmentation=args.data_augmentation,
+                                                                       pin_memory=policy.pin_memory)
 
 
 def test(loader):
@@ -68,8 +76,7 @@ def test(loader):
     total = 0.
     losses = []
     for images, labels in loader:
-        images = images.cuda()
-        labels = labels.cuda()
+        images, labels = policy.batch(images, labels)
 
         with torch.no_grad():
             pred = model(images)
@@ -96,7 +103,7 @@ for epoch in range(args.num_finetune_epochs):
     for i, (images, labels) in enumerate(progress_bar):
         progress_bar.set_description('Finetune Epoch ' + str(epoch))
 
-        images, labels = images.cuda(), labels.cuda()
+        images, labels = policy.batch(images, labels)
 
         pred = model(images)
         xentropy_loss = F.cross_entropy(pred, labels)
@@ -12,10 +12,13 @@ from torch.autograd import Variable
 
 # Local imports
 import data_loaders
-from csv_logger import CSVLogger
-from resnet import ResNet18
-from wide_resnet import WideResNet
-from unet import UNet
+from utils.csv_logger import CSVLogger
+from models.resnet import ResNet18
+from models.wide_resnet import WideResNet
+from models.unet import UNet
+from utils.data_iter import CycleLoader
+from utils.device import add_device_arguments, device_policy
+from utils.profiling import PhaseTimer, add_profiling_arguments
 
 
 def experiment():
@@ -40,17 +43,22 @@ def experiment():
                         help='Path to pre-trained checkpoint to load and finetune')
     parser.add_argument('--save_dir', type=str, default='finetuned_checkpoints',
                         help='Save directory for the fine-tuned checkpoint')
+    add_device_arguments(parser)
+    add_profiling_arguments(parser)
     args = parser.parse_args()
+    policy = device_policy(args, double_backward=True)
     args.load_checkpoint = '/h/lorraine/PycharmProjects/CG_IFT_test/baseline_checkpoints/cifar10_resnet18_sgdm_lr0.1_wd0.0005_aug0.pt'
 
     if args.dataset == 'cifar10':
         num_classes = 10
         train_loader, val_loader, test_loader = data_loaders.load_cifar10(args.batch_size, val_split=True,
-                                                                          augmentation=args.data_augmentation)
+                                                                          augmentation=args.data_augmentation,
+                                                                          pin_memory=policy.pin_memory)
     elif args.dataset == 'cifar100':
         num_classes = 100
         train_loader, val_loader, test_loader = data_loaders.load_cifar100(args.batch_size, val_split=True,
-                                                                           augmentation=args.data_augmentation)
+                                                                           augmentation=args.data_augmentation,
+                                                                           pin_memory=policy.pin_memory)
 
     if args.model == 'resnet18':
         cnn = ResNet18(num_classes=num_classes)
@@ -64,13 +72,14 @@ def experiment():
                                                 int(args.data_augmentation))
     filename = os.path.join(args.save_dir, test_id + '.csv')
     csv_logger = CSVLogger(
-        fieldnames=['epoch', 'train_loss', 'train_acc', 'val_loss', 'val_acc', 'test_loss', 'test_acc'],
+        fieldnames=['epoch', 'train_loss', 'train_acc', 'val_loss', 'val_acc', 'test_loss', 'test_acc']
+                   + PhaseTimer.fieldnames(),
         filename=filename)
 
-    checkpoint = torch.load(args.load_checkpoint)
+    checkpoint = torch.load(args.load_checkpoint, map_location=policy.device)
     init_epoch = checkpoint['epoch']
     cnn.load_state_dict(checkpoint['model_state_dict'])
-    model = cnn.cuda()
+    model = policy.module(cnn)
     model.train()
 
     args.hyper_train = 'augment'  # 'all_weight'  # 'weight'
@@ -83,14 +92,12 @@ def experiment():
         init_hyper = None
         if args.hyper_train == 'weight':
             init_hyper = np.sqrt(args.wdecay)
-            model.weight_decay = Variable(torch.FloatTensor([init_hyper]).cuda(), requires_grad=True)
-            model.weight_decay = model.weight_decay.cuda()
+            model.weight_decay = policy.tensor([init_hyper], requires_grad=True)
         elif args.hyper_train == 'all_weight':
             num_p = sum(p.numel() for p in model.parameters())
             weights = np.ones(num_p) * np.sqrt(args.wdecay)
-            model.weight_decay = Variable(torch.FloatTensor(weights).cuda(), requires_grad=True)
-            model.weight_decay = model.weight_decay.cuda()
-        model = model.cuda()
+            model.weight_decay = policy.tensor(weights, requires_grad=True)
+        model = policy.module(model)
         return init_hyper
 
     if args.hyper_train == 'augment':  # Dont do inside the prior function, else scope is wrong
@@ -101,7 +108,7 @@ def experiment():
                            padding=True,
                            batch_norm=False,
                            up_mode='upconv')  # TODO(PV): Initialize UNet properly
-        augment_net = augment_net.cuda()
+        augment_net = policy.module(augment_net)
 
     def get_hyper_train():
         """
@@ -114,7 +121,7 @@ def experiment():
             return augment_net.parameters()
 
     def get_hyper_train_flat():
-        return torch.cat([p.view(-1) for p in get_hyper_train()])
+        return torch.cat([p.reshape(-1) for p in get_hyper_train()])
 
     # TODO: Check this size
 
@@ -136,11 +143,13 @@ def experiment():
     if args.dataset == 'cifar10':
         num_classes = 10
         train_loader, val_loader, test_loader = data_loaders.load_cifar10(args.batch_size, val_split=True,
-                                                                          augmentation=args.data_augmentation)
+                                                                          augmentation=args.data_augmentation,
+                                                                          pin_memory=policy.pin_memory)
     elif args.dataset == 'cifar100':
         num_classes = 100
         train_loader, val_loader, test_loader = data_loaders.load_cifar100(args.batch_size, val_split=True,
-                                                                           augmentation=args.data_augmentation)
+                                                                           augmentation=args.data_augmentation,
+                                                                           pin_memory=policy.pin_memory)
 
     def test(loader):
         model.eval()  # Change model to 'eval' mode (BN uses moving mean/var).
@@ -148,8 +157,7 @@ def experiment():
         total = 0.
         losses = []
         for images, labels in loader:
-            images = images.cuda()
-            labels = labels.cuda()
+            images, labels = policy.batch(images, labels)
 
             with torch.no_grad():
                 pred = model(images)
@@ -173,7 +181,7 @@ def experiment():
         :param y:
         :return:
         """
-        x, y = x.cuda(), y.cuda()
+        x, y = policy.batch(x, y)
 
         # x, y = Variable(x), Variable(y)
         return x, y
@@ -223,6 +231,8 @@ def experiment():
         xentropy_loss = F.cross_entropy(pred, y)
         return xentropy_loss
 
+    hyper_train_batches, hyper_val_batches = CycleLoader(train_loader), CycleLoader(val_loader)
+    phase_timer = PhaseTimer(policy, args.profile_memory, args.sync_phase_timing)
     for epoch in range(init_epoch, init_epoch + args.num_finetune_epochs):
         xentropy_loss_avg = 0.
         total_val_loss = 0.
@@ -237,12 +247,12 @@ def experiment():
             optimizer.zero_grad(), hyper_optimizer.zero_grad()
             val_loss, weight_norm, grad_norm = hyper_step(1, 1, get_hyper_train, get_hyper_train_flat,
                                                                 model, val_loss_func,
-                                                                val_loader, train_loss_func, train_loader,
-                                                                hyper_optimizer)
+                                                                hyper_val_batches, train_loss_func,
+                                                                hyper_train_batches, hyper_optimizer, phase_timer)
             # del val_loss
             # print(f"hyper: {get_hyper_train()}")
 
-            images, labels = images.cuda(), labels.cuda()
+            images, labels = policy.batch(images, labels)
             # pred = model(images)
             # xentropy_loss = F.cross_entropy(pred, labels)
             xentropy_loss, pred = train_loss_func(images, labels)
@@ -266,6 +276,7 @@ def experiment():
                 weight='%.2f' % weight_norm,
                 update='%.3f' % grad_norm)
 
+        tqdm.write(phase_timer.summary('Finetune epoch {} hyper steps'.format(epoch)))
         val_loss, val_acc = test(val_loader)
         test_loss, test_acc = test(test_loader)
         tqdm.write('val loss: {:6.4f} | val acc: {:6.4f} | test loss: {:6.4f} | test_acc: {:6.4f}'.format(
@@ -276,7 +287,7 @@ def experiment():
         row = {'epoch': str(epoch),
                'train_loss': str(xentropy_loss_avg / (i + 1)), 'train_acc': str(accuracy),
                'val_loss': str(val_loss), 'val_acc': str(val_acc),
-               'test_loss': str(test_loss), 'test_acc': str(test_acc)}
+               'test_loss': str(test_loss), 'test_acc': str(test_acc), **phase_timer.row()}
         csv_logger.writerow(row)
 
 
@@ -381,64 +392,67 @@ def experiment():
 
 
 def hyper_step(train_batch_num, val_batch_num, get_hyper_train, get_hyper_train_flat, model, val_loss_func, val_loader, train_loss_func,
-               train_loader, hyper_optimizer):
+               train_loader, hyper_optimizer, timer=None):
     """
 
     :param train_batch_num:
     :param val_batch_num:
+    :param val_loader: A CycleLoader over the validation set, shared across hyper steps.
+    :param train_loader: A CycleLoader over the training set, shared across hyper steps.
+    :param timer: A PhaseTimer recording the phases of the step.
     :return:
     """
-    from util import gather_flat_grad
-    train_batch_num -= 1
-    val_batch_num -= 1
+    from utils.util import gather_flat_grad
+    timer = PhaseTimer() if timer is None else timer
 
     # set up placeholder for the partial derivative in each batch
-    total_d_val_loss_d_lambda = torch.zeros(get_hyper_train_flat().size(0)).cuda()
+    total_d_val_loss_d_lambda = torch.zeros_like(get_hyper_train_flat())
 
     num_weights = sum(p.numel() for p in model.parameters())
-    d_val_loss_d_theta = torch.zeros(num_weights).cuda()
+    d_val_loss_d_theta = torch.zeros(num_weights, device=next(model.parameters()).device)
     model.train()
-    for batch_idx, (x, y) in enumerate(val_loader):
-        model.zero_grad()
-        val_loss = val_loss_func(x, y)
-        # val_loss_grad = grad(val_loss, model.parameters())
-        d_val_loss_d_theta = d_val_loss_d_theta + gather_flat_grad(grad(val_loss, model.parameters()))
-        if batch_idx >= val_batch_num: break
+    for batch_idx, (x, y) in enumerate(val_loader.take(val_batch_num)):
+        with timer.phase('val_grad'):
+            model.zero_grad()
+            val_loss = val_loss_func(x, y)
+            # val_loss_grad = grad(val_loss, model.parameters())
+            d_val_loss_d_theta = d_val_loss_d_theta + gather_flat_grad(grad(val_loss, model.parameters()))
     d_val_loss_d_theta = d_val_loss_d_theta / (batch_idx + 1)
 
     model.train()  # train()
-    for batch_idx, (x, y) in enumerate(train_loader):
-        train_loss, _ = train_loss_func(x, y)
-        # TODO (JON): Probably don't recompute - use create_graph and retain_graph?
+    for batch_idx, (x, y) in enumerate(train_loader.take(train_batch_num)):
+        with timer.phase('train_grad'):
+            train_loss, _ = train_loss_func(x, y)
+            # TODO (JON): Probably don't recompute - use create_graph and retain_graph?
 
-        model.zero_grad()
-        # hyper_optimizer.zero_grad()
-        d_train_loss_d_theta = grad(train_loss, model.parameters(), create_graph=True)
-        # flat_d_train_loss_d_theta = gather_flat_grad(d_train_loss_d_theta)
-
-        flat_d_train_loss_d_theta = d_val_loss_d_theta.detach().reshape(1, -1) @ gather_flat_grad(
-            d_train_loss_d_theta).reshape(-1, 1)
+            model.zero_grad()
+            # hyper_optimizer.zero_grad()
+            d_train_loss_d_theta = gather_flat_grad(grad(train_loss, model.parameters(), create_graph=True))
+        timer.count_hvps(d_train_loss_d_theta)
 
-        model.zero_grad()
-        # hyper_optimizer.zero_grad()
+        # The inverse Hessian is approximated by the identity, so there is no inverse phase
+        with timer.phase('mixed_grad'):
+            flat_d_train_loss_d_theta = d_val_loss_d_theta.detach().reshape(1, -1) @ d_train_loss_d_theta.reshape(-1, 1)
 
-        # flat_d_train_loss_d_theta.backward()  #flat_pre_conditioner)
-        # if get_hyper_train().grad is not None:
-        #if gather_flat_grad(get_hyper_train()) is not None:
-        total_d_val_loss_d_lambda = total_d_val_loss_d_lambda - gather_flat_grad(
-                grad(flat_d_train_loss_d_theta.reshape(1), get_hyper_train()))
+            model.zero_grad()
+            # hyper_optimizer.zero_grad()
 
-        if batch_idx >= train_batch_num: break
+            # flat_d_train_loss_d_theta.backward()  #flat_pre_conditioner)
+            # if get_hyper_train().grad is not None:
+            #if gather_flat_grad(get_hyper_train()) is not None:
+            total_d_val_loss_d_lambda = total_d_val_loss_d_lambda - gather_flat_grad(
+                    grad(flat_d_train_loss_d_theta.reshape(1), get_hyper_train()))
 
     total_d_val_loss_d_lambda = total_d_val_loss_d_lambda / (batch_idx + 1)
 
-    direct_d_val_loss_d_lambda = torch.zeros(get_hyper_train_flat().size(0)).cuda()
+    direct_d_val_loss_d_lambda = torch.zeros_like(get_hyper_train_flat())
 
     grad_to_assign = direct_d_val_loss_d_lambda + total_d_val_loss_d_lambda
     current_index = 0
     for p in get_hyper_train():
         p_num_params = np.prod(p.shape)
-        p.grad = grad_to_assign[current_index:current_index + p_num_params].view(p.shape)
+        p_grad = grad_to_assign[current_index:current_index + p_num_params].view(p.shape)
+        p.grad = p_grad if p.is_contiguous() else torch.empty_like(p).copy_(p_grad)
         current_index += p_num_params
     # get_hyper_train().grad = (direct_d_val_loss_d_lambda + total_d_val_loss_d_lambda)
 
@@ -446,7 +460,9 @@ def hyper_step(train_batch_num, val_batch_num, get_hyper_train, get_hyper_train_
     print("weight={}, update={}".format(weight_norm, grad_norm))
     # print("weight={}, update={}".format(get_hyper_train_flat().norm(), gather_flat_grad(get_hyper_train()).norm()))
 
-    hyper_optimizer.step()
+    with timer.phase('hyper_opt'):
+        hyper_optimizer.step()
+    timer.end_step()
     model.zero_grad()
     # hyper_optimizer.zero_grad()
 
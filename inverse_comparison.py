@@ -1,5 +1,6 @@
 import os
 import time
+from contextlib import nullcontext
 
 import ipdb
 import argparse
@@ -19,6 +20,8 @@ from models import resnet_cifar
 from models.resnet import ResNet18
 from models.simple_models import Net
 from models.wide_resnet import WideResNet
+from utils.device import device_policy
+from utils.profiling import PhaseTimer
 from utils.util import gather_flat_grad
 
 
@@ -44,20 +47,25 @@ def saver(epoch, elementary_model, elementary_optimizer, augment_net, reweightin
     }, path + '/checkpoint.pt')
 
 
-def load_baseline_model(args):
+def load_baseline_model(args, policy=None):
     """
 
     :param args:
+    :param policy: DevicePolicy to place the model and loaders with, built from args if None
     :return:
     """
+    if policy is None:
+        policy = device_policy(args, double_backward=True)
     if args.dataset == 'cifar10':
         num_classes = 10
         train_loader, val_loader, test_loader = data_loaders.load_cifar10(args.batch_size, val_split=True,
-                                                                          augmentation=args.data_augmentation)
+                                                                          augmentation=args.data_augmentation,
+                                                                          pin_memory=policy.pin_memory)
     elif args.dataset == 'cifar100':
         num_classes = 100
         train_loader, val_loader, test_loader = data_loaders.load_cifar100(args.batch_size, val_split=True,
-                                                                           augmentation=args.data_augmentation)
+                                                                           augmentation=args.data_augmentation,
+                                                                           pin_memory=policy.pin_memory)
     elif args.dataset == 'mnist':
         args.datasize, args.valsize, args.testsize = 100, 100, 100
         num_train = args.datasize
@@ -67,7 +75,7 @@ def load_baseline_model(args):
         from data_loaders import load_mnist
         train_loader, val_loader, test_loader = load_mnist(args.batch_size,
                                                            subset=[args.datasize, args.valsize, args.testsize],
-                                                           num_train=num_train)
+                                                           num_train=num_train, pin_memory=policy.pin_memory)
 
     if args.model == 'resnet18':
         cnn = ResNet18(num_classes=num_classes)
@@ -76,21 +84,24 @@ def load_baseline_model(args):
 
     checkpoint = None
     if args.load_baseline_checkpoint:
-        checkpoint = torch.load(args.load_baseline_checkpoint)
+        checkpoint = torch.load(args.load_baseline_checkpoint, map_location=policy.device)
         cnn.load_state_dict(checkpoint['model_state_dict'])
 
-    model = cnn.cuda()
+    model = policy.module(cnn)
     model.train()
     return model, train_loader, val_loader, test_loader, checkpoint
 
 
-def load_finetuned_model(args, baseline_model):
+def load_finetuned_model(args, baseline_model, policy=None):
     """
 
     :param args:
     :param baseline_model:
+    :param policy: DevicePolicy to place the models with, built from args if None
     :return:
     """
+    if policy is None:
+        policy = device_policy(args, double_backward=True)
     # augment_net = Net(0, 0.0, 32, 3, 0.0, num_classes=32**2 * 3, do_res=True)
     augment_net = UNet(in_channels=3, n_classes=3, depth=1, wf=2, padding=True, batch_norm=False,
                        do_noise_channel=True,
@@ -104,7 +115,7 @@ def load_finetuned_model(args, baseline_model):
     #resnet_cifar.resnet20(num_classes=1)
 
     if args.load_finetune_checkpoint:
-        checkpoint = torch.load(args.load_finetune_checkpoint)
+        checkpoint = torch.load(args.load_finetune_checkpoint, map_location=policy.device)
         baseline_model.load_state_dict(checkpoint['elementary_model_state_dict'])
         augment_net.load_state_dict(checkpoint['augment_model_state_dict'])
         try:
@@ -112,7 +123,8 @@ def load_finetuned_model(args, baseline_model):
         except KeyError:
             pass
 
-    augment_net, reweighting_net, baseline_model = augment_net.cuda(), reweighting_net.cuda(), baseline_model.cuda()
+    augment_net, reweighting_net = policy.module(augment_net), policy.module(reweighting_net)
+    baseline_model = policy.module(baseline_model)
     augment_net.train(), reweighting_net.train(), baseline_model.train()
     return augment_net, reweighting_net, baseline_model
 
@@ -292,7 +304,8 @@ def cg_batch(A_bmm, B, M_bmm=None, X0=None, rtol=1e-4, atol=0.0, maxiter=5, verb
 # TODO: Don't feed in the grad.  Recompute it
 # TODO: Dont give the elementary optimizer... Just the lr?
 # TODO: Take the hyper_step outside of this so I dont feed in optimizer
-def hyper_step(get_hyper_train, model, val_loss_func, val_loader, d_train_loss_d_w, elementary_lr, use_reg, args):
+def hyper_step(get_hyper_train, model, val_loss_func, val_loader, d_train_loss_d_w, elementary_lr, use_reg, args,
+               timer=None, policy=None):
     """Estimate the hypergradient, and take an update with it.
 
     :param get_hyper_train:  A function which returns the hyperparameters we want to tune.
@@ -301,63 +314,73 @@ def hyper_step(get_hyper_train, model, val_loss_func, val_loader, d_train_loss_d
     :param val_loader: A generator for input x, output y tuples.
     :param d_train_loss_d_w:  The derivative of the training loss with respect to elementary parameters.
     :param hyper_optimizer: The optimizer which updates the hyperparameters.
+    :param timer: A PhaseTimer recording the phases of the step.
+    :param policy: The DevicePolicy of the run, built from args if None.
     :return: The scalar valued validation loss, the hyperparameter norm, and the hypergradient norm.
     """
+    timer = PhaseTimer() if timer is None else timer
+    policy = device_policy(args, double_backward=True) if policy is None else policy
     zero_hypergrad(get_hyper_train)
 
     d_train_loss_d_w = gather_flat_grad(d_train_loss_d_w)
+    timer.count_hvps(d_train_loss_d_w)
 
     # Compute gradients of the validation loss w.r.t. the weights/hypers
     num_weights, num_hypers = sum(p.numel() for p in model.parameters()), sum(p.numel() for p in get_hyper_train())
-    d_val_loss_d_theta, direct_grad = torch.zeros(num_weights).cuda(), torch.zeros(num_hypers).cuda()
+    d_val_loss_d_theta, direct_grad = policy.zeros(num_weights), policy.zeros(num_hypers)
     model.train(), model.zero_grad()
     for batch_idx, (x, y) in enumerate(val_loader):
-        val_loss = val_loss_func(x, y)
-        d_val_loss_d_theta += gather_flat_grad(grad(val_loss, model.parameters(), retain_graph=use_reg))
-        if use_reg:
-            direct_grad += gather_flat_grad(grad(val_loss, get_hyper_train()))
-            direct_grad[direct_grad != direct_grad] = 0
+        with timer.phase('val_grad'):
+            val_loss = val_loss_func(x, y)
+            d_val_loss_d_theta += gather_flat_grad(grad(val_loss, model.parameters(), retain_graph=use_reg))
+            if use_reg:
+                direct_grad += gather_flat_grad(grad(val_loss, get_hyper_train()))
+                direct_grad[direct_grad != direct_grad] = 0
         break
 
     # Initialize the preconditioner and counter
-    if not args.use_cg:
-        preconditioner = neumann_hyperstep_preconditioner(d_val_loss_d_theta, d_train_loss_d_w,
-                                                          elementary_lr, args.num_neumann_terms)
-    else:
-        def A_vector_multiply_func(vec):
-            p1 = d_val_loss_d_theta.view(1, -1) @ vec.view(-1, 1)
-            p2 = d_val_loss_d_theta.view(-1, 1) @ p1
-            return p2.view(1, -1, 1)
-
-        preconditioner, _ = cg_batch(A_vector_multiply_func, d_val_loss_d_theta.view(1, -1, 1))
+    with timer.phase('inverse'):
+        if not args.use_cg:
+            preconditioner = neumann_hyperstep_preconditioner(d_val_loss_d_theta, d_train_loss_d_w,
+                                                              elementary_lr, args.num_neumann_terms)
+        else:
+            def A_vector_multiply_func(vec):
+                p1 = d_val_loss_d_theta.view(1, -1) @ vec.view(-1, 1)
+                p2 = d_val_loss_d_theta.view(-1, 1) @ p1
+                return p2.view(1, -1, 1)
+
+            preconditioner, _ = cg_batch(A_vector_multiply_func, d_val_loss_d_theta.view(1, -1, 1))
     # conjugate_grad(A_vector_multiply_func, d_val_loss_d_theta)
 
     # compute d / d lambda (partial Lv / partial w * partial Lt / partial w)
     # = (partial Lv / partial w * partial^2 Lt / (partial w partial lambda))
-    indirect_grad = gather_flat_grad(grad(d_train_loss_d_w, get_hyper_train(), grad_outputs=preconditioner.view(-1)))
-    hypergrad = direct_grad + indirect_grad
+    with timer.phase('mixed_grad'):
+        indirect_grad = gather_flat_grad(grad(d_train_loss_d_w, get_hyper_train(),
+                                              grad_outputs=preconditioner.view(-1)))
+        hypergrad = direct_grad + indirect_grad
 
-    store_hypergrad(get_hyper_train, hypergrad)
+        store_hypergrad(get_hyper_train, hypergrad)
     return val_loss, hypergrad.norm()
 
 
-def get_models(args):
-    model, train_loader, val_loader, test_loader, checkpoint = load_baseline_model(args)
-    augment_net, reweighting_net, model = load_finetuned_model(args, model)
+def get_models(args, policy=None):
+    if policy is None:
+        policy = device_policy(args, double_backward=True)
+    model, train_loader, val_loader, test_loader, checkpoint = load_baseline_model(args, policy)
+    augment_net, reweighting_net, model = load_finetuned_model(args, model, policy)
     return model, train_loader, val_loader, test_loader, augment_net, reweighting_net, checkpoint
 
 
 def experiment(args):
+    policy = device_policy(args, double_backward=True)
     # Setup the random seeds
-    torch.manual_seed(args.seed)
+    policy.manual_seed(args.seed)
     np.random.seed(args.seed)
-    if torch.cuda.is_available():
-        torch.cuda.manual_seed(args.seed)
 
     # Load the baseline model
     args.load_baseline_checkpoint = '/h/lorraine/PycharmProjects/CG_IFT_test/baseline_checkpoints/cifar10_resnet18_sgdm_lr0.1_wd0.0005_aug1.pt'
     args.load_finetune_checkpoint = None  # TODO: Make it load the augment net if this is provided
-    model, train_loader, val_loader, test_loader, augment_net, reweighting_net, checkpoint = get_models(args)
+    model, train_loader, val_loader, test_loader, augment_net, reweighting_net, checkpoint = get_models(args, policy)
 
     # Load the logger
     from train_augment_net_multiple import load_logger, get_id
@@ -394,14 +417,14 @@ def experiment(args):
 
     graph_iter = 0
     def train_loss_func(x, y):
-        x, y = x.cuda(), y.cuda()
+        x, y = policy.batch(x, y)
         reg = 0.
 
         if args.use_augment_net:
             # old_x = x
             x = augment_net(x, class_label=y)
             '''num_sample = 10
-            xs =torch.zeros(num_sample, x.shape[0], x.shape[1], x.shape[2], x.shape[3]).cuda()
+            xs = policy.zeros(num_sample, x.shape[0], x.shape[1], x.shape[2], x.shape[3])
             for i in range(num_sample):
                 xs[i] = augment_net(x, class_label=y)
             xs_diffs = (torch.mean(xs, dim=0) - old_x) ** 2
@@ -456,7 +479,7 @@ def experiment(args):
         use_reg = False
 
     def val_loss_func(x, y):
-        x, y = x.cuda(), y.cuda()
+        x, y = policy.batch(x, y)
         pred = model(x)
         xentropy_loss = F.cross_entropy(pred, y)
 
@@ -464,7 +487,7 @@ def experiment(args):
         if args.use_augment_net:
             if use_reg:
                 num_sample = 10
-                xs = torch.zeros(num_sample, x.shape[0], x.shape[1], x.shape[2], x.shape[3]).cuda()
+                xs = policy.zeros(num_sample, x.shape[0], x.shape[1], x.shape[2], x.shape[3])
                 for i in range(num_sample):
                     xs[i] = augment_net(x, class_label=y)
                 xs_diffs = (torch.abs(torch.mean(xs, dim=0) - x))
@@ -486,7 +509,7 @@ def experiment(args):
         correct, total = 0., 0.
         losses = []
         for images, labels in loader:
-            images, labels = images.cuda(), labels.cuda()
+            images, labels = policy.batch(images, labels)
 
             with torch.no_grad():
                 pred = model(images)
@@ -518,6 +541,7 @@ def experiment(args):
     print(f"Initial Val Loss: {val_loss, val_acc}")
     print(f"Initial Test Loss: {test_loss, test_acc}")
     iteration = 0
+    phase_timer = PhaseTimer(policy, args.profile_memory, args.sync_phase_timing)
     for epoch in range(0, args.num_finetune_epochs):
         reg_anneal_epoch = epoch
         xentropy_loss_avg = 0.
@@ -532,7 +556,7 @@ def experiment(args):
         for i, (images, labels) in enumerate(progress_bar):
             progress_bar.set_description('Finetune Epoch ' + str(epoch))
 
-            images, labels = images.cuda(), labels.cuda()
+            images, labels = policy.batch(images, labels)
             # pred = model(images)
             xentropy_loss, pred = train_loss_func(images, labels)  # F.cross_entropy(pred, labels)
             xentropy_loss_avg += xentropy_loss.item()
@@ -544,7 +568,10 @@ def experiment(args):
                     p.grad = p.grad * 0
                 current_index += p_num_params
             # optimizer.zero_grad()
-            train_grad = grad(xentropy_loss, model.parameters(), create_graph=True)  #
+            # The gradient is also used for the elementary step, but only needs its graph for the hyper steps
+            hyper_step_due = args.num_neumann_terms >= 0 and i % num_tune_hyper == 0
+            with phase_timer.phase('train_grad') if hyper_step_due else nullcontext():
+                train_grad = grad(xentropy_loss, model.parameters(), create_graph=True)  #
 
             if args.num_neumann_terms >= 0:  # if this is less than 0, then don't do hyper_steps
                 if i % num_tune_hyper == 0:
@@ -553,8 +580,10 @@ def experiment(args):
                         cur_lr = param_group['lr']
                         break
                     val_loss, grad_norm = hyper_step(get_hyper_train, model, val_loss_func, val_loader,
-                                                     train_grad, cur_lr, use_reg, args)
-                    hyper_optimizer.step()
+                                                     train_grad, cur_lr, use_reg, args, phase_timer, policy)
+                    with phase_timer.phase('hyper_opt'):
+                        hyper_optimizer.step()
+                    phase_timer.end_step()
 
                     weight_norm = get_hyper_train_flat().norm()
                     total_val_loss += val_loss.item()
@@ -596,8 +625,9 @@ def experiment(args):
                                      'val_loss': str(val_loss), 'val_acc': str(val_acc),
                                      'test_loss': str(test_loss), 'test_acc': str(test_acc),
                                      'run_time': time.time() - init_time,
-                                     'iteration': iteration})
+                                     'iteration': iteration, **phase_timer.row()})
 
+        tqdm.write(phase_timer.summary('Finetune epoch {} hyper steps'.format(epoch)))
         val_loss, val_acc = test(val_loader)
         test_loss, test_acc = test(test_loader)
         tqdm.write('val loss: {:6.4f} | val acc: {:6.4f} | test loss: {:6.4f} | test_acc: {:6.4f}'.format(
@@ -608,7 +638,7 @@ def experiment(args):
                              'train_loss': str(xentropy_loss_avg / (i + 1)), 'train_acc': str(accuracy),
                              'val_loss': str(val_loss), 'val_acc': str(val_acc),
                              'test_loss': str(test_loss), 'test_acc': str(test_acc),
-                             'run_time': time.time() - init_time, 'iteration': iteration})
+                             'run_time': time.time() - init_time, 'iteration': iteration, **phase_timer.row()})
 
 
 def make_test_arg():
@@ -10,7 +10,7 @@ import pdb
 import os
 import sys
 sys.path.insert(0, os.path.abspath(".."))
-from logger import Logger
+from utils.device import add_device_arguments, device_policy
 
 
 ###############################################################################
@@ -44,15 +44,15 @@ parser.add_argument('--log_interval', type=int, default=50, metavar='N',
                     help='how many batches to wait before logging training status')
 parser.add_argument('--save', action='store_true', default=False,
                     help='whether to save current run')
+add_device_arguments(parser)
 args = parser.parse_args()
-args.cuda = not args.no_cuda and torch.cuda.is_available()
+policy = device_policy(args)
+args.cuda = policy.is_cuda
 
-torch.manual_seed(args.seed)
-if args.cuda:
-    torch.cuda.manual_seed(args.seed)
+policy.manual_seed(args.seed)
 
 
-kwargs = {'num_workers': 1, 'pin_memory': True} if args.cuda else {}
+kwargs = {'num_workers': 1, 'pin_memory': policy.pin_memory} if args.cuda else {}
 train_loader = torch.utils.data.DataLoader(
     datasets.MNIST('~/data', train=True, download=True,
                    transform=transforms.Compose([
@@ -102,9 +102,7 @@ class Net(nn.Module):
 ###############################################################################
 # Training
 ###############################################################################
-model = Net(args.num_layers, args.dropout)
-if args.cuda:
-    model.cuda()
+model = policy.module(Net(args.num_layers, args.dropout))
 
 optimizer = optim.SGD(model.parameters(), lr=args.lr, momentum=args.momentum)
 
@@ -112,9 +110,7 @@ def train(epoch, global_step):
     model.train()
     for batch_idx, (data, target) in enumerate(train_loader):
         # Load data.
-        if args.cuda:
-            data, target = data.cuda(), target.cuda()
-        data, target = Variable(data), Variable(target)
+        data, target = policy.batch(data, target)
         data = F.dropout(data, args.input_dropout)
 
         # Process data and take a step.
@@ -128,8 +124,8 @@ def train(epoch, global_step):
         if batch_idx % args.log_interval == 0:
             print('Train Epoch: {} [{}/{} ({:.0f}%)]\tLoss: {:.6f}'.format(
                 epoch, batch_idx * len(data), len(train_loader.dataset),
-                100. * batch_idx / len(train_loader), loss.data[0]))
-            step_stats = (global_step, epoch, batch_idx, loss.data[0])
+                100. * batch_idx / len(train_loader), loss.item()))
+            step_stats = (global_step, epoch, batch_idx, loss.item())
         global_step += 1
 
     return global_step
@@ -140,11 +136,10 @@ def test(global_step):
     test_loss = 0
     correct = 0
     for data, target in test_loader:
-        if args.cuda:
-            data, target = data.cuda(), target.cuda()
-        data, target = Variable(data, volatile=True), Variable(target)
-        output = model(data)
-        test_loss += F.cross_entropy(output, target, size_average=False).data[0] # sum up batch loss
+        data, target = policy.batch(data, target)
+        with torch.no_grad():
+            output = model(data)
+        test_loss += F.cross_entropy(output, target, reduction='sum').item() # sum up batch loss
         pred = output.data.max(1, keepdim=True)[1] # get the index of the max log-probability
         correct += pred.eq(target.data.view_as(pred)).cpu().sum()
 
@@ -14,10 +14,13 @@ from multiprocessing import Pool
 
 # Local imports
 from data_loaders import load_mnist, load_cifar10, load_cifar100, load_ham
-from models.simple_models import CNN, Net, GaussianDropout
+from models.simple_models import CNN, Net, GaussianDropout, weighted_squared_norm
 from utils.util import eval_hessian, eval_jacobian, gather_flat_grad, conjugate_gradiant
 from kfac import KFACOptimizer
 from utils.csv_logger import CSVLogger
+from utils.data_iter import CycleLoader, Prefetcher
+from utils.device import add_device_arguments, device_policy
+from utils.profiling import PhaseTimer, TraceWindow, add_profiling_arguments, add_trace_arguments
 from ruamel.yaml import YAML
 from models.resnet_cifar import resnet44
 
@@ -41,7 +44,8 @@ def experiment(args):
     :return:
     """
     print(f"Running experiment with args: {args}")
-    args.cuda = not args.no_cuda and torch.cuda.is_available()
+    policy = device_policy(args, double_backward=True)
+    args.cuda = policy.is_cuda
 
     # Do this since
     args.train_batch_num -= 1
@@ -53,9 +57,8 @@ def experiment(args):
     yaml.preserve_quotes = True
     yaml.boolean_representation = ['False', 'True']
 
-    torch.manual_seed(args.seed)
+    policy.manual_seed(args.seed)
     np.random.seed(args.seed)
-    if args.cuda: torch.cuda.manual_seed(args.seed)
 
     ###############################################################################
     # Setup dataset
@@ -66,7 +69,7 @@ def experiment(args):
         if num_train == -1: num_train = 50000
         train_loader, val_loader, test_loader = load_mnist(args.batch_size,
                                                            subset=[args.datasize, args.valsize, args.testsize],
-                                                           num_train=num_train)
+                                                           num_train=num_train, pin_memory=policy.pin_memory)
         in_channel = 1
         imsize = 28
         fc_shape = 800
@@ -76,7 +79,8 @@ def experiment(args):
         if num_train == -1: num_train = 45000
         train_loader, val_loader, test_loader = load_cifar10(args.batch_size, num_train=num_train,
                                                              augmentation=True,
-                                                             subset=[args.datasize, args.valsize, args.testsize])
+                                                             subset=[args.datasize, args.valsize, args.testsize],
+                                                             pin_memory=policy.pin_memory)
         in_channel = 3
         imsize = 32
         fc_shape = 250
@@ -86,7 +90,8 @@ def experiment(args):
         if num_train == -1: num_train = 45000
         train_loader, val_loader, test_loader = load_cifar100(args.batch_size, num_train=num_train,
                                                               augmentation=True,
-                                                              subset=[args.datasize, args.valsize, args.testsize])
+                                                              subset=[args.datasize, args.valsize, args.testsize],
+                                                              pin_memory=policy.pin_memory)
         in_channel = 3
         imsize = 32
         fc_shape = 250
@@ -94,7 +99,8 @@ def experiment(args):
 
     elif args.dataset == 'HAM':
         train_loader, val_loader, test_loader = load_ham(args.batch_size, augmentation=True,
-                                                         subset=[args.datasize, args.valsize, args.testsize])
+                                                         subset=[args.datasize, args.valsize, args.testsize],
+                                                         pin_memory=policy.pin_memory)
         num_classes = 7
         in_channel = 3
         imsize = 224
@@ -103,6 +109,7 @@ def experiment(args):
         train_loader, val_loader, test_loader = None, None, None
         in_channel, imsize, fc_shape, num_classes = None, None, None, None
     # TODO (JON): Right now we are not using the test loader for anything.  Should evaluate it occasionally.
+    train_loader, val_loader = Prefetcher(train_loader, args.num_prefetch), Prefetcher(val_loader, args.num_prefetch)
 
     ###############################################################################
     # Setup model
@@ -136,15 +143,7 @@ def experiment(args):
         )
 
         def all_L2_loss():
-            loss = 0
-            count = 0
-            for p in model.parameters():
-                loss += torch.sum(
-                    torch.mul(torch.exp(model.weight_decay[count: count + p.numel()]), torch.flatten(torch.mul(p, p))))
-                # val = torch.flatten(p) - self.weight_decay[count: count + p.numel()]
-                # loss += 1e-3 * torch.sum(torch.mul(val, val))
-                count += p.numel()
-            return loss * torch.exp(model.weight_decay[0])
+            return weighted_squared_norm(model.parameters(), model.weight_decay) * torch.exp(model.weight_decay[0])
 
         model.all_L2_loss = all_L2_loss
         # model.do_train=do_train
@@ -158,35 +157,29 @@ def experiment(args):
         init_hyper = None
         if args.hyper_train == 'weight':
             init_hyper = args.l2
-            model.weight_decay = Variable(torch.FloatTensor([init_hyper]).cuda(), requires_grad=True)
-            # if args.cuda: model.weight_decay = model.weight_decay.cuda()
+            model.weight_decay = policy.tensor([init_hyper], requires_grad=True)
         elif args.hyper_train == 'all_weight':
             init_hyper = args.l2
             num_p = sum(p.numel() for p in model.parameters())
             weights = np.ones(num_p) * init_hyper
-            model.weight_decay = Variable(torch.FloatTensor(weights).cuda(), requires_grad=True)
-            # if args.cuda: model.weight_decay = model.weight_decay.cuda()
+            model.weight_decay = policy.tensor(weights, requires_grad=True)
         elif args.hyper_train == 'opt_data':
             model.num_opt_data = args.batch_size
             # opt_data = torch.zeros(imsize*imsize*in_channel * model.num_opt_data, requires_grad=True)
-            init_x = torch.randn(imsize * imsize * in_channel * model.num_opt_data).cuda() * 0.0  # 0.1
+            init_x = policy.to(torch.randn(imsize * imsize * in_channel * model.num_opt_data)) * 0.0  # 0.1
             init_y = torch.tensor([i % num_classes for i in range(model.num_opt_data)])
             # for x, y in train_loader:
             #   init_x = gather_flat_grad(x).cuda()
             #   init_y = y
             model.opt_data = Variable(init_x, requires_grad=True)
             # torch.FloatTensor(opt_data), requires_grad=True)
-            model.opt_data_y = init_y
-            if args.cuda:
-                # model.opt_data = model.opt_data.cuda()
-                model.opt_data_y = model.opt_data_y.cuda()
+            model.opt_data_y = policy.to(init_y)
         elif args.hyper_train == 'dropout':
             init_hyper = args.dropout
-            model.Gaussian.dropout = Variable(torch.FloatTensor([init_hyper]), requires_grad=True)
-            if args.cuda: model.Gaussian.dropout = Variable(torch.FloatTensor([init_hyper]).cuda(), requires_grad=True)
+            model.Gaussian.dropout = policy.tensor([init_hyper], requires_grad=True)
         elif args.hyper_train == 'various':
             inits = np.zeros(3) - 3
-            model.various = Variable(torch.FloatTensor(inits).cuda(), requires_grad=True)
+            model.various = policy.tensor(inits, requires_grad=True)
         return init_hyper
 
     def get_hyper_train():
@@ -207,10 +200,9 @@ def experiment(args):
 
     hyper = init_hyper_train()  # We need this when doing all_weight
 
-    if args.cuda:
-        model = model.cuda()
-        model.weight_decay = model.weight_decay.cuda()
-        # model.Gaussian.dropout = model.Gaussian.dropout.cuda()
+    model = policy.module(model)
+    model.weight_decay = policy.to(model.weight_decay)
+    # model.Gaussian.dropout = model.Gaussian.dropout.cuda()
 
     ###############################################################################
     # Setup Optimizer
@@ -247,7 +239,7 @@ def experiment(args):
 
     epoch_h_csv_logger = CSVLogger(
         fieldnames=['epoch_h', 'train_loss', 'train_acc', 'val_loss', 'val_acc', 'test_loss', 'test_acc', 'hyper_param',
-                    'hp_update'],
+                    'hp_update'] + PhaseTimer.fieldnames(),
         filename=os.path.join(directory, 'epoch_h_log.csv'))
 
     ###############################################################################
@@ -255,8 +247,8 @@ def experiment(args):
     ###############################################################################
     def change_saturation_brightness(x, saturation, brightness):
         # print(saturation, brightness)
-        saturation_noise = 1.0 + torch.randn(x.shape[0]).cuda() * torch.exp(saturation)
-        brightness_noise = torch.randn(x.shape[0]).cuda() * torch.exp(brightness)
+        saturation_noise = 1.0 + torch.randn(x.shape[0], device=x.device) * torch.exp(saturation)
+        brightness_noise = torch.randn(x.shape[0], device=x.device) * torch.exp(brightness)
         return x * saturation_noise.view(-1, 1, 1, 1) + brightness_noise.view(-1, 1, 1, 1)
 
     def train_loss_func(x, y, network, reduction='elementwise_mean'):
@@ -331,7 +323,7 @@ def experiment(args):
         :param y:
         :return:
         """
-        if args.cuda: x, y = x.cuda(), y.cuda()
+        x, y = policy.batch(x, y)
 
         x, y = Variable(x), Variable(y)
         return x, y
@@ -374,6 +366,7 @@ def experiment(args):
 
             total_loss += loss.item()
             step += 1
+            trace_window.step()
             if batch_idx >= args.train_batch_num: break
 
         # Occasionally record stats.
@@ -423,25 +416,29 @@ def experiment(args):
     KFAC_damping = 1e-2
     kfac_opt = KFACOptimizer(model, damping=KFAC_damping)  # sec_optimizer
 
+    # The hyper steps keep pulling from the same iterators instead of restarting the loaders every call
+    hyper_train_batches, hyper_val_batches = CycleLoader(train_loader), CycleLoader(val_loader)
+    phase_timer = PhaseTimer(policy, args.profile_memory, args.sync_phase_timing)
+    trace_window = TraceWindow(args, os.path.join(directory, 'traces'), policy)
+
     def KFAC_optimize(epoch_h):
         """
 
         :return:
         """
         # set up placeholder for the partial derivative in each batch
-        total_d_val_loss_d_lambda = torch.zeros(get_hyper_train().size(0))
-        if args.cuda: total_d_val_loss_d_lambda = total_d_val_loss_d_lambda.cuda()
+        total_d_val_loss_d_lambda = policy.zeros(get_hyper_train().size(0))
 
         num_weights = sum(p.numel() for p in model.parameters())
-        d_val_loss_d_theta = torch.zeros(num_weights).cuda()
+        d_val_loss_d_theta = policy.zeros(num_weights)
         model.train()
-        for batch_idx, (x, y) in enumerate(val_loader):
-            model.zero_grad()
-            x, y = prepare_data(x, y)
-            val_loss, _ = batch_loss(x, y, model, val_loss_func)
-            val_loss_grad = grad(val_loss, model.parameters())
-            d_val_loss_d_theta += gather_flat_grad(val_loss_grad)
-            if batch_idx >= args.val_batch_num: break
+        for batch_idx, (x, y) in enumerate(hyper_val_batches.take(args.val_batch_num + 1)):
+            with phase_timer.phase('val_grad'):
+                model.zero_grad()
+                x, y = prepare_data(x, y)
+                val_loss, _ = batch_loss(x, y, model, val_loss_func)
+                val_loss_grad = grad(val_loss, model.parameters())
+                d_val_loss_d_theta += gather_flat_grad(val_loss_grad)
         d_val_loss_d_theta /= (batch_idx + 1)
 
         # get d theta / d lambda
@@ -464,23 +461,27 @@ def experiment(args):
                 flat_pre_conditioner = pre_conditioner  # 2*pre_conditioner - args.lr*hessian_term
             elif args.hessian == 'direct':
                 assert args.dataset == 'MNIST' and args.model == 'mlp' and args.num_layers == 0, "Don't do direct for large problems."
-                hessian = torch.zeros(
-                    num_weights, num_weights).cuda()  # grad(grad(train_loss, model.parameters()), model.parameters())
-                for batch_idx, (x, y) in enumerate(train_loader):
-                    x, y = prepare_data(x, y)
-                    train_loss, _ = batch_loss(x, y, model, train_loss_func)
-                    # TODO (JON): Probably don't recompute - use create_graph and retain_graph?
+                hessian = policy.zeros(
+                    num_weights, num_weights)  # grad(grad(train_loss, model.parameters()), model.parameters())
+                for batch_idx, (x, y) in enumerate(hyper_train_batches.take(args.train_batch_num + 1)):
+                    with phase_timer.phase('train_grad'):
+                        x, y = prepare_data(x, y)
+                        train_loss, _ = batch_loss(x, y, model, train_loss_func)
+                        # TODO (JON): Probably don't recompute - use create_graph and retain_graph?
 
-                    model.zero_grad(), hyper_optimizer.zero_grad()
-                    d_train_loss_d_theta = grad(train_loss, model.parameters(), create_graph=True, retain_graph=True)
-                    flat_d_train_loss_d_theta = gather_flat_grad(d_train_loss_d_theta)
-                    for p_index, p in enumerate(flat_d_train_loss_d_theta):
-                        hessian_term = grad(p, model.parameters(), retain_graph=True)
-                        flat_hessian_term = gather_flat_grad(hessian_term)
-                        hessian[p_index] += flat_hessian_term
-                    if batch_idx >= args.train_batch_num: break
-                hessian /= (batch_idx + 1)
-                inv_hessian = torch.pinverse(hessian)
+                        model.zero_grad(), hyper_optimizer.zero_grad()
+                        d_train_loss_d_theta = grad(train_loss, model.parameters(), create_graph=True,
+                                                    retain_graph=True)
+                        flat_d_train_loss_d_theta = gather_flat_grad(d_train_loss_d_theta)
+                    phase_timer.count_hvps(flat_d_train_loss_d_theta)
+                    with phase_timer.phase('inverse'):
+                        for p_index, p in enumerate(flat_d_train_loss_d_theta):
+                            hessian_term = grad(p, model.parameters(), retain_graph=True)
+                            flat_hessian_term = gather_flat_grad(hessian_term)
+                            hessian[p_index] += flat_hessian_term
+                with phase_timer.phase('inverse'):
+                    hessian /= (batch_idx + 1)
+                    inv_hessian = torch.pinverse(hessian)
                 if args.graph_hessian:
                     def downsample(h, desired_size):
                         downsample_factor = 7850 // desired_size
@@ -499,20 +500,22 @@ def experiment(args):
                 flat_pre_conditioner = pre_conditioner
 
             model.train()  # train()
-            for batch_idx, (x, y) in enumerate(train_loader):
-                x, y = prepare_data(x, y)
-                train_loss, _ = batch_loss(x, y, model, train_loss_func)
-                # TODO (JON): Probably don't recompute - use create_graph and retain_graph?
+            for batch_idx, (x, y) in enumerate(hyper_train_batches.take(args.train_batch_num + 1)):
+                with phase_timer.phase('train_grad'):
+                    x, y = prepare_data(x, y)
+                    train_loss, _ = batch_loss(x, y, model, train_loss_func)
+                    # TODO (JON): Probably don't recompute - use create_graph and retain_graph?
 
-                model.zero_grad(), hyper_optimizer.zero_grad()
-                d_train_loss_d_theta = grad(train_loss, model.parameters(), create_graph=True)
-                flat_d_train_loss_d_theta = gather_flat_grad(d_train_loss_d_theta)
+                    model.zero_grad(), hyper_optimizer.zero_grad()
+                    d_train_loss_d_theta = grad(train_loss, model.parameters(), create_graph=True)
+                    flat_d_train_loss_d_theta = gather_flat_grad(d_train_loss_d_theta)
+                phase_timer.count_hvps(flat_d_train_loss_d_theta)
 
-                model.zero_grad(), hyper_optimizer.zero_grad()
-                flat_d_train_loss_d_theta.backward(flat_pre_conditioner)
-                if get_hyper_train().grad is not None:
-                    total_d_val_loss_d_lambda -= get_hyper_train().grad
-                if batch_idx >= args.train_batch_num: break
+                with phase_timer.phase('mixed_grad'):
+                    model.zero_grad(), hyper_optimizer.zero_grad()
+                    flat_d_train_loss_d_theta.backward(flat_pre_conditioner)
+                    if get_hyper_train().grad is not None:
+                        total_d_val_loss_d_lambda -= get_hyper_train().grad
             total_d_val_loss_d_lambda /= (batch_idx + 1)
         elif args.hessian == 'KFAC':
             # model.zero_grad()
@@ -529,15 +532,17 @@ def experiment(args):
                     kfac_opt.fake_step()
                     if batch_idx >= args.train_batch_num: break
                     # TODO (JON):  Note that this not a normal K-FAC step - certain parts commented out.'''
-            flat_pre_conditioner = torch.zeros(num_weights).cuda()
-            for batch_idx, (x, y) in enumerate(train_loader):
-                model.train()
-                model.zero_grad(), hyper_optimizer.zero_grad()
-                x, y = prepare_data(x, y)
-                train_loss, _ = batch_loss(x, y, model, train_loss_func)
-                # TODO (JON): Probably don't recompute - use create_graph and retain_graph?
-                d_train_loss_d_theta = grad(train_loss, model.parameters(), create_graph=True)
-                flat_d_train_loss_d_theta = gather_flat_grad(d_train_loss_d_theta)
+            flat_pre_conditioner = policy.zeros(num_weights)
+            for batch_idx, (x, y) in enumerate(hyper_train_batches.take(args.train_batch_num + 1)):
+                with phase_timer.phase('train_grad'):
+                    model.train()
+                    model.zero_grad(), hyper_optimizer.zero_grad()
+                    x, y = prepare_data(x, y)
+                    train_loss, _ = batch_loss(x, y, model, train_loss_func)
+                    # TODO (JON): Probably don't recompute - use create_graph and retain_graph?
+                    d_train_loss_d_theta = grad(train_loss, model.parameters(), create_graph=True)
+                    flat_d_train_loss_d_theta = gather_flat_grad(d_train_loss_d_theta)
+                phase_timer.count_hvps(flat_d_train_loss_d_theta)
 
                 current = 0
                 for m in model.modules():
@@ -546,7 +551,7 @@ def experiment(args):
 
                         # print(f'KFAC module: {m}')
                         if m.__class__.__name__ == 'Conv2d':
-                            size0, size1 = m.weight.size(0), m.weight.view(m.weight.size(0), -1).size(1)
+                            size0, size1 = m.weight.size(0), m.weight.reshape(m.weight.size(0), -1).size(1)
                         else:
                             size0, size1 = m.weight.size(0), m.weight.size(1)
                         mod_size1 = size1 + 1 if m.bias is not None else size1
@@ -567,12 +572,11 @@ def experiment(args):
                             if val_batch_idx >= args.val_batch_num: break
                         d_val_loss_d_theta /= (val_batch_idx + 1)'''
 
-                        pre_conditioner = kfac_opt._get_natural_grad(m,
-                                                                     d_val_loss_d_theta[current:current + size].view(
-                                                                         shape),
-                                                                     KFAC_damping)
+                        with phase_timer.phase('inverse'):
+                            pre_conditioner = kfac_opt._get_natural_grad(
+                                m, d_val_loss_d_theta[current:current + size].view(shape), KFAC_damping)
 
-                        flat_pre_conditioner[current: current + size] = gather_flat_grad(pre_conditioner)
+                            flat_pre_conditioner[current: current + size] = gather_flat_grad(pre_conditioner)
 
                         '''model.train()
                         model.zero_grad(), hyper_optimizer.zero_grad()
@@ -587,32 +591,32 @@ def experiment(args):
 
                         total_d_val_loss_d_lambda -= get_hyper_train().grad'''
                         current += size
-                model.zero_grad(), hyper_optimizer.zero_grad()
-                flat_d_train_loss_d_theta.backward(flat_pre_conditioner)
-                total_d_val_loss_d_lambda -= get_hyper_train().grad
-
-                if batch_idx >= args.train_batch_num: break
+                with phase_timer.phase('mixed_grad'):
+                    model.zero_grad(), hyper_optimizer.zero_grad()
+                    flat_d_train_loss_d_theta.backward(flat_pre_conditioner)
+                    total_d_val_loss_d_lambda -= get_hyper_train().grad
             total_d_val_loss_d_lambda /= (batch_idx + 1)
 
-        direct_d_val_loss_d_lambda = torch.zeros(get_hyper_train().size(0))
-        if args.cuda: direct_d_val_loss_d_lambda = direct_d_val_loss_d_lambda.cuda()
+        direct_d_val_loss_d_lambda = policy.zeros(get_hyper_train().size(0))
         model.train()
-        for batch_idx, (x_val, y_val) in enumerate(val_loader):
-            model.zero_grad(), hyper_optimizer.zero_grad()
-            x_val, y_val = prepare_data(x_val, y_val)
-            val_loss, _ = batch_loss(x_val, y_val, model, val_loss_func)
-            val_loss_grad = grad(val_loss, get_hyper_train(), allow_unused=True)
+        for batch_idx, (x_val, y_val) in enumerate(hyper_val_batches.take(args.val_batch_num + 1)):
+            with phase_timer.phase('val_grad'):
+                model.zero_grad(), hyper_optimizer.zero_grad()
+                x_val, y_val = prepare_data(x_val, y_val)
+                val_loss, _ = batch_loss(x_val, y_val, model, val_loss_func)
+                val_loss_grad = grad(val_loss, get_hyper_train(), allow_unused=True)
             if val_loss_grad is not None and val_loss_grad[0] is not None:
                 direct_d_val_loss_d_lambda += gather_flat_grad(val_loss_grad)
             else:
                 break
-            if batch_idx >= args.val_batch_num: break
         direct_d_val_loss_d_lambda /= (batch_idx + 1)
 
         get_hyper_train().grad = direct_d_val_loss_d_lambda + total_d_val_loss_d_lambda
         print("weight={}, update={}".format(get_hyper_train().norm(), get_hyper_train().grad.norm()))
 
-        hyper_optimizer.step()
+        with phase_timer.phase('hyper_opt'):
+            hyper_optimizer.step()
+        phase_timer.end_step()
         model.zero_grad(), hyper_optimizer.zero_grad()
         return get_hyper_train(), get_hyper_train().grad
 
@@ -625,16 +629,15 @@ def experiment(args):
         global model
         model = model.double()
         model.Gaussian.dropout = Variable(model.Gaussian.dropout.double(), requires_grad=True)
-        model.weight_decay = Variable(model.weight_decay.double(), requires_grad=True)
-        if args.cuda: model.weight_decay = model.weight_decay.cuda()
+        model.weight_decay = Variable(policy.to(model.weight_decay.double()), requires_grad=True)
 
         model.eval()
         model.zero_grad()
         train_loss = 0
         for batch_idx, (x, y) in enumerate(train_loader):
             # Load x.
-            x = x.double()
             x, y = prepare_data(x, y)
+            x = x.double()
 
             train_loss += batch_loss(x, y, model, train_loss_func)
 
@@ -644,21 +647,19 @@ def experiment(args):
         grad_vec = gather_flat_grad(train_loss_grad).double()
 
         d_loss_d_l = grad(train_loss, get_hyper_train(), create_graph=True)
-        jacobian = eval_jacobian(gather_flat_grad(d_loss_d_l).double(), model, args.cuda).double()
+        jacobian = eval_jacobian(gather_flat_grad(d_loss_d_l).double(), model, policy).double()
 
-        d_theta_d_lambda = torch.DoubleTensor(np.zeros((jacobian.size(1), jacobian.size(0))))
-        if args.cuda: d_theta_d_lambda = d_theta_d_lambda.cuda()
+        d_theta_d_lambda = policy.to(torch.DoubleTensor(np.zeros((jacobian.size(1), jacobian.size(0)))))
         for i in range(jacobian.size(1)):
-            con_grad, k = conjugate_gradiant(grad_vec, jacobian[:, i].unsqueeze(0).permute(1, 0), model, args.cuda,
+            con_grad, k = conjugate_gradiant(grad_vec, jacobian[:, i].unsqueeze(0).permute(1, 0), model, policy,
                                              None)
             d_theta_d_lambda[i] = con_grad.view(-1)
 
         optimizer.zero_grad()
         val_loss = 0
         for batch_idx, (x, y) in enumerate(val_loader):
-            x = x.double()
-            if args.cuda: x, y = x.cuda(), y.cuda()
-            x, y = Variable(x), Variable(y)
+            x, y = policy.batch(x, y)
+            x, y = Variable(x.double()), Variable(y)
             val_loss += batch_loss(x, y, model, val_loss_func)
 
         val_loss /= len(val_loader)  # batch_idx
@@ -667,16 +668,13 @@ def experiment(args):
 
         d_loss_d_lambda = d_theta_d_lambda @ grad_vec
         hyper_update = args.lrh * d_loss_d_lambda
-        if args.cuda: hyper_update = hyper_update.cuda()
+        hyper_update = policy.to(hyper_update)
         print(f"weight={get_hyper_train().norm()}, update={hyper_update.norm()}")
         hyper = get_hyper_train() - hyper_update
         model = model.float()
         model.Gaussian.dropout = Variable(model.Gaussian.dropout.float(), requires_grad=True)
 
-        if args.cuda:
-            model.weight_decay = Variable(model.weight_decay.float(), requires_grad=True).cuda()
-        else:
-            model.weight_decay = Variable(model.weight_decay.float(), requires_grad=True)
+        model.weight_decay = Variable(policy.to(model.weight_decay.float()), requires_grad=True)
 
         return hyper, hyper_update
 
@@ -686,6 +684,7 @@ def experiment(args):
     global_step = 0
 
     hp_k, update = 0, 0
+    trace_window.start()
     for epoch_h in range(0, args.hepochs + 1):
         print(f"Hyper epoch: {epoch_h}")
         epoch_csv_logger = CSVLogger(fieldnames=['epoch', 'train_loss', 'val_loss', 'val_acc'],
@@ -712,7 +711,7 @@ def experiment(args):
                          'val_loss': str(eval_val_loss), 'val_acc': str(eval_val_corr),
                          'test_loss': str(eval_test_loss), 'test_acc': str(eval_test_corr),
                          'epoch_h': str(epoch_h),
-                         'hp_update': str(update)}
+                         'hp_update': str(update), **phase_timer.row()}
             epoch_h_csv_logger.writerow(epoch_row)
             if args.break_perfect_val and eval_val_corr >= 0.999 and eval_train_corr >= 0.999:
                 break
@@ -744,8 +743,11 @@ def experiment(args):
         #     continue
 
         hp_k, update = KFAC_optimize(epoch_h)
+        trace_window.step()
+        print(phase_timer.summary(f'Hyper epoch {epoch_h} hyper step'))
 
         # print(f"hyper parameter={hp_k}")
+    trace_window.stop()
 
 
 def save_hessian(hessian, name):
@@ -838,6 +840,9 @@ if __name__ == '__main__':
                         help='input batch size for training (default: 64)')
     parser.add_argument('--test_batch_size', type=int, default=250, metavar='N',
                         help='input batch size for testing (default: 1000)')
+    parser.add_argument('--num_prefetch', type=int, default=0, metavar='N',
+                        help='number of batches to load ahead on a background thread (0 disables prefetching); '
+                             'faster input, but the thread shares the global RNG, so seeded runs are not reproducible')
     elementary_epochs = 2
     parser.add_argument('--epochs', type=int, default=elementary_epochs, metavar='N',
                         help='number of epochs to train (default: 10)')
@@ -909,6 +914,9 @@ if __name__ == '__main__':
                         help='image size')  # TODO (JON): Should this be automatically set based on dataset?
     parser.add_argument('--no-cuda', action='store_true', default=False,
                         help='disables CUDA training')
+    add_device_arguments(parser)
+    add_profiling_arguments(parser)
+    add_trace_arguments(parser)
     parser.add_argument('--break-perfect-val', action='store_true', default=False,
                         help='disables CUDA training')
     parser.add_argument('--seed', type=int, default=100, metavar='S',
@@ -0,0 +1,63 @@
+import torch
+from torch import nn
+import torch.nn.functional as F
+
+
+class ParametricAugmentNet(nn.Module):
+    """Augments images with a per-channel affine, a colour jitter and a spatial-transformer style warp.
+
+    Each image draws a noise vector, and one linear layer maps it to the parameters of its transformations, in order:
+        - a scale and shift for every channel,
+        - brightness, contrast and (for RGB images) saturation,
+        - a 2x3 affine warp of the sampling grid.
+    Every parameter is squashed by a tanh and scaled by its maximum magnitude, and a zero output is the identity.
+    The weights of the linear layer are the hyperparameters, (noise_dim + 1) * (2 * channels + 9) of them, which is
+    255 for RGB images with the default noise_dim.  It is called like UNet, so it can stand in as the augment_net.
+    """
+
+    def __init__(self, in_channels=3, noise_dim=16, max_scale=0.5, max_shift=0.5, max_colour=0.5, max_warp=0.25,
+                 init_std=1e-2):
+        """
+        :param in_channels: number of image channels
+        :param noise_dim: size of the per-image noise vector
+        :param max_scale: maximum relative change of the per-channel scale
+        :param max_shift: maximum per-channel shift
+        :param max_colour: maximum brightness shift and relative contrast and saturation change
+        :param max_warp: maximum deviation of the warp from the identity
+        :param init_std: standard deviation of the initial weights, the biases start at zero
+        """
+        super(ParametricAugmentNet, self).__init__()
+        self.in_channels = in_channels
+        self.noise_dim = noise_dim
+        self.num_outputs = 2 * in_channels + 3 + 6
+        self.max_scale, self.max_shift, self.max_colour, self.max_warp = max_scale, max_shift, max_colour, max_warp
+
+        self.params = nn.Linear(noise_dim, self.num_outputs)
+        nn.init.normal_(self.params.weight, std=init_std)
+        nn.init.zeros_(self.params.bias)
+        self.register_buffer('identity_warp', torch.tensor([1., 0., 0., 0., 1., 0.]))
+
+    def forward(self, x, use_zero_noise=False, class_label=None):
+        batch_size, channels = x.shape[0], x.shape[1]
+        noise = torch.randn(batch_size, self.noise_dim, device=x.device, dtype=x.dtype)
+        if use_zero_noise:
+            noise = noise * 0
+        scale, shift, colour, warp = torch.tanh(self.params(noise)).split([channels, channels, 3, 6], dim=1)
+
+        # Per-channel affine
+        x = x * (1 + self.max_scale * scale).view(batch_size, channels, 1, 1) \
+            + (self.max_shift * shift).view(batch_size, channels, 1, 1)
+
+        # Colour: brightness, contrast around the image mean, saturation around the grey image
+        colour = (self.max_colour * colour).view(batch_size, 3, 1, 1, 1).unbind(dim=1)
+        x = x + colour[0]
+        mean = x.mean(dim=(1, 2, 3), keepdim=True)
+        x = mean + (x - mean) * (1 + colour[1])
+        if channels == 3:
+            grey = x.mean(dim=1, keepdim=True)
+            x = grey + (x - grey) * (1 + colour[2])
+
+        # Spatial transformer: resample the image on an affinely warped grid
+        theta = (self.identity_warp + self.max_warp * warp).view(batch_size, 2, 3)
+        grid = F.affine_grid(theta, x.shape, align_corners=False)
+        return F.grid_sample(x, grid, padding_mode='border', align_corners=False)
@@ -3,6 +3,8 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from models.simple_models import weighted_squared_norm
+
 
 def conv3x3(in_planes, out_planes, stride=1):
     return nn.Conv2d(in_planes, out_planes, kernel_size=3, stride=stride, padding=1, bias=False)
@@ -100,13 +102,7 @@ class ResNet(nn.Module):
             return out
 
     def all_L2_loss(self):
-        loss = .0
-        count = 0
-        for p in self.parameters():
-            loss = loss + torch.sum(
-                torch.mul(torch.exp(self.weight_decay[count: count + p.numel()]), torch.flatten(torch.mul(p, p))))
-            count += p.numel()
-        return loss
+        return weighted_squared_norm(self.parameters(), self.weight_decay)
 
 
 def ResNet18(num_classes=10):
@@ -31,7 +31,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.nn.init as init
-from models.simple_models import GaussianDropout
+from models.simple_models import GaussianDropout, squared_norm, weighted_squared_norm
 
 from torch.autograd import Variable
 
@@ -127,19 +127,9 @@ class ResNet(nn.Module):
         self.eval()
 
     def L2_loss(self):
-        loss = 0
-        for p in self.parameters():
-            loss += torch.sum(torch.mul(p, p))
-        return loss * (10 ** self.weight_decay)
+        return squared_norm(self.parameters()) * (10 ** self.weight_decay)
     def all_L2_loss(self):
-        loss = 0
-        count = 0
-        for p in self.parameters():
-            loss += torch.sum(torch.mul(torch.exp(self.weight_decay[count: count + p.numel()]), torch.flatten(torch.mul(p, p))))
-            #val = torch.flatten(p) - self.weight_decay[count: count + p.numel()]
-            #loss += 1e-3 * torch.sum(torch.mul(val, val))
-            count += p.numel()
-        return loss
+        return weighted_squared_norm(self.parameters(), self.weight_decay)
 
 
 def resnet20(dropout=0, num_classes=10):
@@ -5,6 +5,33 @@ import torch.nn as nn
 from torch.autograd import Variable
 import torch.nn.functional as F
 
+
+def squared_norm(params):
+    """
+    Sum of the squares of every entry of params, as one dot product per tensor.
+    :param params: iterable of tensors, e.g. model.parameters()
+    :return: scalar tensor
+    """
+    params = list(params)
+    return torch.stack([torch.dot(p.reshape(-1), p.reshape(-1)) for p in params]).sum()
+
+
+def weighted_squared_norm(params, log_weights):
+    """
+    Sum of exp(log_weights) * p ** 2 over every entry of params.
+
+    exp is taken once over the whole flat vector, which is then split (not sliced) into one view per tensor:
+    slicing it per tensor makes its double backward scatter into a full-size zero tensor for every parameter.
+    :param params: iterable of tensors, e.g. model.parameters()
+    :param log_weights: flat tensor with one entry per parameter entry, in the order of params
+    :return: scalar tensor
+    """
+    params = list(params)
+    weights = torch.exp(log_weights)
+    weights = [w.view_as(p) for w, p in zip(weights.split([p.numel() for p in params]), params)]
+    weighted = torch._foreach_mul(torch._foreach_mul(params, params), weights)
+    return torch.stack([w.sum() for w in weighted]).sum()
+
 class GaussianDropout(nn.Module):
     def __init__(self, dropout):
         super(GaussianDropout, self).__init__()
@@ -19,10 +46,7 @@ class GaussianDropout(nn.Module):
         # N(1, alpha)
         if self.training:
             dropout = F.sigmoid(self.dropout)
-            if x.is_cuda:
-                epsilon = torch.randn(x.size()).cuda() * (dropout / (1 - dropout)) + 1
-            else:
-                epsilon = torch.randn(x.size()) * (dropout / (1 - dropout)) + 1
+            epsilon = torch.randn(x.size(), device=x.device, dtype=x.dtype) * (dropout / (1 - dropout)) + 1
             return x * epsilon
         else:
             '''
@@ -48,9 +72,7 @@ class BernoulliDropout(nn.Module):
         temperature = 0.5
         # N(1, alpha)
         if self.training:
-            u = Variable(torch.rand(x.size()))
-            if x.is_cuda:
-                u = u.cuda()
+            u = Variable(torch.rand(x.size(), device=x.device, dtype=x.dtype))
             z = F.sigmoid(self.dropout) + torch.log(u / (1 - u))
             a = F.sigmoid(z / temperature)
             return x * a
@@ -58,6 +80,32 @@ class BernoulliDropout(nn.Module):
             return x
 
 
+class ExampleWeightTable(nn.Module):
+    def __init__(self, num_examples, init_logit=0.):
+        """
+        Loss weight logits for every example of a dataset, looked up by dataset index.
+        :param num_examples: number of examples in the dataset
+        :param init_logit: initial logit of every example
+        """
+        super(ExampleWeightTable, self).__init__()
+        self.logits = nn.Parameter(torch.full((num_examples,), float(init_logit)))
+
+    def forward(self, index):
+        return self.logits[index]
+
+    def rows(self, index):
+        """
+        Copies the logits of index into a new leaf, so hypergradients w.r.t. them have the size of the batch.
+        """
+        return self.logits.detach()[index].requires_grad_()
+
+    def sparse_grad(self, index, rows_grad):
+        """
+        Scatters the gradient w.r.t. rows(index) into a sparse gradient for the whole table.
+        """
+        return torch.sparse_coo_tensor(index.unsqueeze(0), rows_grad, self.logits.shape, check_invariants=True)
+
+
 class reshape(nn.Module):
     def __init__(self, size):
         super(reshape, self).__init__()
@@ -113,7 +161,7 @@ class SimpleConvNet(nn.Module):
     def forward(self, x):
         out = self.layer1(x)
         out = self.layer2(out)
-        out = out.view(out.size(0), -1)
+        out = out.reshape(out.size(0), -1)
         out = self.fc_dropout(self.fc(out))
         return out
 
@@ -186,26 +234,15 @@ class CNN(nn.Module):
 
     def forward(self, x):
         x = self.features(x)
-        x = x.view(x.size(0), -1)
+        x = x.reshape(x.size(0), -1)
         x = self.classifier(x)
         return x
 
     def L2_loss(self):
-        loss = 0
-        for p in self.parameters():
-            loss += torch.sum(torch.mul(p, p))
-        return loss * (10 ** self.weight_decay)
+        return squared_norm(self.parameters()) * (10 ** self.weight_decay)
 
     def all_L2_loss(self):
-        loss = 0
-        count = 0
-        for p in self.parameters():
-            #val = torch.flatten(p) - self.weight_decay[count: count + p.numel()]
-            loss += torch.sum(
-                torch.mul(torch.exp(self.weight_decay[count: count + p.numel()]), torch.flatten(torch.mul(p, p))))
-            #loss += 1e-3 * torch.sum(torch.mul(val, val))
-            count += p.numel()
-        return loss
+        return weighted_squared_norm(self.parameters(), self.weight_decay)
 
 
 class Net(nn.Module):
@@ -232,9 +269,9 @@ class Net(nn.Module):
     def forward(self, x):
         cur_shape = x.shape
         if not self.do_res:
-            return self.net(x.view(-1, self.imsize))# .reshape(cur_shape)
+            return self.net(x.reshape(-1, self.imsize))# .reshape(cur_shape)
         else:
-            res = self.net(x.view(-1, self.imsize)).reshape(cur_shape)
+            res = self.net(x.reshape(-1, self.imsize)).reshape(cur_shape)
             return x + res
 
     def do_train(self):
@@ -244,16 +281,7 @@ class Net(nn.Module):
         self.net.eval()
 
     def L2_loss(self):
-        loss = .0
-        for p in self.parameters():
-            loss = loss + torch.sum(torch.mul(p, p)) * torch.exp(self.weight_decay)
-        return loss
+        return squared_norm(self.parameters()) * torch.exp(self.weight_decay)
 
     def all_L2_loss(self):
-        loss = .0
-        count = 0
-        for p in self.parameters():
-            loss = loss + torch.sum(
-                torch.mul(torch.exp(self.weight_decay[count: count + p.numel()]), torch.flatten(torch.mul(p, p))))
-            count += p.numel()
-        return loss
+        return weighted_squared_norm(self.parameters(), self.weight_decay)
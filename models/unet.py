@@ -79,7 +79,7 @@ class UNet(nn.Module):
             if do_class_generation:
                 x = x * 0 + class_label.float().reshape(-1, 1, 1, 1)
 
-            noise_channel = torch.randn((x.shape[0], 1, x.shape[2], x.shape[3])).cuda()*0 + torch.randn((x.shape[0], 1, 1, 1)).cuda()
+            noise_channel = torch.randn((x.shape[0], 1, x.shape[2], x.shape[3]), device=x.device, dtype=x.dtype)*0 + torch.randn((x.shape[0], 1, 1, 1), device=x.device, dtype=x.dtype)
             if use_zero_noise:
                 noise_channel = noise_channel * 0
 
@@ -0,0 +1,82 @@
+"""
+Usage: python benchmark_recurrence.py --bptt 70 --batch_size 40 --emsize 650 --nhid 650
+
+What this does:
+    Times the dropconnect LSTM recurrence in eager mode and in TorchScript mode, on the same work a hyper step
+    does: a forward pass, the gradient w.r.t. the weights (with create_graph=True), and the derivative of a
+    gradient-vector product w.r.t. the wdrop hyperparameter.  Reports the time per token for each mode and the
+    speedup of the scripted loop over the eager one.
+"""
+
+import time
+import argparse
+
+import torch
+from torch.autograd import grad
+
+# Local imports
+import rnn_utils
+import model_basic as model
+
+
+parser = argparse.ArgumentParser(description='Benchmark the eager and scripted dropconnect LSTM recurrence')
+parser.add_argument('--bptt', type=int, default=70, help='sequence length')
+parser.add_argument('--batch_size', type=int, default=40, help='batch size')
+parser.add_argument('--emsize', type=int, default=650, help='size of the layer input')
+parser.add_argument('--nhid', type=int, default=650, help='number of hidden units')
+parser.add_argument('--wdrop', type=float, default=0.5, help='dropconnect probability on the recurrent weights')
+parser.add_argument('--iters', type=int, default=5, help='number of timed hyper steps per mode')
+parser.add_argument('--warmup', type=int, default=3, help='number of untimed hyper steps per mode')
+parser.add_argument('--device', type=str, default='cpu')
+parser.add_argument('--seed', type=int, default=1)
+
+
+def hyper_step_time(cell, wdrop, input, hidden, iters, warmup):
+    """Returns the average time of one forward + double backward through the cell."""
+    params = list(cell.parameters())
+
+    def step():
+        cell.h2h.mask_weights(wdrop=wdrop)
+        cell.i2h.mask_weights(wdrop=None)
+        output, _ = cell(input, hidden)
+        loss = output.pow(2).mean()
+        d_loss_d_params = grad(loss, params, create_graph=True)
+        grad_vector_product = sum(g.pow(2).sum() for g in d_loss_d_params)
+        grad(grad_vector_product, wdrop)
+
+    for _ in range(warmup):
+        step()
+
+    if input.is_cuda:
+        torch.cuda.synchronize()
+    start_time = time.time()
+    for _ in range(iters):
+        step()
+    if input.is_cuda:
+        torch.cuda.synchronize()
+    return (time.time() - start_time) / iters
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    torch.manual_seed(args.seed)
+
+    input = torch.randn(args.bptt, args.batch_size, args.emsize, device=args.device)
+    hidden = (torch.zeros(1, args.batch_size, args.nhid, device=args.device),
+              torch.zeros(1, args.batch_size, args.nhid, device=args.device))
+    wdrop = torch.full([1], rnn_utils.logit(args.wdrop), requires_grad=True, device=args.device)
+    num_tokens = args.bptt * args.batch_size
+
+    times = {}
+    for recurrence in ['eager', 'script']:
+        torch.manual_seed(args.seed)
+        cell = model.DropconnectCell(args.emsize, args.nhid, wdrop=wdrop, recurrence=recurrence).to(args.device)
+        if recurrence == 'script' and model.scripted_lstm_recurrence() is None:
+            print('script: could not be compiled, skipping')
+            continue
+        times[recurrence] = hyper_step_time(cell, wdrop, input, hidden, args.iters, args.warmup)
+        print('{}: {:.1f} ms/hyper step | {:.2f} us/token | {:.0f} tokens/s'.format(
+              recurrence, times[recurrence] * 1e3, times[recurrence] * 1e6 / num_tokens, num_tokens / times[recurrence]))
+
+    if 'script' in times:
+        print('script speedup over eager: {:.2f}x'.format(times['eager'] / times['script']))
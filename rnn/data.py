@@ -1,4 +1,5 @@
 import os
+import hashlib
 import torch
 
 from collections import Counter
@@ -20,37 +21,73 @@ class Dictionary(object):
         self.total += 1
         return self.word2idx[word]
 
+    def add_words(self, words):
+        """Adds a list of words and returns their ids; equivalent to calling add_word on each word."""
+        # Only the unseen words need a Python-level loop; dict.fromkeys keeps first-occurrence order
+        for word in dict.fromkeys(words):
+            if word not in self.word2idx:
+                self.idx2word.append(word)
+                self.word2idx[word] = len(self.idx2word) - 1
+        ids = list(map(self.word2idx.__getitem__, words))
+        self.counter.update(ids)
+        self.total += len(ids)
+        return ids
+
+    def counts(self):
+        """Returns a LongTensor with the number of occurrences of each word id."""
+        counts = torch.zeros(len(self.idx2word), dtype=torch.long)
+        for token_id, count in self.counter.items():
+            counts[token_id] = count
+        return counts
+
     def __len__(self):
         return len(self.idx2word)
 
 
 class Corpus(object):
-    def __init__(self, path):
+    def __init__(self, path, use_cache=True):
+        """Loads the train/valid/test splits in path, reusing a cached copy when the files haven't changed.
+
+        The cache is stored as corpus.<hash>.data in the working directory, where the hash is taken over the
+        contents of the three split files.
+        """
         self.dictionary = Dictionary()
-        self.train = self.tokenize(os.path.join(path, 'train.txt'))
-        self.valid = self.tokenize(os.path.join(path, 'valid.txt'))
-        self.test = self.tokenize(os.path.join(path, 'test.txt'))
+        split_paths = [os.path.join(path, split + '.txt') for split in ['train', 'valid', 'test']]
+        cache_fn = 'corpus.{}.data'.format(self.hash_files(split_paths))
+
+        if use_cache and os.path.exists(cache_fn):
+            print('Loading cached dataset...')
+            self.load_state(torch.load(cache_fn))
+        else:
+            print('Producing dataset...')
+            self.train, self.valid, self.test = [self.tokenize(split_path) for split_path in split_paths]
+            if use_cache:
+                torch.save(self.state(), cache_fn)
+
+    @staticmethod
+    def hash_files(paths):
+        md5 = hashlib.md5()
+        for path in paths:
+            assert os.path.exists(path)
+            with open(path, 'rb') as f:
+                md5.update(f.read())
+        return md5.hexdigest()
+
+    def state(self):
+        """Returns the corpus as plain tensors and lists, so the cache doesn't pickle any of these classes."""
+        return {'idx2word': self.dictionary.idx2word, 'counts': self.dictionary.counts(),
+                'train': self.train, 'valid': self.valid, 'test': self.test}
+
+    def load_state(self, state):
+        self.dictionary.idx2word = list(state['idx2word'])
+        self.dictionary.word2idx = {word: idx for idx, word in enumerate(self.dictionary.idx2word)}
+        self.dictionary.counter = Counter(dict(enumerate(state['counts'].tolist())))
+        self.dictionary.total = int(state['counts'].sum())
+        self.train, self.valid, self.test = state['train'], state['valid'], state['test']
 
     def tokenize(self, path):
         """Tokenizes a text file."""
         assert os.path.exists(path)
-        # Add words to the dictionary
-        with open(path, 'r') as f:
-            tokens = 0
-            for line in f:
-                words = line.split() + ['<eos>']
-                tokens += len(words)
-                for word in words:
-                    self.dictionary.add_word(word)
-
-        # Tokenize file content
         with open(path, 'r') as f:
-            ids = torch.LongTensor(tokens)
-            token = 0
-            for line in f:
-                words = line.split() + ['<eos>']
-                for word in words:
-                    ids[token] = self.dictionary.word2idx[word]
-                    token += 1
-
-        return ids
+            words = [word for line in f for word in line.split() + ['<eos>']]
+        return torch.LongTensor(self.dictionary.add_words(words))
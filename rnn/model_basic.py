@@ -2,7 +2,9 @@ import sys
 import ipdb
 
 import math
+import warnings
 import numpy as np
+from typing import List, Tuple
 
 import torch
 import torch.nn as nn
@@ -18,12 +20,21 @@ from embed_regularize import embedded_dropout
 
 
 class RNNModel(nn.Module):
-    """Container module with an encoder, a recurrent module, and a decoder."""
+    """Container module with an encoder, a recurrent module, and a decoder.
+
+    softmax selects the output layer used by nll_loss: 'full' is a softmax over the whole vocabulary, 'adaptive'
+    is the AdaptiveSoftmax below, which shares the decoder weights.  log_prob always gives the normalized
+    distribution over the whole vocabulary, so perplexities computed from it are exact for either choice.
+    """
 
     def __init__(self, rnn_type, ntoken, ninp, nhid, nlayers, dropouto=0., dropouth=0., dropouti=0., dropoute=0., wdrop=0.,
-                 tie_weights=True, wdecay=0.0, wdecay_type='global', dropout_type='standard'):
+                 tie_weights=True, wdecay=0.0, wdecay_type='global', dropout_type='standard', embedding='index',
+                 recurrence='eager', softmax='full', cutoffs=(2000, 4000), token_counts=None, device=None):
         super(RNNModel, self).__init__()
 
+        if device is None:
+            device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
+
         if dropout_type in ['concrete', 'per_param']:
             self.lockdrop = ConcreteDropout()
         elif dropout_type == 'standard':
@@ -33,13 +44,15 @@ class RNNModel(nn.Module):
         # self.encoder = nn.Embedding(ntoken, ninp)
 
         if rnn_type == 'LSTM':
-            self.rnns = [DropconnectCell(ninp if l == 0 else nhid, nhid if l != nlayers - 1 else (ninp if tie_weights else nhid), wdrop=wdrop) for l in range(nlayers)]
+            self.rnns = [DropconnectCell(ninp if l == 0 else nhid, nhid if l != nlayers - 1 else (ninp if tie_weights else nhid), wdrop=wdrop,
+                                         recurrence=recurrence) for l in range(nlayers)]
             # if wdrop:
             #     print("Using weight drop {}".format(wdrop))
 
         print(self.rnns)
         self.rnns = torch.nn.ModuleList(self.rnns)
         self.decoder = nn.Linear(nhid, ntoken)
+        self.adaptive_softmax = AdaptiveSoftmax(ninp if tie_weights else nhid, ntoken, cutoffs, token_counts) if softmax == 'adaptive' else None
 
         # Optionally tie weights
         if tie_weights:
@@ -49,16 +62,16 @@ class RNNModel(nn.Module):
         self.init_weights()
 
         if wdecay_type == 'global':
-            self.weight_decay = torch.tensor([math.log(wdecay)], requires_grad=True, device='cuda:0')
+            self.weight_decay = torch.tensor([math.log(wdecay)], requires_grad=True, device=device)
             # self.weight_decay = torch.tensor([math.log(wdecay)], requires_grad=False, device='cuda:0')
             # self.weight_decay = torch.tensor([0.0], device='cuda:0')
         elif wdecay_type == 'per_layer':
             weights = np.ones(nlayers, dtype='float32') * math.log(wdecay)
-            self.weight_decay = torch.tensor(weights, requires_grad=True, device='cuda:0')
+            self.weight_decay = torch.tensor(weights, requires_grad=True, device=device)
         elif wdecay_type == 'per_param':
             num_p = sum(p.numel() for p in self.parameters())
             weights = np.ones(num_p, dtype='float32') * math.log(wdecay)
-            self.weight_decay = torch.tensor(weights, requires_grad=True, device='cuda:0')
+            self.weight_decay = torch.tensor(weights, requires_grad=True, device=device)
 
         self.rnn_type = rnn_type
         self.ninp = ninp
@@ -72,6 +85,9 @@ class RNNModel(nn.Module):
         self.wdrop = wdrop
         self.tie_weights = tie_weights
         self.wdecay_type = wdecay_type
+        self.embedding = embedding
+        self.recurrence = recurrence
+        self.softmax = softmax
 
     def init_weights(self):
         initrange = 0.1
@@ -79,30 +95,50 @@ class RNNModel(nn.Module):
         self.decoder.bias.data.fill_(0)
         self.decoder.weight.data.uniform_(-initrange, initrange)
 
-    def emb_drop(self, p_logit):
-        if not self.training:
-            return self.encoder.weight
-
+    def emb_mask(self, p_logit):
+        """Samples a concrete dropout mask with one entry per word of the vocabulary."""
         p = torch.sigmoid(p_logit)
 
         eps = 1e-7
         temp = 0.1
-        unif_noise = torch.rand((self.encoder.weight.shape[0]), device='cuda:0')
+        unif_noise = torch.rand((self.encoder.weight.shape[0]), device=self.encoder.weight.device)
 
         drop_prob = (torch.log(p + eps) - torch.log(1 - p + eps) + torch.log(unif_noise + eps) - torch.log(1 - unif_noise + eps))
         drop_prob = torch.sigmoid(drop_prob / temp)
         mask = 1 - drop_prob
         retain_prob = 1 - p
         mask = mask / retain_prob  # (10000)
+        return mask
+
+    def emb_drop(self, p_logit):
+        if not self.training:
+            return self.encoder.weight
 
+        mask = self.emb_mask(p_logit)
         emb_weights = self.encoder.weight * mask.unsqueeze(1)  # mask.unsqueeze(1) gives (10000, 1)
         return emb_weights  # (10000, 650)
 
-    def forward(self, input, hidden, return_h=False):
+    def embed(self, input):
+        """Embeds the (seq_len, batch) token ids with embedding dropout.
+
+        The 'one_hot' path multiplies a dense one-hot encoding with the masked embedding matrix.  The 'index'
+        path gathers the rows of the embedding matrix and of the dropout mask for the tokens in the batch
+        instead, which gives the same values and the same gradients w.r.t. the weights and the dropout logit.
+        """
+        if self.embedding == 'one_hot':
+            dropped_emb_weights = self.emb_drop(self.dropoute)
+            return F.linear(one_hot(input), weight=dropped_emb_weights.t())
+
+        emb = F.embedding(input, self.encoder.weight)
+        if self.training:
+            mask = self.emb_mask(self.dropoute)
+            emb = emb * F.embedding(input, mask.unsqueeze(1))
+        return emb
+
+    def forward(self, input, hidden, return_h=False, decode=True):
 
         # emb = embedded_dropout(self.encoder, input, dropout=self.dropoute if self.training else 0)
-        dropped_emb_weights = self.emb_drop(self.dropoute)
-        emb = F.linear(one_hot(input), weight=dropped_emb_weights.t())  # TODO(PV): Need to manually incorporate dropout here!
+        emb = self.embed(input)
         emb = self.lockdrop(emb, self.dropouti)
 
         raw_output = emb
@@ -126,12 +162,28 @@ class RNNModel(nn.Module):
         output = self.lockdrop(raw_output, self.dropouto)
         outputs.append(output)
 
-        decoded = self.decoder(output.view(output.size(0)*output.size(1), output.size(2)))
-        result = decoded.view(output.size(0), output.size(1), decoded.size(1))
+        # With decode=False the last layer's outputs are returned, for nll_loss and log_prob
+        result = self.decode(output) if decode else output
         if return_h:
             return result, hidden, raw_outputs, outputs
         return result, hidden
 
+    def decode(self, output):
+        decoded = self.decoder(output.view(output.size(0)*output.size(1), output.size(2)))
+        return decoded.view(output.size(0), output.size(1), decoded.size(1))
+
+    def nll_loss(self, output, targets):
+        """Mean negative log-likelihood of the targets given the (seq_len, batch, nhid) outputs of forward(decode=False)."""
+        if self.adaptive_softmax is None:
+            return F.cross_entropy(self.decode(output).view(-1, self.ntoken), targets)
+        return self.adaptive_softmax.nll_loss(output.view(-1, output.size(2)), targets, self.decoder.weight, self.decoder.bias)
+
+    def log_prob(self, output):
+        """Returns (seq_len * batch, ntoken) log-probabilities over the whole vocabulary."""
+        if self.adaptive_softmax is None:
+            return F.log_softmax(self.decode(output).view(-1, self.ntoken), dim=1)
+        return self.adaptive_softmax.log_prob(output.view(-1, output.size(2)), self.decoder.weight, self.decoder.bias)
+
     def init_hidden(self, bsz):
         weight = next(self.parameters()).data
         if self.rnn_type == 'LSTM':
@@ -161,6 +213,84 @@ class RNNModel(nn.Module):
             return loss
 
 
+class AdaptiveSoftmax(nn.Module):
+    """Adaptive softmax (Grave et al., 2017) over the rows of a decoder weight matrix.
+
+    Words are ranked by frequency and split by cutoffs into a shortlist and tail clusters.  The head is a softmax
+    over the shortlist words plus one logit per tail cluster; a word in a tail cluster gets the probability of
+    its cluster times a softmax over the words of that cluster.  Only the targets that fall in a cluster pay for
+    its softmax, so most tokens only need the shortlist rows of the decoder.
+
+    The word logits come from the rows of the decoder weights passed in, so tied embeddings stay tied, and
+    within a cluster the conditional distribution is the same as under the full softmax.  Only the cluster logits
+    are new parameters.
+
+    Hypergradients: this is a different loss from the full softmax, so the hypergradients it gives are not those of
+    the full softmax.  Hyperparameters that act on the layer outputs (dropouto, dropouth, dropouti) are the least
+    affected.  Prefer the full softmax when tuning dropoute, wdrop or wdecay, which act on the (tied) decoder weights
+    and the recurrent weights, and so go through the parts of the loss that the clusters change.
+
+    Arguments:
+    nhid -- size of the outputs that are decoded
+    ntoken -- size of the vocabulary
+    cutoffs -- increasing frequency ranks at which the clusters start
+    token_counts -- (ntoken,) word counts used to rank the words; the word ids are used as ranks if None
+    """
+
+    def __init__(self, nhid, ntoken, cutoffs, token_counts=None):
+        super(AdaptiveSoftmax, self).__init__()
+
+        self.cutoffs = list(cutoffs) + [ntoken]
+        self.ntoken = ntoken
+        self.cluster = nn.Linear(nhid, len(cutoffs))
+
+        if token_counts is None:
+            order = torch.arange(ntoken)
+        else:
+            order = torch.argsort(torch.as_tensor(token_counts), descending=True)
+        rank = torch.empty_like(order)
+        rank[order] = torch.arange(ntoken)
+        self.register_buffer('order', order)  # order[r] is the id of the word with frequency rank r
+        self.register_buffer('rank', rank)  # rank[i] is the frequency rank of word i
+
+    def cluster_logits(self, output, weight, bias, i):
+        """Logits of the words in cluster i (cluster 0 is the shortlist)."""
+        tokens = self.order[(self.cutoffs[i - 1] if i > 0 else 0):self.cutoffs[i]]
+        return F.linear(output, weight[tokens], bias[tokens])
+
+    def head_log_prob(self, output, weight, bias):
+        head_logits = torch.cat([self.cluster_logits(output, weight, bias, 0), self.cluster(output)], dim=1)
+        return F.log_softmax(head_logits, dim=1)
+
+    def nll_loss(self, output, targets, weight, bias):
+        target_rank = self.rank[targets]
+        head_log_prob = self.head_log_prob(output, weight, bias)
+
+        # Shortlist words are scored by their own head entry, tail words by the head entry of their cluster
+        target_cluster = torch.bucketize(target_rank, torch.tensor(self.cutoffs[:-1], device=targets.device), right=True)
+        head_index = torch.where(target_cluster == 0, target_rank, self.cutoffs[0] + target_cluster - 1)
+        nll = -head_log_prob.gather(1, head_index.unsqueeze(1)).squeeze(1)
+
+        for i in range(1, len(self.cutoffs)):
+            in_cluster = (target_cluster == i).nonzero().squeeze(1)
+            if in_cluster.numel() == 0:
+                continue
+            tail_log_prob = F.log_softmax(self.cluster_logits(output[in_cluster], weight, bias, i), dim=1)
+            tail_index = target_rank[in_cluster] - self.cutoffs[i - 1]
+            nll = nll.index_add(0, in_cluster, -tail_log_prob.gather(1, tail_index.unsqueeze(1)).squeeze(1))
+
+        return nll.mean()
+
+    def log_prob(self, output, weight, bias):
+        head_log_prob = self.head_log_prob(output, weight, bias)
+        log_probs = [head_log_prob[:, :self.cutoffs[0]]]
+        for i in range(1, len(self.cutoffs)):
+            cluster_log_prob = head_log_prob[:, self.cutoffs[0] + i - 1].unsqueeze(1)
+            log_probs.append(cluster_log_prob + F.log_softmax(self.cluster_logits(output, weight, bias, i), dim=1))
+        # Columns are in frequency rank order; put them back in word id order
+        return torch.cat(log_probs, dim=1)[:, self.rank]
+
+
 class DropconnectLinear(nn.Module):
     def __init__(self, input_dim, output_dim, wdrop=0):
         super(DropconnectLinear, self).__init__()
@@ -190,7 +320,7 @@ class DropconnectLinear(nn.Module):
 
             eps = 1e-7
             temp = 0.1
-            unif_noise = torch.rand(self.elem_weight_raw.size(), device='cuda:0')
+            unif_noise = torch.rand(self.elem_weight_raw.size(), device=self.elem_weight_raw.device)
 
             drop_prob = (torch.log(p + eps) - torch.log(1 - p + eps) + torch.log(unif_noise + eps) - torch.log(1 - unif_noise + eps))
             drop_prob = torch.sigmoid(drop_prob / temp)
@@ -217,52 +347,108 @@ class DropconnectLinear(nn.Module):
         self.elem_bias.data.uniform_(-stdv, stdv)
 
 
+def lstm_recurrence(x_components_all: List[torch.Tensor], h: torch.Tensor, cell: torch.Tensor,
+                    h2h_weight: torch.Tensor, h2h_bias: torch.Tensor, nhid: int) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """Runs the LSTM updates over a sequence, given the input projections for every timestep."""
+    hidden_list = []
+
+    # Loop over the indexes in the sequence --> process each index in parallel across items in the batch
+    for x_components in x_components_all:
+        h_components = F.linear(h, h2h_weight, h2h_bias)
+
+        preactivations = x_components + h_components
+
+        gates_together = torch.sigmoid(preactivations[:, 0:3*nhid])
+        forget_gate = gates_together[:, 0:nhid]
+        input_gate = gates_together[:, nhid:2*nhid]
+        output_gate = gates_together[:, 2*nhid:3*nhid]
+        new_cell = torch.tanh(preactivations[:, 3*nhid:4*nhid])
+
+        cell = forget_gate * cell + input_gate * new_cell
+        h = output_gate * torch.tanh(cell)
+
+        hidden_list.append(h)
+
+    return torch.stack(hidden_list), h, cell
+
+
+_scripted_lstm_recurrence = None
+
+
+def scripted_lstm_recurrence():
+    """Returns lstm_recurrence compiled with TorchScript, or None if it can't be used.
+
+    torch.compile isn't an option here, since its backward doesn't support create_graph and the hyper step
+    differentiates through the gradient.  The scripted function is checked once against the eager one on a
+    small input, including a double backward, and any failure falls back to eager mode with a warning.
+    """
+    global _scripted_lstm_recurrence
+    if _scripted_lstm_recurrence is None:
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')  # torch.jit.script is deprecated in recent versions
+                scripted = torch.jit.script(lstm_recurrence)
+            if not _check_recurrence(scripted):
+                raise RuntimeError('scripted recurrence does not match eager mode')
+            _scripted_lstm_recurrence = scripted
+        except Exception as e:
+            warnings.warn('Could not compile the recurrent loop, falling back to eager mode: {}'.format(e))
+            _scripted_lstm_recurrence = False
+    return _scripted_lstm_recurrence or None
+
+
+def _check_recurrence(recurrence, seq_len=3, batch_size=2, nhid=4):
+    generator = torch.Generator().manual_seed(0)
+    x = torch.randn(seq_len, batch_size, 4*nhid, generator=generator)
+    weight = torch.randn(4*nhid, nhid, generator=generator)
+    bias = torch.randn(4*nhid, generator=generator)
+    h, cell = torch.zeros(batch_size, nhid), torch.zeros(batch_size, nhid)
+
+    def hypergrad(fn):
+        scale = torch.ones(1, requires_grad=True)
+        w = weight.clone().requires_grad_()
+        output, _, _ = fn(list((x * scale).unbind(0)), h, cell, w, bias, nhid)
+        w_grad, = torch.autograd.grad(output.pow(2).sum(), w, create_graph=True)
+        return torch.autograd.grad(w_grad.pow(2).sum(), scale)[0]
+
+    # The profiling executor only optimizes the graph after a couple of runs, so check those runs too
+    expected = hypergrad(lstm_recurrence)
+    return all(torch.allclose(hypergrad(recurrence), expected, rtol=1e-4, atol=1e-6) for _ in range(3))
+
+
 class DropconnectCell(nn.Module):
-    """Cell for dropconnect RNN."""
+    """Cell for dropconnect RNN.
 
-    def __init__(self, ninp, nhid, wdrop=0):
+    recurrence selects how the loop over timesteps is run: 'eager' runs it in Python, 'script' runs a TorchScript
+    version of it (falling back to eager if that can't be compiled).
+    """
+
+    def __init__(self, ninp, nhid, wdrop=0, recurrence='eager'):
         super(DropconnectCell, self).__init__()
 
         self.ninp = ninp
         self.nhid = nhid
         self.wdrop = wdrop
+        self.recurrence = recurrence
 
         self.i2h = DropconnectLinear(ninp, 4*nhid, wdrop=0)
         self.h2h = DropconnectLinear(nhid, 4*nhid, wdrop=wdrop)
 
     def forward(self, input, hidden):
 
-        hidden_list = []
-
-        nhid = self.nhid
-
         h, cell = hidden
+        h = h.squeeze()
+        cell = cell.squeeze()
 
-        # Loop over the indexes in the sequence --> process each index in parallel across items in the batch
-        for i in range(len(input)):
-
-            h = h.squeeze()
-            cell = cell.squeeze()
-
-            x = input[i]
-
-            x_components = self.i2h(x)
-            h_components = self.h2h(h)
-
-            preactivations = x_components + h_components
-
-            gates_together = torch.sigmoid(preactivations[:, 0:3*nhid])
-            forget_gate = gates_together[:, 0:nhid]
-            input_gate = gates_together[:, nhid:2*nhid]
-            output_gate = gates_together[:, 2*nhid:3*nhid]
-            new_cell = torch.tanh(preactivations[:, 3*nhid:4*nhid])
-
-            cell = forget_gate * cell + input_gate * new_cell
-            h = output_gate * torch.tanh(cell)
+        # The input projection doesn't depend on the recurrence, so compute it for all timesteps in one matmul.
+        # unbind (rather than indexing) keeps the backward to a single stack instead of one full-size zero tensor per step
+        x_components_all = self.i2h(input).unbind(0)
 
-            hidden_list.append(h)
+        recurrence = lstm_recurrence
+        if self.recurrence == 'script':
+            recurrence = scripted_lstm_recurrence() or lstm_recurrence
 
-        hidden_stacked = torch.stack(hidden_list)
+        hidden_stacked, h, cell = recurrence(x_components_all, h, cell, self.h2h.elem_weight, self.h2h.elem_bias, self.nhid)
 
         return hidden_stacked, (h.unsqueeze(0), cell.unsqueeze(0))
 
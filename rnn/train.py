@@ -8,7 +8,6 @@ import csv
 import ipdb
 import time
 import math
-import hashlib
 import datetime
 import argparse
 
@@ -37,6 +36,8 @@ from rnn_utils import batchify, get_batch, repackage_hidden
 
 sys.path.insert(0, '..')
 from utils.util import gather_flat_grad
+from utils.device import add_device_arguments, device_policy
+from utils.profiling import PhaseTimer, TraceWindow, add_profiling_arguments, add_trace_arguments
 
 parser = argparse.ArgumentParser(description='PyTorch PennTreeBank RNN/LSTM Language Model')
 parser.add_argument('--data', type=str, default='data/penn/',
@@ -103,6 +104,14 @@ parser.add_argument('--wdecay', type=float, default=1e-9,
                     help='weight decay applied to all weights')
 parser.add_argument('--wdecay_type', type=str, default='global', choices=['global', 'per_layer', 'per_param'],
                     help='Choose the type of weight decay to use (either global or per-parameter)')
+parser.add_argument('--embedding', type=str, default='index', choices=['index', 'one_hot'],
+                    help='Look up embeddings by index, or multiply a dense one-hot encoding with the embedding matrix')
+parser.add_argument('--recurrence', type=str, default='eager', choices=['eager', 'script'],
+                    help='Run the LSTM timestep loop in Python, or as a TorchScript function (falls back to eager if it fails to compile)')
+parser.add_argument('--softmax', type=str, default='full', choices=['full', 'adaptive'],
+                    help='Output layer for the train/val losses; evaluation perplexities always use the full distribution over the vocabulary')
+parser.add_argument('--cutoffs', type=int, nargs='+', default=[2000, 4000],
+                    help='Frequency ranks at which the adaptive softmax clusters start')
 parser.add_argument('--dropout_type', type=str, default='standard', choices=['standard', 'concrete', 'per_param'],
                     help='Choose the type of dropout (standard or concrete)')
 
@@ -128,23 +137,24 @@ parser.add_argument('--test', action='store_true', default=False,
 parser.add_argument('--overwrite', action='store_true', default=False,
                     help="Run the experiment and overwrite a (possibly existing) result file.")
 
+add_device_arguments(parser)
+add_profiling_arguments(parser)
+add_trace_arguments(parser)
 args = parser.parse_args()
 args.tied = True
 
 if args.tune is not None:
     args.tune = args.tune.split(',')
 
-if not args.disable_cuda and torch.cuda.is_available():
-    use_device = torch.device('cuda:{}'.format(args.gpu))
-else:
-    use_device = torch.device('cpu')
+if args.device is None:
+    args.device = 'cuda:{}'.format(args.gpu)
+policy = device_policy(args, double_backward=True)
+use_device = policy.device
 
 # Set the random seed manually for reproducibility.
 if args.seed:
     np.random.seed(args.seed)
-    torch.manual_seed(args.seed)
-    if torch.cuda.is_available():
-        torch.cuda.manual_seed(args.seed)
+    policy.manual_seed(args.seed)
 
 
 # Create hyperparameters and logger
@@ -159,6 +169,7 @@ for hparam_name in args.tune:
         iteration_labels += ['{}_mean'.format(hparam_name), '{}_std'.format(hparam_name)]
     else:
         iteration_labels += [hparam_name]
+iteration_labels += PhaseTimer.fieldnames()
 stats = { 'epoch': epoch_labels, 'iteration': iteration_labels }
 logger = Logger(sys.argv, args, files=files_used, stats=stats)
 # ---------------------------------
@@ -193,17 +204,11 @@ def model_load(fn):
     # global model, criterion, param_optimizer
     global model
     with open(fn, 'rb') as f:
-        model = torch.load(f)
+        # model_save pickles the whole model, which torch.load only unpickles with weights_only=False
+        model = torch.load(f, map_location=use_device, weights_only=False)
         # model, criterion, param_optimizer = torch.load(f)
 
-fn = 'corpus.{}.data'.format(hashlib.md5(args.data.encode()).hexdigest())
-if os.path.exists(fn):
-    print('Loading cached dataset...')
-    corpus = torch.load(fn)
-else:
-    print('Producing dataset...')
-    corpus = data.Corpus(args.data)
-    torch.save(corpus, fn)
+corpus = data.Corpus(args.data)  # Cached on disk, keyed by the contents of the split files
 
 eval_batch_size = 10
 test_batch_size = 1
@@ -227,23 +232,26 @@ if args.dropout_type == 'per_param':
 else:
     num_dropouts = 1
 
-dropouto = torch.full([num_dropouts], rnn_utils.logit(args.dropouto), requires_grad=True, device='cuda:0')
-dropouth = torch.full([num_dropouts], rnn_utils.logit(args.dropouth), requires_grad=True, device='cuda:0')
-dropouti = torch.full([num_dropouts], rnn_utils.logit(args.dropouti), requires_grad=True, device='cuda:0')
+dropouto = torch.full([num_dropouts], rnn_utils.logit(args.dropouto), requires_grad=True, device=use_device)
+dropouth = torch.full([num_dropouts], rnn_utils.logit(args.dropouth), requires_grad=True, device=use_device)
+dropouti = torch.full([num_dropouts], rnn_utils.logit(args.dropouti), requires_grad=True, device=use_device)
 
-dropoute = torch.full([1], rnn_utils.logit(args.dropoute), requires_grad=True, device='cuda:0')
+dropoute = torch.full([1], rnn_utils.logit(args.dropoute), requires_grad=True, device=use_device)
 
 if args.dropout_type == 'per_param':
-    wdrop = torch.full([4*num_dropouts, num_dropouts], rnn_utils.logit(args.wdrop), requires_grad=True, device='cuda:0')
+    wdrop = torch.full([4*num_dropouts, num_dropouts], rnn_utils.logit(args.wdrop), requires_grad=True, device=use_device)
 else:
-    wdrop = torch.full([1], rnn_utils.logit(args.wdrop), requires_grad=True, device='cuda:0')
+    wdrop = torch.full([1], rnn_utils.logit(args.wdrop), requires_grad=True, device=use_device)
 
-alpha = torch.full([1], rnn_utils.inv_softplus(args.alpha), requires_grad=True, device='cuda:0')
-beta = torch.full([1], rnn_utils.inv_softplus(args.beta), requires_grad=True, device='cuda:0')
+alpha = torch.full([1], rnn_utils.inv_softplus(args.alpha), requires_grad=True, device=use_device)
+beta = torch.full([1], rnn_utils.inv_softplus(args.beta), requires_grad=True, device=use_device)
 
 model = model.RNNModel(args.model, ntokens, args.emsize, args.nhid, args.nlayers, dropouto, dropouth, dropouti, dropoute, wdrop,
-                       args.tied, wdecay=args.wdecay, wdecay_type=args.wdecay_type, dropout_type=args.dropout_type)
-model = model.to(use_device)
+                       args.tied, wdecay=args.wdecay, wdecay_type=args.wdecay_type, dropout_type=args.dropout_type,
+                       embedding=args.embedding, recurrence=args.recurrence,
+                       softmax=args.softmax, cutoffs=args.cutoffs, token_counts=corpus.dictionary.counts(),
+                       device=use_device)
+model = policy.module(model)
 criterion = nn.CrossEntropyLoss()
 criterion = criterion.to(use_device)
 
@@ -285,8 +293,8 @@ def evaluate(data_source, batch_size=10):
         hidden = model.init_hidden(batch_size)
         for i in range(0, data_source.size(0) - 1, args.bptt):
             data, targets = get_batch(data_source, i, args)
-            output, hidden = model(data, hidden)
-            total_loss += len(data) * criterion(output.view(-1, ntokens), targets).data
+            output, hidden = model(data, hidden, decode=False)
+            total_loss += len(data) * F.nll_loss(model.log_prob(output), targets).data
             hidden = repackage_hidden(hidden)
 
     model.train()
@@ -315,8 +323,8 @@ def val_loss_func(data_source, val_epoch, val_iter, val_seq_pos):
     data, targets = get_batch(data_source, val_seq_pos, args, seq_len=seq_len)
     val_hidden = repackage_hidden(val_hidden)
 
-    output, val_hidden, rnn_hs, dropped_rnn_hs = model(data, val_hidden, return_h=True)
-    val_loss = criterion(output.view(-1, ntokens), targets)
+    output, val_hidden, rnn_hs, dropped_rnn_hs = model(data, val_hidden, return_h=True, decode=False)
+    val_loss = model.nll_loss(output, targets)
 
     # I DON'T THINK ALPHA AND BETA SHOULD BE USED WHEN COMPUTING THE VALIDATION LOSS!
     # loss = loss + sum(args.alpha * dropped_rnn_h.pow(2).mean() for dropped_rnn_h in dropped_rnn_hs[-1:])
@@ -353,9 +361,9 @@ def train_loss_func(train_epoch, train_iter, train_seq_pos):
     data, targets = get_batch(train_data, train_seq_pos, args, seq_len=seq_len)
     train_hidden = repackage_hidden(train_hidden)
 
-    output, train_hidden, rnn_hs, dropped_rnn_hs = model(data, train_hidden, return_h=True)
+    output, train_hidden, rnn_hs, dropped_rnn_hs = model(data, train_hidden, return_h=True, decode=False)
 
-    xentropy_loss = criterion(output.view(-1, ntokens), targets)
+    xentropy_loss = model.nll_loss(output, targets)
     loss = xentropy_loss
 
     loss = loss + sum(F.softplus(alpha) * dropped_rnn_h.pow(2).mean() for dropped_rnn_h in dropped_rnn_hs[-1:])
@@ -416,35 +424,43 @@ def neumann_hyperstep_preconditioner(d_val_loss_d_theta, d_train_loss_d_w, eleme
     return preconditioner
 
 
-def hyper_step(d_train_loss_d_w):
+def hyper_step(d_train_loss_d_w, timer):
     """Estimate the hypergradient, and take an update with it.
+
+    Arguments:
+        d_train_loss_d_w: the gradients of the training loss, built with create_graph=True
+        timer: the PhaseTimer recording the phases of the step
     """
     global val_epoch, val_iter, val_seq_pos
 
     zero_hypergrad(get_hyper_train)
     d_train_loss_d_w = gather_flat_grad(d_train_loss_d_w)
+    timer.count_hvps(d_train_loss_d_w)
 
     # Compute gradients of the validation loss w.r.t. the weights/hypers
     num_weights, num_hypers = sum(p.numel() for p in model.parameters()), sum(p.numel() for p in get_hyper_train())
-    d_val_loss_d_theta = torch.zeros(num_weights).cuda()
+    d_val_loss_d_theta = policy.zeros(num_weights)
     # model.train()
     model.eval()
     model.zero_grad()
 
-    val_loss, val_epoch, val_iter, val_seq_pos = val_loss_func(hyperval_data, val_epoch, val_iter, val_seq_pos)  # eval() is used in here
-    d_val_loss_d_theta += gather_flat_grad(grad(val_loss, model.parameters()))  # Do we need create_graph=True or retain_graph=True ?
+    with timer.phase('val_grad'):
+        val_loss, val_epoch, val_iter, val_seq_pos = val_loss_func(hyperval_data, val_epoch, val_iter, val_seq_pos)  # eval() is used in here
+        d_val_loss_d_theta += gather_flat_grad(grad(val_loss, model.parameters()))  # Do we need create_graph=True or retain_graph=True ?
 
     # Initialize the preconditioner and counter
-    preconditioner = neumann_hyperstep_preconditioner(d_val_loss_d_theta, d_train_loss_d_w,
-                                                      args.lr, args.num_neumann_terms)
+    with timer.phase('inverse'):
+        preconditioner = neumann_hyperstep_preconditioner(d_val_loss_d_theta, d_train_loss_d_w,
+                                                          args.lr, args.num_neumann_terms)
 
     # compute d / d lambda (partial Lv / partial w * partial Lt / partial w)
     # = (partial Lv / partial w * partial^2 Lt / (partial w partial lambda))
-    indirect_grad = gather_flat_grad(grad(d_train_loss_d_w, get_hyper_train(), grad_outputs=preconditioner.view(-1)))
-    # indirect_grad = gather_flat_grad(grad(d_train_loss_d_w, get_hyper_train(), grad_outputs=d_val_loss_d_theta.detach().view(-1)))
-    hypergrad = indirect_grad
+    with timer.phase('mixed_grad'):
+        indirect_grad = gather_flat_grad(grad(d_train_loss_d_w, get_hyper_train(), grad_outputs=preconditioner.view(-1)))
+        # indirect_grad = gather_flat_grad(grad(d_train_loss_d_w, get_hyper_train(), grad_outputs=d_val_loss_d_theta.detach().view(-1)))
+        hypergrad = indirect_grad
 
-    store_hypergrad(get_hyper_train, -hypergrad)
+        store_hypergrad(get_hyper_train, -hypergrad)
     # get_hyper_train()[0].grad = -hypergrad
     return val_loss, hypergrad.norm()
 
@@ -525,6 +541,7 @@ def main():
     best_val_loss = []
     stored_loss = 1e8
     start_time = time.time()
+    trace_window = TraceWindow(args, os.path.join(logger.log_dir, 'traces'), policy)
 
     # At any point you can hit Ctrl + C to break out of training early.
     try:
@@ -545,6 +562,8 @@ def main():
         total_loss = 0
 
         epoch_start_time = time.time()
+        phase_timer = PhaseTimer(policy, args.profile_memory, args.sync_phase_timing)
+        trace_window.start()
 
         while train_epoch < args.epochs and patience_elapsed < args.patience:
 
@@ -558,14 +577,17 @@ def main():
                     p.grad = p.grad * 0  # Explicitly zeroing the gradients -- why is this required? Why not model.zero_grad() ?
                 current_index += p_num_params
             param_optimizer.zero_grad()
-            train_grad = grad(regularized_loss, model.parameters(), create_graph=True)
+            with phase_timer.phase('train_grad'):
+                train_grad = grad(regularized_loss, model.parameters(), create_graph=True)
 
-            if args.clip:
-                train_grad, total_grad_norm = clip_grad_norm(train_grad, args.clip)
+                if args.clip:
+                    train_grad, total_grad_norm = clip_grad_norm(train_grad, args.clip)
 
-            val_loss, grad_norm = hyper_step(train_grad)
-            if train_epoch >= args.warmup_epochs:
-                hyper_optimizer.step()
+            val_loss, grad_norm = hyper_step(train_grad, phase_timer)
+            with phase_timer.phase('hyper_opt'):
+                if train_epoch >= args.warmup_epochs:
+                    hyper_optimizer.step()
+            phase_timer.end_step()
 
             # Replace the original gradient for the elementary optimizer step.
             current_index = 0
@@ -585,8 +607,9 @@ def main():
             hparam_dict = make_hparam_dict()
             iteration_dict = { 'iteration': global_step, 'time': time.time() - start_time, 'train_loss': cur_loss.item(),
                                'val_loss': val_loss.item(), 'train_ppl': math.exp(cur_loss.item()), 'val_ppl': math.exp(val_loss.item()),
-                               **hparam_dict }
+                               **hparam_dict, **phase_timer.row() }
             logger.write('iteration', iteration_dict)
+            trace_window.step()
 
             hparam_string = ' | '.join(['{}: {}'.format(key, value) for (key, value) in hparam_dict.items()])
 
@@ -624,6 +647,7 @@ def main():
                         train_epoch, (time.time() - epoch_start_time), param_optimizer.param_groups[0]['lr'],
                         mean_epoch_train_loss, math.exp(mean_epoch_train_loss), val_loss, math.exp(val_loss),
                         test_loss, math.exp(test_loss)))
+                print(phase_timer.summary('Epoch {} hyper steps'.format(old_train_epoch)))
                 print('-' * 89)
                 sys.stdout.flush()
 
@@ -670,6 +694,7 @@ def main():
         print('-' * 89)
         print('Exiting from training early')
         sys.stdout.flush()
+    trace_window.stop()
 
 
     # Load the best saved model.
@@ -8,7 +8,6 @@ import csv
 import ipdb
 import time
 import math
-import hashlib
 import datetime
 import argparse
 
@@ -23,6 +22,7 @@ import numpy as np
 import torch
 import torch.nn as nn
 import torch.optim as optim
+import torch.nn.functional as F
 from torch.autograd import grad
 
 # Local imports
@@ -35,6 +35,7 @@ from rnn_utils import batchify, get_batch, repackage_hidden
 
 sys.path.insert(0, '..')
 from utils.util import gather_flat_grad
+from utils.device import add_device_arguments, device_policy
 
 parser = argparse.ArgumentParser(description='PyTorch PennTreeBank RNN/LSTM Language Model')
 parser.add_argument('--data', type=str, default='data/penn/',
@@ -98,6 +99,14 @@ parser.add_argument('--wdecay', type=float, default=0.,
                     help='weight decay applied to all weights')
 parser.add_argument('--wdecay_type', type=str, default='global', choices=['global', 'per_layer', 'per_param'],
                     help='Choose the type of weight decay to use (either global, per_layer, or per_param)')
+parser.add_argument('--embedding', type=str, default='index', choices=['index', 'one_hot'],
+                    help='Look up embeddings by index, or multiply a dense one-hot encoding with the embedding matrix')
+parser.add_argument('--recurrence', type=str, default='eager', choices=['eager', 'script'],
+                    help='Run the LSTM timestep loop in Python, or as a TorchScript function (falls back to eager if it fails to compile)')
+parser.add_argument('--softmax', type=str, default='full', choices=['full', 'adaptive'],
+                    help='Output layer for the train/val losses; evaluation perplexities always use the full distribution over the vocabulary')
+parser.add_argument('--cutoffs', type=int, nargs='+', default=[2000, 4000],
+                    help='Frequency ranks at which the adaptive softmax clusters start')
 
 parser.add_argument('--nonmono', type=int, default=5,
                     help='Number of epochs for nonmonotonic lr decay')
@@ -127,23 +136,22 @@ parser.add_argument('--test', action='store_true', default=False,
 parser.add_argument('--overwrite', action='store_true', default=False,
                     help="Run the experiment and overwrite a (possibly existing) result file.")
 
+add_device_arguments(parser)
 args = parser.parse_args()
 args.tied = True
 
 if args.tune is not None:
     args.tune = args.tune.split(',')
 
-if not args.disable_cuda and torch.cuda.is_available():
-    use_device = torch.device('cuda:{}'.format(args.gpu))
-else:
-    use_device = torch.device('cpu')
+if args.device is None:
+    args.device = 'cuda:{}'.format(args.gpu)
+policy = device_policy(args, double_backward=True)
+use_device = policy.device
 
 # Set the random seed manually for reproducibility.
 if args.seed:
     np.random.seed(args.seed)
-    torch.manual_seed(args.seed)
-    if torch.cuda.is_available():
-        torch.cuda.manual_seed(args.seed)
+    policy.manual_seed(args.seed)
 
 
 # Create hyperparameters and logger
@@ -190,14 +198,7 @@ def model_load(fn):
     with open(fn, 'rb') as f:
         model, criterion, param_optimizer = torch.load(f)
 
-fn = 'corpus.{}.data'.format(hashlib.md5(args.data.encode()).hexdigest())
-if os.path.exists(fn):
-    print('Loading cached dataset...')
-    corpus = torch.load(fn)
-else:
-    print('Producing dataset...')
-    corpus = data.Corpus(args.data)
-    torch.save(corpus, fn)
+corpus = data.Corpus(args.data)  # Cached on disk, keyed by the contents of the split files
 
 eval_batch_size = 10
 test_batch_size = 1
@@ -217,15 +218,17 @@ if args.small_data:
 
 # Initialize tunable hyperparameters
 # ----------------------------------
-dropouto = torch.full([1], rnn_utils.logit(args.dropouto), requires_grad=True, device='cuda:0')
-dropouth = torch.full([1], rnn_utils.logit(args.dropouth), requires_grad=True, device='cuda:0')
-dropouti = torch.full([1], rnn_utils.logit(args.dropouti), requires_grad=True, device='cuda:0')
+dropouto = torch.full([1], rnn_utils.logit(args.dropouto), requires_grad=True, device=use_device)
+dropouth = torch.full([1], rnn_utils.logit(args.dropouth), requires_grad=True, device=use_device)
+dropouti = torch.full([1], rnn_utils.logit(args.dropouti), requires_grad=True, device=use_device)
 
-dropoute = torch.full([1], rnn_utils.logit(args.dropoute), requires_grad=True, device='cuda:0')
+dropoute = torch.full([1], rnn_utils.logit(args.dropoute), requires_grad=True, device=use_device)
 
 model = model.RNNModel(args.model, ntokens, args.emsize, args.nhid, args.nlayers, dropouto, dropouth, dropouti, dropoute, args.wdrop,
-                       args.tied, wdecay=args.wdecay, wdecay_type=args.wdecay_type)
-model = model.to(use_device)
+                       args.tied, wdecay=args.wdecay, wdecay_type=args.wdecay_type, embedding=args.embedding, recurrence=args.recurrence,
+                       softmax=args.softmax, cutoffs=args.cutoffs, token_counts=corpus.dictionary.counts(),
+                       device=use_device)
+model = policy.module(model)
 criterion = nn.CrossEntropyLoss()
 criterion = criterion.to(use_device)
 
@@ -259,8 +262,8 @@ def evaluate(data_source, batch_size=10):
         hidden = model.init_hidden(batch_size)
         for i in range(0, data_source.size(0) - 1, args.bptt):
             data, targets = get_batch(data_source, i, args)
-            output, hidden = model(data, hidden)
-            total_loss += len(data) * criterion(output.view(-1, ntokens), targets).data
+            output, hidden = model(data, hidden, decode=False)
+            total_loss += len(data) * F.nll_loss(model.log_prob(output), targets).data
             hidden = repackage_hidden(hidden)
 
     model.train()
@@ -281,8 +284,8 @@ def val_loss_func(data_source):
     data, targets = get_batch(data_source, 0, args, seq_len=seq_len)
     val_hidden = repackage_hidden(val_hidden)
 
-    output, val_hidden, rnn_hs, dropped_rnn_hs = model(data, val_hidden, return_h=True)
-    val_loss = criterion(output.view(-1, ntokens), targets)
+    output, val_hidden, rnn_hs, dropped_rnn_hs = model(data, val_hidden, return_h=True, decode=False)
+    val_loss = model.nll_loss(output, targets)
 
     return val_loss
 
@@ -295,8 +298,8 @@ def train_loss_func():
     # Turn on training mode which enables dropout.
     model.train()
     data, targets = get_batch(train_data, 0, args, seq_len=seq_len)
-    output, train_hidden, rnn_hs, dropped_rnn_hs = model(data, train_hidden, return_h=True)
-    xentropy_loss = criterion(output.view(-1, ntokens), targets)
+    output, train_hidden, rnn_hs, dropped_rnn_hs = model(data, train_hidden, return_h=True, decode=False)
+    xentropy_loss = model.nll_loss(output, targets)
     loss = xentropy_loss
 
     if args.wdecay_type in ['global', 'per_layer', 'per_param']:
@@ -350,7 +353,7 @@ def hyper_step(train_grad):
 
     # Compute gradients of the validation loss w.r.t. the weights/hypers
     num_weights, num_hypers = sum(p.numel() for p in model.parameters()), sum(p.numel() for p in get_hyper_train())
-    d_val_loss_d_theta = torch.zeros(num_weights).cuda()
+    d_val_loss_d_theta = policy.zeros(num_weights)
     # model.eval()
     model.zero_grad()
 
@@ -0,0 +1,88 @@
+"""Times the forward and backward pass of every HyperConv2d/HyperLinear layer of the STN AlexNet, with and
+without the fused forward, and checks that both give the same outputs and gradients.
+
+Usage: python benchmark_hyperlayers.py --batch_size 128 --iters 10
+"""
+import argparse
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, 'hypermodels')
+from hypermodels.hyperconv2d import HyperConv2d
+from hypermodels.hyperlinear import HyperLinear
+
+
+parser = argparse.ArgumentParser(description='HyperConv2d/HyperLinear microbenchmark')
+parser.add_argument('--batch_size', '-bsz', type=int, default=128, help='input batch size')
+parser.add_argument('--num_hparams', type=int, default=8, help='size of the hypernet input')
+parser.add_argument('--iters', type=int, default=10, help='number of timed iterations per layer and mode')
+parser.add_argument('--warmup', type=int, default=2, help='number of untimed iterations per layer and mode')
+parser.add_argument('--no_cuda', action='store_true', default=False, help='run on the CPU even if CUDA is available')
+parser.add_argument('--seed', type=int, default=0, help='random seed')
+
+# (name, layer constructor, input size without the batch dimension), following hypermodels/alexnet.py on 32x32 inputs
+filters = [3, 86, 260, 518, 346, 346]
+strides = [2, 1, 1, 1, 1]
+input_sizes = [32, 8, 4, 4, 4]
+layer_specs = [('conv{}'.format(i), lambda num_hparams, fused, i=i: HyperConv2d(filters[i], filters[i+1], stride=strides[i],
+                kernel_size=3, padding=1, num_hparams=num_hparams, fused=fused), (filters[i], input_sizes[i], input_sizes[i]))
+               for i in range(5)]
+layer_specs += [('fc1', lambda num_hparams, fused: HyperLinear(filters[-1]*2*2, 4096, num_hparams, fused=fused), (filters[-1]*2*2,)),
+                ('fc2', lambda num_hparams, fused: HyperLinear(4096, 4096, num_hparams, fused=fused), (4096,)),
+                ('fc3', lambda num_hparams, fused: HyperLinear(4096, 10, num_hparams, fused=fused), (4096,))]
+
+
+def time_layer(layer, input, htensor, iters, warmup, device):
+    def step():
+        output = layer(input, htensor)
+        output.sum().backward()
+
+    for _ in range(warmup):
+        step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start_time = time.time()
+    for _ in range(iters):
+        step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.time() - start_time) / iters
+
+
+def max_difference(layer, fused_layer, input, htensor):
+    outputs, grads = [], []
+    for l in [layer, fused_layer]:
+        l.zero_grad()
+        output = l(input, htensor)
+        output.sum().backward()
+        outputs.append(output.detach())
+        grads.append([p.grad.clone() for p in l.parameters()])
+    output_diff = (outputs[0] - outputs[1]).abs().max().item()
+    grad_diff = max((g0 - g1).abs().max().item() for g0, g1 in zip(*grads))
+    return output_diff, grad_diff
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    device = torch.device('cuda' if torch.cuda.is_available() and not args.no_cuda else 'cpu')
+    torch.manual_seed(args.seed)
+
+    htensor = torch.rand(args.batch_size, args.num_hparams, device=device)
+    total_unfused, total_fused = 0., 0.
+    print('{:6s} {:>12s} {:>12s} {:>8s} {:>12s} {:>12s}'.format('layer', 'unfused ms', 'fused ms', 'speedup', 'max out diff', 'max grad diff'))
+    for name, make_layer, input_size in layer_specs:
+        layer = make_layer(args.num_hparams, False).to(device)
+        fused_layer = make_layer(args.num_hparams, True).to(device)
+        fused_layer.load_state_dict(layer.state_dict())
+        input = torch.randn(args.batch_size, *input_size, device=device)
+
+        output_diff, grad_diff = max_difference(layer, fused_layer, input, htensor)
+        unfused_time = time_layer(layer, input, htensor, args.iters, args.warmup, device)
+        fused_time = time_layer(fused_layer, input, htensor, args.iters, args.warmup, device)
+        total_unfused += unfused_time
+        total_fused += fused_time
+        print('{:6s} {:12.2f} {:12.2f} {:7.2f}x {:12.2e} {:12.2e}'.format(
+            name, unfused_time * 1e3, fused_time * 1e3, unfused_time / fused_time, output_diff, grad_diff))
+    print('{:6s} {:12.2f} {:12.2f} {:7.2f}x'.format('total', total_unfused * 1e3, total_fused * 1e3, total_unfused / total_fused))
@@ -9,12 +9,16 @@ from torch.utils.data import DataLoader
 from torchvision import datasets, transforms
 
 from util.cutout import Cutout
-from cifar import CustomCIFAR10
 
 
-def create_loaders(args, hyper=False, root_dir='data/'):
-    normalize = transforms.Normalize(mean=[x / 255.0 for x in [125.3, 123.0, 113.9]],
-                                     std=[x / 255.0 for x in [63.0, 62.1, 66.7]])
+CIFAR_MEAN = [x / 255.0 for x in [125.3, 123.0, 113.9]]
+CIFAR_STD = [x / 255.0 for x in [63.0, 62.1, 66.7]]
+
+
+def create_loaders(args, hyper=False, root_dir='data/', pin_memory=False):
+    """When hyper is True the jitters and cutout are left out of the pipeline, since hypertrain.py applies
+    them batch-wise with per-example hyperparameters (see util.augment.augment_batch)."""
+    normalize = transforms.Normalize(mean=CIFAR_MEAN, std=CIFAR_STD)
 
     train_transform = transforms.Compose([])
 
@@ -31,38 +35,21 @@ def create_loaders(args, hyper=False, root_dir='data/'):
 
     test_transform = transforms.Compose([transforms.ToTensor(), normalize])
 
-    if hyper:
-        # Train set
-        trainset = CustomCIFAR10(root=root_dir, train=True, download=True, transform=train_transform)
-        num_train = int(np.floor((1-args.percent_valid) * len(trainset)))
-
-        trainset.train_data = trainset.train_data[:num_train, :, :, :]
-        trainset.train_labels = trainset.train_labels[:num_train]
-        
-        # Validation set
-        valset = CustomCIFAR10(root=root_dir, train=True, download=True, transform=train_transform)
-        valset.train_data = valset.train_data[num_train:, :, :, :]
-        valset.train_labels = valset.train_labels[num_train:]
-        
-        # Test set
-        testset = CustomCIFAR10(root=root_dir, train=False, download=True, transform=test_transform)
-
-    else:
-        # Train set
-        trainset = datasets.CIFAR10(root=root_dir, train=True, download=True, transform=train_transform)
-        num_train = int(np.floor((1-args.percent_valid) * len(trainset)))
-
-        trainset.train_data = trainset.train_data[:num_train, :, :, :]
-        trainset.train_labels = trainset.train_labels[:num_train]
-        # Validation set
-        valset = datasets.CIFAR10(root=root_dir, train=True, download=True, transform=train_transform)
-        valset.train_data = valset.train_data[num_train:, :, :, :]
-        valset.train_labels = valset.train_labels[num_train:]
-        # Test set
-        testset = datasets.CIFAR10(root=root_dir, train=False, download=True, transform=test_transform)
-
-    train_loader = DataLoader(dataset=trainset, batch_size=args.batch_size, shuffle=True, pin_memory=False)
-    valid_loader = DataLoader(dataset=valset, batch_size=args.batch_size, shuffle=True, pin_memory=False)
-    test_loader = DataLoader(dataset=testset, batch_size=args.batch_size, pin_memory=False)
+    # Train set
+    trainset = datasets.CIFAR10(root=root_dir, train=True, download=True, transform=train_transform)
+    num_train = int(np.floor((1-args.percent_valid) * len(trainset)))
+
+    trainset.train_data = trainset.train_data[:num_train, :, :, :]
+    trainset.train_labels = trainset.train_labels[:num_train]
+    # Validation set
+    valset = datasets.CIFAR10(root=root_dir, train=True, download=True, transform=train_transform)
+    valset.train_data = valset.train_data[num_train:, :, :, :]
+    valset.train_labels = valset.train_labels[num_train:]
+    # Test set
+    testset = datasets.CIFAR10(root=root_dir, train=False, download=True, transform=test_transform)
+
+    train_loader = DataLoader(dataset=trainset, batch_size=args.batch_size, shuffle=True, pin_memory=pin_memory)
+    valid_loader = DataLoader(dataset=valset, batch_size=args.batch_size, shuffle=True, pin_memory=pin_memory)
+    test_loader = DataLoader(dataset=testset, batch_size=args.batch_size, pin_memory=pin_memory)
 
     return train_loader, valid_loader, test_loader
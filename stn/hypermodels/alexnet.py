@@ -18,13 +18,13 @@ class AlexNet(nn.Module):
 
         strides = [2, 1, 1, 1, 1]
         self.convs = nn.ModuleList([HyperConv2d(self.filters[i], self.filters[i+1], 
-            stride=strides[i], kernel_size=3, padding=1, num_hparams=num_hparams)
+            stride=strides[i], kernel_size=3, padding=1, num_hparams=num_hparams, fused=args.fused_hyperlayers)
             for i in range(5)])
 
         self.last_dim = self.filters[-1]*2*2
-        self.fc1 = HyperLinear(self.last_dim, 4096, num_hparams)
-        self.fc2 = HyperLinear(4096, 4096, num_hparams)
-        self.fc3 = HyperLinear(4096, num_classes, num_hparams)
+        self.fc1 = HyperLinear(self.last_dim, 4096, num_hparams, fused=args.fused_hyperlayers)
+        self.fc2 = HyperLinear(4096, 4096, num_hparams, fused=args.fused_hyperlayers)
+        self.fc3 = HyperLinear(4096, num_classes, num_hparams, fused=args.fused_hyperlayers)
 
     def forward(self, x, hnet_tensor, hparam_tensor, hdict):
         for layer, hconv in enumerate(self.convs):
@@ -36,7 +36,7 @@ class AlexNet(nn.Module):
             x = dropout_2d(x, drop_probs, training=self.training) 
 
         # Set-up before running through fully-connected layers.
-        x = x.view(x.size(0), -1)
+        x = x.reshape(x.size(0), -1)
         fc_probs = self.get_fcdrop_probs(hparam_tensor, hdict)
         x = dropout(x, fc_probs[0], training=self.training)    
         x = F.relu(self.fc1(x, hnet_tensor))
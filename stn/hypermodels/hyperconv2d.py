@@ -6,7 +6,7 @@ import math
 class HyperConv2d(nn.Module):
 
     def __init__(self, in_channels, out_channels, kernel_size, padding, num_hparams,
-        stride=1, bias=True):
+        stride=1, bias=True, fused=False):
         super(HyperConv2d, self).__init__()
 
         self.in_channels = in_channels
@@ -15,6 +15,7 @@ class HyperConv2d(nn.Module):
         self.padding = padding
         self.num_hparams = num_hparams
         self.stride = stride
+        self.fused = fused
 
         self.elem_weight = nn.Parameter(torch.Tensor(
             out_channels, in_channels, kernel_size, kernel_size))
@@ -39,6 +40,9 @@ class HyperConv2d(nn.Module):
             input (tensor): size should be (B, C, H, W)
             htensor (tensor): size should be (B, D)
         """
+        if htensor is not None and self.fused:
+            return self.fused_forward(input, htensor)
+
         output = F.conv2d(input, self.elem_weight, self.elem_bias, padding=self.padding, 
             stride=self.stride)
         output *= self.elem_scalar
@@ -56,6 +60,28 @@ class HyperConv2d(nn.Module):
 
         return output
 
+    def fused_forward(self, input, htensor):
+        """Same as forward, but computes the elementary and hypernet outputs with a single convolution
+        over the concatenated output channels."""
+        weight = torch.cat([self.elem_weight, self.hnet_weight], dim=0)
+        both_out = F.conv2d(input, weight, padding=self.padding, stride=self.stride)
+
+        output = both_out[:, :self.out_channels]
+        if self.elem_bias is not None:
+            output = output + self.elem_bias.unsqueeze(1).unsqueeze(1)
+        output = output * self.elem_scalar
+
+        hnet_scalars = self.htensor_to_scalars(htensor)
+        hnet_wscalars = hnet_scalars[:, :self.out_channels].unsqueeze(2).unsqueeze(2)
+        hnet_bscalars = hnet_scalars[:, self.out_channels:]
+
+        hnet_out = both_out[:, self.out_channels:] * hnet_wscalars
+        if self.hnet_bias is not None:
+            hnet_out += (hnet_bscalars * self.hnet_bias).unsqueeze(2).unsqueeze(2)
+        output += hnet_out
+
+        return output
+
     def init_params(self):
         # Initialize elementary parameters.
         n = self.in_channels * self.kernel_size * self.kernel_size
@@ -7,12 +7,13 @@ import torch.nn.functional as F
 
 class HyperLinear(nn.Module):
 
-    def __init__(self, in_features, out_features, num_hparams, bias=True):
+    def __init__(self, in_features, out_features, num_hparams, bias=True, fused=False):
         super(HyperLinear, self).__init__()
 
         self.in_features = in_features
         self.out_features = out_features
         self.num_hparams = num_hparams
+        self.fused = fused
 
         self.elem_weight = nn.Parameter(torch.Tensor(out_features, in_features))
         self.hnet_weight = nn.Parameter(torch.Tensor(out_features, in_features))
@@ -34,6 +35,8 @@ class HyperLinear(nn.Module):
             input (tensor): size should be (B, D)
             htensor (tensor): size should be (B, num_hparams)
         """
+        if htensor is not None and self.fused:
+            return self.fused_forward(input, htensor)
 
         output = F.linear(input, self.elem_weight, self.elem_bias)
         output *= self.elem_scalar
@@ -51,6 +54,29 @@ class HyperLinear(nn.Module):
 
         return output
 
+    def fused_forward(self, input, htensor):
+        """Same as forward, but computes the elementary and hypernet outputs with a single matmul
+        over the concatenated output features."""
+        weight = torch.cat([self.elem_weight, self.hnet_weight], dim=0)
+        both_out = F.linear(input, weight)
+
+        output = both_out[:, :self.out_features]
+        if self.elem_bias is not None:
+            output = output + self.elem_bias
+        output = output * self.elem_scalar
+
+        hnet_scalars = self.htensor_to_scalars(htensor)
+        hnet_wscalars = hnet_scalars[:, :self.out_features]
+        hnet_bscalars = hnet_scalars[:, self.out_features:]
+        hnet_out = hnet_wscalars * both_out[:, self.out_features:]
+
+        if self.hnet_bias is not None:
+            hnet_out += hnet_bscalars * self.hnet_bias
+
+        output += hnet_out
+
+        return output
+
     def init_params(self):
         # Initialize elementary parameters.
         stdv = 1. / math.sqrt(self.in_features) 
@@ -17,7 +17,7 @@ class SmallCNN(nn.Module):
         # Intialize convolutional filters and last fully connected layer. 
         self.convs = nn.ModuleList([
             HyperConv2d(self.filters[i], self.filters[i+1], kernel_size=3, padding=1, 
-                num_hparams=self.num_hparams) for i in range(3)])
+                num_hparams=self.num_hparams, fused=args.fused_hyperlayers) for i in range(3)])
 
         self.last_dim = self.filters[-1]*4*4
         self.fc = nn.Linear(self.last_dim, num_classes)
@@ -30,7 +30,7 @@ class SmallCNN(nn.Module):
             drop_probs = self.get_drop_probs(hparam_tensor, hdict, layer)
             x = dropout_2d(x, drop_probs, training=self.training)
 
-        x = x.view(x.size(0), -1)
+        x = x.reshape(x.size(0), -1)
         x = self.fc(x)
         return x
 
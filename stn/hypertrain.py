@@ -1,6 +1,7 @@
 import os
 import sys
 import csv
+import copy
 import ipdb
 import time
 import argparse
@@ -14,16 +15,20 @@ from torch.optim.lr_scheduler import MultiStepLR
 sys.path.insert(0, 'hypermodels')
 
 from util.dropout import dropout
+from util.augment import augment_batch
 from hypermodels.small import SmallCNN
 from hypermodels.alexnet import AlexNet
-from datasets.cifar import CustomCIFAR10
-from datasets.loaders import create_loaders
-from util.hyperparameter import perturb, hparam_transform, \
-                                hnet_transform, compute_entropy, \
+from datasets.loaders import create_loaders, CIFAR_MEAN, CIFAR_STD
+from util.hyperparameter import HyperparameterTransform, compute_entropy, \
                                 create_hparams, create_hlabels, create_hstats
 
 from logger import Logger
 
+sys.path.insert(0, '..')
+from utils.data_iter import Prefetcher
+from utils.device import add_device_arguments, device_policy
+from utils.profiling import TraceWindow, add_trace_arguments
+
 
 ###############################################################################
 # Arguments
@@ -68,6 +73,7 @@ parser.add_argument('--scale_lr', '-slr', type=float, default=3e-3, help='learni
 parser.add_argument('--momentum', '-mom', type=float, default=0.9, help='amount of momentum on usual parameters')
 parser.add_argument('--train_steps', '-tstep', type=int, default=2, help='number of batches to optimize parameters on training set')
 parser.add_argument('--valid_steps', '-vstep', type=int, default=1, help='number of batches to optimize hyperparameters on validation set')
+parser.add_argument('--hgrad_only', action='store_true', default=False, help='in validation steps, only backpropagate to the hyperparameters (skips the weight gradients)')
 # LR decay hyperparameters
 parser.add_argument('--lr_decay', type=float, default=0.1, help='Factor by which to multiply the learning rate.')
 parser.add_argument('--nonmono', '-nonm', type=int, default=60, help='how many previous epochs to consider for nonmonotonic criterion')
@@ -81,6 +87,8 @@ parser.add_argument('--cutholes_scale', '-chscl', type=float, default=0.5, help=
 # Miscellaneous hyperparameters
 parser.add_argument('--log_interval', type=int, default=50, help='how many steps before logging stats')
 parser.add_argument('--percent_valid', '-pval', type=float, default=0.2, help='percentage of training dataset to be used as a validation set')
+parser.add_argument('--fused_hyperlayers', action='store_true', default=False, help='compute the elementary and hypernet outputs of each hyper layer with a single conv/matmul')
+parser.add_argument('--num_prefetch', type=int, default=0, help='number of batches to load ahead on a background thread (0 disables prefetching); faster input, but the thread shares the global RNG, so seeded runs are not reproducible')
 parser.add_argument('--no_cuda', action='store_true', default=False, help='disables CUDA training')
 parser.add_argument('--save', action='store_true', default=False, help='whether to save current run')
 parser.add_argument('--logdir', default='logs', help='directory of regNet to save to')
@@ -88,196 +96,25 @@ parser.add_argument('--dir', default='hyper-training', help='directory of logdir
 parser.add_argument('--subdir', default='', help='subdirectory of logdir/dir to save in')
 parser.add_argument('--seed', type=int, default=0, help='random seed (default: 1)')
 
-args = parser.parse_args()
-
-args.cuda = not args.no_cuda and torch.cuda.is_available()
-device = torch.device("cuda" if args.cuda else "cpu")
-cudnn.benchmark = True  # Should make training should go faster for large models
-
-torch.manual_seed(args.seed)
-np.random.seed(args.seed)
-if args.cuda:
-    torch.cuda.manual_seed(args.seed)
-
-if args.tune_all:
-    args.tune_dropoutl = args.tune_indropout = args.tune_inscale =\
-        args.tune_jitters = args.tune_cutlength = args.tune_cutholes = True
-    args.tune_fcdropout = (args.model == 'alexnet')
-
-assert any([args.tune_dropout, args.tune_dropoutl,
-            args.tune_hue, args.tune_sat, args.tune_bright, args.tune_contrast,
-            args.tune_jitters, args.tune_indropout, args.tune_cutlength,
-            args.tune_cutholes, args.tune_inscale, args.tune_fcdropout]), \
-            "Must tune something when hypertraining"
-
-
-###############################################################################
-# Data Loading/Processing
-###############################################################################
-train_loader, valid_loader, test_loader = create_loaders(args, hyper=True)
-
-train_iter = iter(train_loader)
-valid_iter = iter(valid_loader)
-###############################################################################
-# Model/Optimizer
-###############################################################################
-num_classes = 10
-cnn_class = {'small': SmallCNN, 'alexnet': AlexNet}[args.model]
-
-htensor, hscale, hdict = create_hparams(args, cnn_class, device)
-
-num_hparams = htensor.size(0)
-
-if args.model == 'small':
-    cnn = SmallCNN(args, num_classes, num_hparams)
-elif args.model == 'alexnet':
-    cnn = AlexNet(args, num_classes, num_hparams)
-
-cnn = cnn.to(device)
-
-total_params = sum(param.numel() for param in cnn.parameters())
-print('Args:', args)
-print('Model total parameters:', total_params)
-
-cnn_optimizer = torch.optim.SGD(cnn.parameters(), lr=args.train_lr, momentum=args.momentum)
-hyper_optimizer = torch.optim.Adam([htensor], lr=args.valid_lr)
-scale_optimizer = torch.optim.Adam([hscale], lr=args.scale_lr)
-
-###############################################################################
-# Saving
-###############################################################################
-hlabels = create_hlabels(hdict, args)
-train_labels = ('global_step', 'train_epoch', 'valid_epoch', 'time', 'loss', 'acc')
-valid_labels = ('global_step', 'train_epoch', 'valid_epoch', 'time', 'loss', 'acc', 'entropy')
-valid_labels += hlabels
-test_labels = ('global_step', 'time', 'loss', 'acc')
-epoch_labels = ['epoch', 'time', 'train_loss', 'train_acc', 'val_loss', 'val_acc', 'lr']
-
-label_dict = { 'train': train_labels, 'valid': valid_labels, 'test': test_labels, 'epoch': epoch_labels }
-logger = Logger(sys.argv, args, label_dict)
-
-
-def model_save(fn):
-    with open(fn, 'wb') as f:
-        torch.save([cnn, htensor, hscale, cnn_optimizer, hyper_optimizer], f)
-
-def model_load(fn):
-    global cnn, nonfil_htensor, fil_htensor, hscale, cnn_optimizer, hyper_optimizer
-    with open(fn, 'rb') as f:
-        cnn, htensor, hscale, cnn_optimizer, hyper_optimizer = torch.load(f)
-
-###############################################################################
-# Evaluation
-###############################################################################
-def evaluate(loader):
-    """Returns the loss and accuracy on the entire validation/test set.
-
-    Arguments:
-    loader -- a DataLoader wrapping around the validation/test set
-    """
-    cnn.eval()    # Change model to 'eval' mode.
-    correct = total = loss = 0.
-    loader.dataset.reset_hparams()
-    with torch.no_grad():
-        for images, labels in loader:
-            images, labels = images.to(device), labels.to(device)
-            hnet_tensor = hnet_transform(htensor.repeat(images.size(0), 1), hdict)
-            hparam_tensor = hparam_transform(htensor.repeat(images.size(0), 1), hdict)
-            pred = cnn(images, hnet_tensor, hparam_tensor, hdict)
-            loss += F.cross_entropy(pred, labels, reduction='sum').item()
-            hard_pred = torch.max(pred, 1)[1]
-            total += labels.size(0)
-            correct += (hard_pred == labels).sum().item()
-
-    accuracy = correct / total
-    mean_loss = loss / total
-    return mean_loss, accuracy
+parser.add_argument('--seeds', type=int, nargs='+', default=None, help='train one STN per seed in this process, sharing the datasets (overrides --seed)')
+add_device_arguments(parser)
+add_trace_arguments(parser)
 
 
-###############################################################################
-# Optimization step
-###############################################################################
-def next_batch(data_iter, data_loader, curr_epoch):
-    """Load next minibatch."""
-    try:
-        images, labels = data_iter.next()
-    except StopIteration:
-        curr_epoch += 1
-        data_iter = iter(data_loader)
-        images, labels = data_iter.next()
-
-    images, labels = images.to(device), labels.to(device)
-    return images, labels, data_iter, curr_epoch
-
-
-def optimization_step(data_iter, data_loader, curr_epoch, hyper=False):
-    cnn_optimizer.zero_grad()
-    hyper_optimizer.zero_grad()
-    scale_optimizer.zero_grad()
-    data_loader.dataset.reset_hparams()
-
-    if not hyper or args.tune_scales:
-        batch_htensor = perturb(htensor, hscale, args.batch_size)
-    else:
-        batch_htensor = htensor.repeat(args.batch_size, 1)
-
-    hparam_tensor = hparam_transform(batch_htensor, hdict)
-
-    if not hyper:
-        data_loader.dataset.set_hparams(hparam_tensor, hdict)
-
-    images, labels, data_iter, curr_epoch = next_batch(data_iter, data_loader, curr_epoch)
-    hparam_tensor = hparam_tensor[:images.size(0)]
-    hnet_tensor = hnet_transform(batch_htensor[:images.size(0)], hdict)
-
-    # Apply input transformations.
-    if args.tune_indropout and not hyper:
-        indrop_idx = hdict['indropout'].index
-        probs = hparam_tensor[:,indrop_idx]
-        images = dropout(images, probs, training=True)
-    if args.tune_inscale and not hyper:
-        inscale_idx = hdict['inscale'].index
-        inscale = hparam_tensor[:,inscale_idx]
-        noise = torch.rand(images.size(0), device=device)
-        scaled_noise = ((1 + inscale) - (1 / (1 + inscale))) * noise + (1/(1 + inscale))
-        images = images * scaled_noise[:,None,None,None]
-
-    pred = cnn(images, hnet_tensor, hparam_tensor, hdict)
-    xentropy_loss = F.cross_entropy(pred, labels)
-    entropy = compute_entropy(hscale)
-    loss = xentropy_loss - args.entropy_weight * entropy
-    loss.backward()
-
-    if not hyper:
-        cnn_optimizer.step()
-    else:
-        hyper_optimizer.step()
-        if args.tune_scales:
-            scale_optimizer.step()
-
-    # Calculate number of correct predictions.
-    _, hard_pred = torch.max(pred, 1)
-    num_correct = (hard_pred == labels).sum().item()
-    num_points = labels.size(0)
-    step_stats = { 'xentropy': xentropy_loss.item(), 'entropy': entropy.item(),
-                   'num_correct': num_correct, 'num_points': num_points }
+def check_args(args):
+    """Fills in the options implied by --tune_all and checks that something is tuned."""
+    if args.tune_all:
+        args.tune_dropoutl = args.tune_indropout = args.tune_inscale =\
+            args.tune_jitters = args.tune_cutlength = args.tune_cutholes = True
+        args.tune_fcdropout = (args.model == 'alexnet')
 
-    return data_iter, curr_epoch, step_stats
+    assert any([args.tune_dropout, args.tune_dropoutl,
+                args.tune_hue, args.tune_sat, args.tune_bright, args.tune_contrast,
+                args.tune_jitters, args.tune_indropout, args.tune_cutlength,
+                args.tune_cutholes, args.tune_inscale, args.tune_fcdropout]), \
+                "Must tune something when hypertraining"
 
 
-###############################################################################
-# Training Loop
-###############################################################################
-# Bookkeeping stuff.
-train_step = valid_step = global_step = wup_step = 0
-train_epoch = valid_epoch = 0
-test_step = 0
-start_time = time.time()
-
-train_stats = { 'xentropy': 0., 'num_correct': 0., 'num_points': 0. }
-valid_stats = { 'xentropy': 0., 'entropy': 0., 'num_correct': 0., 'num_points': 0. }
-epoch_stats = { 'xentropy': 0., 'num_correct': 0., 'num_points': 0. }
-
 def accumulate_stats(running_stats, curr_stats):
     for k in running_stats:
         running_stats[k] += curr_stats[k]
@@ -286,197 +123,444 @@ def clear_stats(running_stats):
     for k in running_stats:
         running_stats[k] = 0.
 
-def summarize_stats(running_stats, hyper=False):
-    time_taken = time.time() - start_time
-    avg_xentropy = running_stats['xentropy'] / args.log_interval
-    avg_accuracy = running_stats['num_correct'] / running_stats['num_points']
 
-    summary_stats = { 'global_step': global_step, 'train_epoch': train_epoch,
-                      'valid_epoch': valid_epoch, 'time': time_taken, 'loss': avg_xentropy,
-                      'acc': avg_accuracy }
+class HyperTrainer():
+    """Trains one STN. All of the state of a run lives on the instance, so several runs (e.g. different seeds
+    or configurations) can be trained one after the other in the same process.
 
-    if not hyper:
-        return summary_stats
-    else:
-        avg_entropy = running_stats['entropy'] / args.log_interval
-        summary_stats['entropy'] = avg_entropy
-        hstats = create_hstats(htensor, hscale, hdict, args)
-        summary_stats.update(hstats)
-        return summary_stats, hstats
+    Arguments:
+    args -- the parsed command line arguments of this run
+    loaders -- optional (train, valid, test) DataLoaders from create_loaders(args, hyper=True), to share the
+               decoded datasets between runs; they are created from args if not given
+    argv -- command line used to name the log directory (defaults to sys.argv)
+    """
 
-# Warmup for specified number of epochs. Do not tune hyperparameters during this time.
-curr_train_epoch = train_epoch
+    def __init__(self, args, loaders=None, argv=None):
+        check_args(args)
+        self.args = args
+
+        self.policy = device_policy(args)
+        if args.model == 'alexnet' and getattr(args, 'channels_last', 'auto') == 'auto':
+            # The hyper-layers of AlexNet are ~13% slower channels-last on the CPU, the small CNN's ~35% faster
+            self.policy.channels_last = False
+        args.cuda = self.policy.is_cuda
+        self.device = self.policy.device
+        cudnn.benchmark = True  # Should make training should go faster for large models
+
+        self.policy.manual_seed(args.seed)
+        np.random.seed(args.seed)
+
+        #######################################################################
+        # Data Loading/Processing
+        #######################################################################
+        if loaders is None:
+            loaders = create_loaders(args, hyper=True, pin_memory=self.policy.pin_memory)
+        train_loader, valid_loader, self.test_loader = loaders
+        self.train_loader = Prefetcher(train_loader, args.num_prefetch)
+        self.valid_loader = Prefetcher(valid_loader, args.num_prefetch)
+
+        self.train_iter = iter(self.train_loader)
+        self.valid_iter = iter(self.valid_loader)
+
+        #######################################################################
+        # Model/Optimizer
+        #######################################################################
+        num_classes = 10
+        cnn_class = {'small': SmallCNN, 'alexnet': AlexNet}[args.model]
+
+        self.htensor, self.hscale, self.hdict = create_hparams(args, cnn_class, self.device)
+        self.htransform = HyperparameterTransform(self.hdict, self.device)
+
+        num_hparams = self.htensor.size(0)
+        self.cnn = self.policy.module(cnn_class(args, num_classes, num_hparams))
+
+        total_params = sum(param.numel() for param in self.cnn.parameters())
+        print('Args:', args)
+        print('Model total parameters:', total_params)
+
+        self.cnn_optimizer = torch.optim.SGD(self.cnn.parameters(), lr=args.train_lr, momentum=args.momentum)
+        self.hyper_optimizer = torch.optim.Adam([self.htensor], lr=args.valid_lr)
+        self.scale_optimizer = torch.optim.Adam([self.hscale], lr=args.scale_lr)
+
+        #######################################################################
+        # Saving
+        #######################################################################
+        hlabels = create_hlabels(self.hdict, args)
+        train_labels = ('global_step', 'train_epoch', 'valid_epoch', 'time', 'loss', 'acc')
+        valid_labels = ('global_step', 'train_epoch', 'valid_epoch', 'time', 'loss', 'acc', 'entropy')
+        valid_labels += hlabels
+        test_labels = ('global_step', 'time', 'loss', 'acc')
+        epoch_labels = ['epoch', 'time', 'train_loss', 'train_acc', 'val_loss', 'val_acc', 'lr']
+
+        label_dict = { 'train': train_labels, 'valid': valid_labels, 'test': test_labels, 'epoch': epoch_labels }
+        self.logger = Logger(sys.argv if argv is None else argv, args, label_dict)
+        self.trace_window = TraceWindow(args, os.path.join(self.logger.logdir, 'traces'), self.policy)
+
+        #######################################################################
+        # Bookkeeping
+        #######################################################################
+        self.train_step = self.valid_step = self.global_step = self.wup_step = 0
+        self.train_epochs = self.valid_epochs = 0
+        self.start_time = self.epoch_start_time = time.time()
+
+        self.train_stats = { 'xentropy': 0., 'num_correct': 0., 'num_points': 0. }
+        self.valid_stats = { 'xentropy': 0., 'entropy': 0., 'num_correct': 0., 'num_points': 0. }
+        self.epoch_stats = { 'xentropy': 0., 'num_correct': 0., 'num_points': 0. }
+
+        self.best_val_loss = []
+        self.stored_loss = float('inf')
+        self.patience_elapsed = 0
+
+    def model_save(self, fn):
+        with open(fn, 'wb') as f:
+            torch.save({'cnn': self.cnn.state_dict(),
+                        'htensor': self.htensor.detach(),
+                        'hscale': self.hscale.detach(),
+                        'cnn_optimizer': self.cnn_optimizer.state_dict(),
+                        'hyper_optimizer': self.hyper_optimizer.state_dict(),
+                        'scale_optimizer': self.scale_optimizer.state_dict()}, f)
+
+    def model_load(self, fn):
+        # Load into the existing model, hparams and optimizers in place, so the optimizers (and the lr scheduler)
+        # stay bound to the tensors that are trained afterwards
+        with open(fn, 'rb') as f:
+            state = torch.load(f, map_location=self.device)
+        self.cnn.load_state_dict(state['cnn'])
+        with torch.no_grad():
+            self.htensor.copy_(state['htensor'])
+            self.hscale.copy_(state['hscale'])
+        self.cnn_optimizer.load_state_dict(state['cnn_optimizer'])
+        self.hyper_optimizer.load_state_dict(state['hyper_optimizer'])
+        self.scale_optimizer.load_state_dict(state['scale_optimizer'])
+
+    ###########################################################################
+    # Evaluation
+    ###########################################################################
+    def evaluate(self, loader):
+        """Returns the loss and accuracy on the entire validation/test set.
+
+        Arguments:
+        loader -- a DataLoader wrapping around the validation/test set
+        """
+        self.cnn.eval()    # Change model to 'eval' mode.
+        correct = total = loss = 0.
+        with torch.no_grad():
+            # The hyperparameters are fixed during evaluation, so transform them once for a full batch
+            # and slice off the rows needed for each (possibly smaller, last) batch.
+            eval_htensor = self.htensor.repeat(loader.batch_size, 1)
+            eval_hnet_tensor = self.htransform.hnet_transform(eval_htensor)
+            eval_hparam_tensor = self.htransform.hparam_transform(eval_htensor)
+            for images, labels in loader:
+                images, labels = self.policy.batch(images, labels)
+                hnet_tensor = eval_hnet_tensor[:images.size(0)]
+                hparam_tensor = eval_hparam_tensor[:images.size(0)]
+                pred = self.cnn(images, hnet_tensor, hparam_tensor, self.hdict)
+                loss += F.cross_entropy(pred, labels, reduction='sum').item()
+                hard_pred = torch.max(pred, 1)[1]
+                total += labels.size(0)
+                correct += (hard_pred == labels).sum().item()
+
+        accuracy = correct / total
+        mean_loss = loss / total
+        return mean_loss, accuracy
+
+    ###########################################################################
+    # Optimization step
+    ###########################################################################
+    def next_batch(self, data_iter, data_loader, curr_epoch):
+        """Load next minibatch."""
+        try:
+            images, labels = next(data_iter)
+        except StopIteration:
+            curr_epoch += 1
+            data_iter = iter(data_loader)
+            images, labels = next(data_iter)
+
+        images, labels = self.policy.batch(images, labels)
+        return images, labels, data_iter, curr_epoch
+
+    def optimization_step(self, data_iter, data_loader, curr_epoch, hyper=False):
+        args, hdict = self.args, self.hdict
+
+        self.cnn_optimizer.zero_grad()
+        self.hyper_optimizer.zero_grad()
+        self.scale_optimizer.zero_grad()
+
+        if not hyper or args.tune_scales:
+            batch_htensor = self.htransform.perturb(self.htensor, self.hscale, args.batch_size)
+        else:
+            batch_htensor = self.htensor.repeat(args.batch_size, 1)
 
-cnn.train()
-while train_epoch < args.warmup_epochs:
-    train_iter, train_epoch, stats = optimization_step(train_iter, train_loader, train_epoch)
-    accumulate_stats(train_stats, stats)
-    accumulate_stats(epoch_stats, stats)
+        hparam_tensor = self.htransform.hparam_transform(batch_htensor)
 
-    if wup_step % args.log_interval == 0 and global_step > 0:
-        summary_stats = summarize_stats(train_stats)
-        print('Global Step: {} Train Epoch: {} \tWarmup step:{} \tLoss: {:.3f} \
-               Accuracy: {:.3f}'.format(global_step, train_epoch, wup_step, 
-                summary_stats['loss'], summary_stats['acc']))
-        logger.write('train', summary_stats)
-        clear_stats(train_stats)
+        images, labels, data_iter, curr_epoch = self.next_batch(data_iter, data_loader, curr_epoch)
+        hparam_tensor = hparam_tensor[:images.size(0)]
+        hnet_tensor = self.htransform.hnet_transform(batch_htensor[:images.size(0)])
 
-    wup_step += 1
-    global_step += 1
+        # Apply input transformations.
+        if not hyper:
+            images = augment_batch(images, hparam_tensor, hdict, CIFAR_MEAN, CIFAR_STD)
+        if args.tune_indropout and not hyper:
+            indrop_idx = hdict['indropout'].index
+            probs = hparam_tensor[:,indrop_idx]
+            images = dropout(images, probs, training=True)
+        if args.tune_inscale and not hyper:
+            inscale_idx = hdict['inscale'].index
+            inscale = hparam_tensor[:,inscale_idx]
+            noise = torch.rand(images.size(0), device=self.device)
+            scaled_noise = ((1 + inscale) - (1 / (1 + inscale))) * noise + (1/(1 + inscale))
+            images = images * scaled_noise[:,None,None,None]
+
+        pred = self.cnn(images, hnet_tensor, hparam_tensor, hdict)
+        xentropy_loss = F.cross_entropy(pred, labels)
+        entropy = compute_entropy(self.hscale)
+        loss = xentropy_loss - args.entropy_weight * entropy
+        if hyper and args.hgrad_only:
+            # Only the hyperparameter optimizers step on the validation set, so the weight gradients
+            # (which are zeroed before the next step) don't need to be computed at all.
+            hyper_tensors = [self.htensor, self.hscale] if args.tune_scales else [self.htensor]
+            for hyper_tensor, hyper_grad in zip(hyper_tensors, torch.autograd.grad(loss, hyper_tensors)):
+                hyper_tensor.grad = hyper_grad
+        else:
+            loss.backward()
+
+        if not hyper:
+            self.cnn_optimizer.step()
+        else:
+            self.hyper_optimizer.step()
+            if args.tune_scales:
+                self.scale_optimizer.step()
+
+        # Calculate number of correct predictions.
+        _, hard_pred = torch.max(pred, 1)
+        num_correct = (hard_pred == labels).sum().item()
+        num_points = labels.size(0)
+        step_stats = { 'xentropy': xentropy_loss.item(), 'entropy': entropy.item(),
+                       'num_correct': num_correct, 'num_points': num_points }
+
+        return data_iter, curr_epoch, step_stats
+
+    ###########################################################################
+    # Training Loop
+    ###########################################################################
+    def summarize_stats(self, running_stats, hyper=False):
+        time_taken = time.time() - self.start_time
+        avg_xentropy = running_stats['xentropy'] / self.args.log_interval
+        avg_accuracy = running_stats['num_correct'] / running_stats['num_points']
+
+        summary_stats = { 'global_step': self.global_step, 'train_epoch': self.train_epochs,
+                          'valid_epoch': self.valid_epochs, 'time': time_taken, 'loss': avg_xentropy,
+                          'acc': avg_accuracy }
+
+        if not hyper:
+            return summary_stats
+        else:
+            avg_entropy = running_stats['entropy'] / self.args.log_interval
+            summary_stats['entropy'] = avg_entropy
+            hstats = create_hstats(self.htensor, self.hscale, self.hdict, self.args)
+            summary_stats.update(hstats)
+            return summary_stats, hstats
 
-    if curr_train_epoch != train_epoch:
-        val_loss, val_acc = evaluate(valid_loader)
+    def end_of_epoch_stats(self, curr_train_epoch):
+        """Evaluates on the validation set and logs the stats of the training epoch that just finished."""
+        val_loss, val_acc = self.evaluate(self.valid_loader)
 
-        mean_train_loss = epoch_stats['xentropy'] / float(len(train_loader))
-        train_acc = epoch_stats['num_correct'] / float(epoch_stats['num_points'])
+        mean_train_loss = self.epoch_stats['xentropy'] / float(len(self.train_loader))
+        train_acc = self.epoch_stats['num_correct'] / float(self.epoch_stats['num_points'])
 
-        elapsed_time = time.time() - start_time
+        elapsed_time = time.time() - self.start_time
+        epoch_time = time.time() - self.epoch_start_time
+        self.epoch_start_time = time.time()
 
         print('=' * 80)
-        print('Train Epoch: {} | Trn Loss: {:.3f} | Trn Acc: {:.3f} | Val Loss: {:.3f} | Val acc: {:.3f}'.format(
-               train_epoch, mean_train_loss, train_acc, val_loss, val_acc))
+        print('Train Epoch: {} | Trn Loss: {:.3f} | Trn Acc: {:.3f} | Val Loss: {:.3f} | Val acc: {:.3f} | Epoch time: {:.1f}s'.format(
+               curr_train_epoch, mean_train_loss, train_acc, val_loss, val_acc, epoch_time))
         print('=' * 80)
 
         epoch_dict = { 'epoch': curr_train_epoch, 'time': elapsed_time,
                        'train_loss': mean_train_loss, 'train_acc': train_acc,
                        'val_loss': val_loss, 'val_acc': val_acc,
-                       'lr': cnn_optimizer.param_groups[0]['lr']}
-        logger.write('epoch', epoch_dict)
+                       'lr': self.cnn_optimizer.param_groups[0]['lr']}
+        self.logger.write('epoch', epoch_dict)
+        return epoch_dict
+
+    def warmup(self):
+        """Warmup for specified number of epochs. Do not tune hyperparameters during this time."""
+        args = self.args
+        curr_train_epoch = self.train_epochs
+
+        self.cnn.train()
+        while self.train_epochs < args.warmup_epochs:
+            with torch.profiler.record_function('elementary_step'):
+                self.train_iter, self.train_epochs, stats = self.optimization_step(
+                    self.train_iter, self.train_loader, self.train_epochs)
+            accumulate_stats(self.train_stats, stats)
+            accumulate_stats(self.epoch_stats, stats)
+
+            if self.wup_step % args.log_interval == 0 and self.global_step > 0:
+                summary_stats = self.summarize_stats(self.train_stats)
+                print('Global Step: {} Train Epoch: {} \tWarmup step:{} \tLoss: {:.3f} \
+                       Accuracy: {:.3f}'.format(self.global_step, self.train_epochs, self.wup_step,
+                        summary_stats['loss'], summary_stats['acc']))
+                self.logger.write('train', summary_stats)
+                clear_stats(self.train_stats)
+
+            self.wup_step += 1
+            self.global_step += 1
+            self.trace_window.step()
+
+            if curr_train_epoch != self.train_epochs:
+                self.end_of_epoch_stats(curr_train_epoch)
+                curr_train_epoch = self.train_epochs
+                clear_stats(self.epoch_stats)
+
+        clear_stats(self.train_stats)
+        clear_stats(self.epoch_stats)
+
+    def train_epoch(self):
+        """Alternates between optimizing on the training set for args.train_steps and on the validation
+        set for args.valid_steps until a pass over the training set is completed. Then evaluates on the
+        validation set, decays the learning rate, and checkpoints the model if it improved.
+
+        Returns the stats of the epoch.
+        """
+        args = self.args
+        changed_epoch = False
+        while not changed_epoch:
+            # Check whether we should use training or validation set.
+            cycle_pos = (self.train_step + self.valid_step) % (args.train_steps + args.valid_steps)
+            hyper = cycle_pos >= args.train_steps
+
+            # Do a step on the training set.
+            if not hyper:
+                self.cnn.train()
+                curr_train_epoch = self.train_epochs
+                with torch.profiler.record_function('elementary_step'):
+                    self.train_iter, self.train_epochs, stats = (
+                        self.optimization_step(self.train_iter, self.train_loader, self.train_epochs))
+                changed_epoch = (curr_train_epoch != self.train_epochs)
+                accumulate_stats(self.train_stats, stats)
+                accumulate_stats(self.epoch_stats, stats)
+
+                if self.train_step % args.log_interval == 0 and self.global_step > 0:
+                    summary_stats = self.summarize_stats(self.train_stats)
+                    print('Global Step: {} Train Epoch: {} \tTrain step:{} \tLoss: {:.3f} Accuracy: {:.3f} lr: {:.4e}'.format(
+                           self.global_step, self.train_epochs, self.train_step, summary_stats['loss'], summary_stats['acc'],
+                           self.cnn_optimizer.param_groups[0]['lr']))
+                    self.logger.write('train', summary_stats)
+                    clear_stats(self.train_stats)
+
+                self.train_step += 1
+
+            # Do a step on the validation set.
+            else:
+                self.cnn.eval()
+                with torch.profiler.record_function('hyper_step'):
+                    self.valid_iter, self.valid_epochs, stats = (
+                        self.optimization_step(self.valid_iter, self.valid_loader, self.valid_epochs, hyper=True))
+                accumulate_stats(self.valid_stats, stats)
+
+                if self.valid_step % args.log_interval == 0 and self.global_step > 0:
+                    summary_stats, hstats = self.summarize_stats(self.valid_stats, hyper=True)
+                    print('Global Step: {} Valid Epoch: {} \t Valid Step {} \
+                        \tLoss: {:.6f} Accuracy: {:.3f} Entropy {:.3f}'.format(self.global_step,
+                            self.valid_epochs, self.valid_step, summary_stats['loss'],
+                            summary_stats['acc'], summary_stats['entropy']))
+                    print(hstats)
+                    self.logger.write('valid', summary_stats)
+                    clear_stats(self.valid_stats)
+
+                self.valid_step += 1
+
+            self.global_step += 1
+            self.trace_window.step()
+
+        # Just completed an epoch on the training set, so check the validation loss.
+        epoch_dict = self.end_of_epoch_stats(curr_train_epoch)
+        val_loss = epoch_dict['val_loss']
+
+        if (len(self.best_val_loss) > args.nonmono and val_loss > min(self.best_val_loss[:-args.nonmono])):
+
+            self.cnn_optimizer.param_groups[0]['lr'] *= args.lr_decay
+            print('Decaying the learning rate to {}'.format(
+                self.cnn_optimizer.param_groups[0]['lr']))
+            sys.stdout.flush()
+
+        self.best_val_loss.append(val_loss)
+
+        if val_loss < self.stored_loss:
+            self.model_save(os.path.join(self.logger.logdir, 'best_checkpoint.pt'))
+            print('Saving model (new best validation)')
+            sys.stdout.flush()
+            self.stored_loss = val_loss
+            self.patience_elapsed = 0
+        else:
+            self.patience_elapsed += 1
 
-        curr_train_epoch = train_epoch
-        clear_stats(epoch_stats)
+        clear_stats(self.epoch_stats)
+        return epoch_dict
 
-clear_stats(train_stats)
-clear_stats(epoch_stats)
+    def train(self):
+        """Runs the warmup and the hypertraining loop, then reloads the best checkpoint and returns its final
+        validation and test performance (also saved to result.csv)."""
+        args = self.args
 
-best_val_loss = []
-stored_loss = float('inf')
-patience_elapsed = 0
+        self.trace_window.start()
+        self.warmup()
 
-scheduler = MultiStepLR(cnn_optimizer, milestones=[60,120,160], gamma=args.lr_decay)
+        scheduler = MultiStepLR(self.cnn_optimizer, milestones=[60,120,160], gamma=args.lr_decay)
 
-try:
-    # Enter main training loop. Alternate between optimizing on training set for
-    # args.train_steps and on validation set for args.valid_steps.
-    while patience_elapsed < args.patience:
-        # Check whether we should use training or validation set.
-        cycle_pos = (train_step + valid_step) % (args.train_steps + args.valid_steps)
-        hyper = cycle_pos >= args.train_steps
+        try:
+            while self.patience_elapsed < args.patience:
+                self.train_epoch()
+                if self.cnn_optimizer.param_groups[0]['lr'] < 1e-5:  # Another stopping criterion based on decaying the lr
+                    break
 
-        # Do a step on the training set.
-        if not hyper:
-            cnn.train()
-            curr_train_epoch = train_epoch
-            train_iter, train_epoch, stats = (
-                optimization_step(train_iter, train_loader,train_epoch))
-            changed_epoch = (curr_train_epoch != train_epoch)
-            accumulate_stats(train_stats, stats)
-            accumulate_stats(epoch_stats, stats)
-
-            if train_step % args.log_interval == 0 and global_step > 0:
-                summary_stats = summarize_stats(train_stats)
-                print('Global Step: {} Train Epoch: {} \tTrain step:{} \tLoss: {:.3f} Accuracy: {:.3f} lr: {:.4e}'.format(
-                       global_step, train_epoch, train_step, summary_stats['loss'], summary_stats['acc'],
-                       cnn_optimizer.param_groups[0]['lr']))
-                logger.write('train', summary_stats)
-                clear_stats(train_stats)
-
-            train_step += 1
-
-        # Do a step on the validation set.
-        else:
-            cnn.eval()
-            valid_iter, valid_epoch, stats = (
-                optimization_step(valid_iter, valid_loader, valid_epoch, hyper=True))
-            accumulate_stats(valid_stats, stats)
-
-            if valid_step % args.log_interval == 0 and global_step > 0:
-                summary_stats, hstats = summarize_stats(valid_stats, hyper=True)
-                print('Global Step: {} Valid Epoch: {} \t Valid Step {} \
-                    \tLoss: {:.6f} Accuracy: {:.3f} Entropy {:.3f}'.format(global_step,
-                        valid_epoch, valid_step, summary_stats['loss'],
-                        summary_stats['acc'], summary_stats['entropy']))
-                print(hstats)
-                logger.write('valid', summary_stats)
-                clear_stats(valid_stats)
-
-            valid_step += 1
-
-        global_step += 1
-
-        # If just completed an epoch on the training set, check the test loss.
-        if changed_epoch:
-
-            changed_epoch = False  # Reset changed_epoch back to False
-
-            val_loss, val_acc = evaluate(valid_loader)
-
-            mean_train_loss = epoch_stats['xentropy'] / float(len(train_loader))
-            train_acc = epoch_stats['num_correct'] / float(epoch_stats['num_points'])
-
-            elapsed_time = time.time() - start_time
-
-            print('=' * 80)
-            print('Train Epoch: {} | Trn Loss: {:.3f} | Trn Acc: {:.3f} | Val Loss: {:.3f} | Val acc: {:.3f}'.format(
-                   curr_train_epoch, mean_train_loss, train_acc, val_loss, val_acc))
-            print('=' * 80)
-
-            epoch_dict = { 'epoch': curr_train_epoch, 'time': elapsed_time,
-                           'train_loss': mean_train_loss, 'train_acc': train_acc,
-                           'val_loss': val_loss, 'val_acc': val_acc,
-                           'lr': cnn_optimizer.param_groups[0]['lr']}
-            logger.write('epoch', epoch_dict)
-
-            if (len(best_val_loss) > args.nonmono and val_loss > min(best_val_loss[:-args.nonmono])):
-                
-                cnn_optimizer.param_groups[0]['lr'] *= args.lr_decay
-                print('Decaying the learning rate to {}'.format(
-                    cnn_optimizer.param_groups[0]['lr']))
-                sys.stdout.flush()
-
-            best_val_loss.append(val_loss)
-
-            if val_loss < stored_loss:
-                model_save(os.path.join(logger.logdir, 'best_checkpoint.pt'))
-                print('Saving model (new best validation)')
-                sys.stdout.flush()
-                stored_loss = val_loss
-                patience_elapsed = 0
-            else:
-                patience_elapsed += 1
+        except KeyboardInterrupt:
+            print('=' * 89)
+            print('Exiting from training early')
+            sys.stdout.flush()
+        self.trace_window.stop()
 
-            if cnn_optimizer.param_groups[0]['lr'] < 1e-5:  # Another stopping criterion based on decaying the lr
-                break
+        # Load the best saved model.
+        self.model_load(os.path.join(self.logger.logdir, 'best_checkpoint.pt'))
 
-            clear_stats(epoch_stats)
+        # Run on val and test data.
+        val_loss, val_acc = self.evaluate(self.valid_loader)
+        test_loss, test_acc = self.evaluate(self.test_loader)
 
-except KeyboardInterrupt:
-    print('=' * 89)
-    print('Exiting from training early')
-    sys.stdout.flush()
+        print('=' * 89)
+        print('| End of training | val loss {:8.5f} | val acc {:8.5f} | test loss {:8.5f} | test acc {:8.5f}'.format(
+                 val_loss, val_acc, test_loss, test_acc))
+        print('=' * 89)
+        sys.stdout.flush()
 
+        result = { 'val_loss': val_loss, 'val_acc': val_acc, 'test_loss': test_loss, 'test_acc': test_acc }
 
-# Load the best saved model.
-model_load(os.path.join(logger.logdir, 'best_checkpoint.pt'))
+        # Save the final val and test performance to a results CSV file
+        with open(os.path.join(self.logger.logdir, 'result.csv'), 'w') as result_file:
+            result_writer = csv.DictWriter(result_file,
+                fieldnames=['val_loss', 'val_acc', 'test_loss', 'test_acc'])
+            result_writer.writeheader()
+            result_writer.writerow(result)
+            result_file.flush()
 
-# Run on val and test data.
-val_loss, val_acc = evaluate(valid_loader)
-test_loss, test_acc = evaluate(test_loader)
+        if args.save:
+            self.logger.close()
 
-print('=' * 89)
-print('| End of training | val loss {:8.5f} | val acc {:8.5f} | test loss {:8.5f} | test acc {:8.5f}'.format(
-         val_loss, val_acc, test_loss, test_acc))
-print('=' * 89)
-sys.stdout.flush()
+        return result
 
-# Save the final val and test performance to a results CSV file
-with open(os.path.join(logger.logdir, 'result.csv'), 'w') as result_file:
-    result_writer = csv.DictWriter(result_file,
-        fieldnames=['val_loss', 'val_acc', 'test_loss', 'test_acc'])
-    result_writer.writeheader()
-    result_writer.writerow({ 'val_loss': val_loss, 'val_acc': val_acc,
-        'test_loss': test_loss, 'test_acc': test_acc })
-    result_file.flush()
 
-if args.save:
-    logger.close()
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.seeds is None:
+        HyperTrainer(args).train()
+    else:
+        # Decode the datasets once and share the loaders between the runs.
+        check_args(args)
+        loaders = create_loaders(args, hyper=True, pin_memory=device_policy(args).pin_memory)
+        for seed in args.seeds:
+            seed_args = copy.deepcopy(args)
+            seed_args.seed = seed
+            # Logger names the run after the short options in argv, so add the seed to tell the runs apart
+            HyperTrainer(seed_args, loaders, argv=sys.argv + ['-seed', str(seed)]).train()
@@ -0,0 +1,129 @@
+import torch
+
+from util.cutout import BatchCutout
+from util.hyperparameter import robustify
+
+
+###############################################################################
+# Colour space helpers
+###############################################################################
+
+def rgb_to_grayscale(images):
+    """Maps (B, 3, H, W) RGB images in [0, 1] to (B, 1, H, W) luma."""
+    r, g, b = images.unbind(1)
+    return (0.299 * r + 0.587 * g + 0.114 * b).unsqueeze(1)
+
+def rgb_to_hsv(images):
+    """Maps (B, 3, H, W) RGB images in [0, 1] to HSV, with every channel in [0, 1]."""
+    r, g, b = images.unbind(1)
+    maxc = images.max(1)[0]
+    minc = images.min(1)[0]
+
+    # Avoid dividing by zero for gray pixels; their hue and saturation come out as 0.
+    eqc = maxc == minc
+    cr = maxc - minc
+    ones = torch.ones_like(maxc)
+    s = cr / torch.where(eqc, ones, maxc)
+    cr_divisor = torch.where(eqc, ones, cr)
+    rc = (maxc - r) / cr_divisor
+    gc = (maxc - g) / cr_divisor
+    bc = (maxc - b) / cr_divisor
+
+    hr = (maxc == r).float() * (bc - gc)
+    hg = ((maxc == g) & (maxc != r)).float() * (2.0 + rc - bc)
+    hb = ((maxc != g) & (maxc != r)).float() * (4.0 + gc - rc)
+    h = torch.fmod((hr + hg + hb) / 6.0 + 1.0, 1.0)
+    return torch.stack([h, s, maxc], dim=1)
+
+def hsv_to_rgb(images):
+    """Inverse of rgb_to_hsv."""
+    h, s, v = images.unbind(1)
+    i = torch.floor(h * 6.0)
+    f = h * 6.0 - i
+    i = i.long() % 6
+
+    p = torch.clamp(v * (1.0 - s), 0.0, 1.0)
+    q = torch.clamp(v * (1.0 - s * f), 0.0, 1.0)
+    t = torch.clamp(v * (1.0 - s * (1.0 - f)), 0.0, 1.0)
+
+    # Pick the (r, g, b) triple of the hue sector each pixel falls in.
+    sectors = torch.arange(6, device=images.device).view(1, 6, 1, 1)
+    mask = (i.unsqueeze(1) == sectors).float()
+    r = (mask * torch.stack([v, q, p, p, t, v], dim=1)).sum(1)
+    g = (mask * torch.stack([t, v, v, q, p, p], dim=1)).sum(1)
+    b = (mask * torch.stack([p, p, t, v, v, q], dim=1)).sum(1)
+    return torch.stack([r, g, b], dim=1)
+
+
+###############################################################################
+# Per-example augmentations
+###############################################################################
+
+def _blend(images, other, factors):
+    return torch.clamp(factors[:,None,None,None] * images + (1 - factors[:,None,None,None]) * other, 0., 1.)
+
+def adjust_brightness(images, factors):
+    return torch.clamp(images * factors[:,None,None,None], 0., 1.)
+
+def adjust_contrast(images, factors):
+    mean = rgb_to_grayscale(images).mean(dim=(1, 2, 3), keepdim=True)
+    return _blend(images, mean, factors)
+
+def adjust_saturation(images, factors):
+    return _blend(images, rgb_to_grayscale(images), factors)
+
+def adjust_hue(images, factors):
+    hsv = rgb_to_hsv(images)
+    hue = torch.fmod(hsv[:,0] + factors[:,None,None] + 1.0, 1.0)
+    hsv = torch.stack([hue, hsv[:,1], hsv[:,2]], dim=1)
+    return hsv_to_rgb(hsv)
+
+def sample_factors(jitter, centered=False):
+    """Samples one jitter factor per example, with the same ranges as transforms.ColorJitter.
+
+    Arguments:
+    jitter -- (B,) tensor of jitter amounts
+    centered -- if True sample from [-jitter, jitter] (hue), otherwise from [max(0, 1-jitter), 1+jitter]
+    """
+    noise = torch.rand_like(jitter)
+    if centered:
+        low, high = -jitter, jitter
+    else:
+        low, high = torch.clamp(1 - jitter, min=0.), 1 + jitter
+    return low + (high - low) * noise
+
+def augment_batch(images, hparam_tensor, hdict, mean, std):
+    """Applies the tuned jitter and cutout hyperparameters to a batch, using one row of hparam_tensor per image.
+
+    The jitters are applied to the unnormalized images in the order brightness, contrast, saturation, hue,
+    and cutout is applied to the normalized images, which matches where the per-image transforms used to sit
+    in the data pipeline.
+
+    Arguments:
+    images -- (B, C, H, W) normalized images
+    hparam_tensor -- (B, num_hparams) constrained hyperparameters, as returned by hparam_transform
+    hdict -- dictionary mapping hyperparameter names to info about the hyperparameter
+    mean -- per-channel mean the images were normalized with
+    std -- per-channel standard deviation the images were normalized with
+    """
+    hparam_tensor = hparam_tensor.detach()
+
+    jitter_ops = [('bright', adjust_brightness, False), ('contrast', adjust_contrast, False),
+                  ('sat', adjust_saturation, False), ('hue', adjust_hue, True)]
+    jitter_ops = [op for op in jitter_ops if op[0] in hdict]
+    if jitter_ops:
+        mean = torch.as_tensor(mean, device=images.device).view(1, -1, 1, 1)
+        std = torch.as_tensor(std, device=images.device).view(1, -1, 1, 1)
+        images = images * std + mean
+        for jname, adjust, centered in jitter_ops:
+            jitter = robustify(hparam_tensor[:,hdict[jname].index], 1e-3)
+            images = adjust(images, sample_factors(jitter, centered))
+        images = (images - mean) / std
+
+    if 'cutlength' in hdict or 'cutholes' in hdict:
+        # Untuned cutout settings default to a single hole of length 8.
+        length = hparam_tensor[:,hdict['cutlength'].index] if 'cutlength' in hdict else 8
+        n_holes = hparam_tensor[:,hdict['cutholes'].index] if 'cutholes' in hdict else 1
+        images = BatchCutout(n_holes, length)(images)
+
+    return images
@@ -82,9 +82,7 @@ def perturb(htensor, hscale, batch_size, hdict=None):
     noise = htensor.new(batch_size, htensor.size(0)).normal_()
     perturb_htensor = htensor + F.softplus(hscale)*noise
     if hdict is not None:
-        for hinfo in [hinfo for hinfo in hdict.values() if not hinfo.minibatch]:
-            hidx = hinfo.index
-            perturb_htensor[:, hidx] = perturb_htensor[0, hidx]
+        perturb_htensor = HyperparameterTransform(hdict, htensor.device).share_across_batch(perturb_htensor)
     return perturb_htensor
 
 def hnet_transform(htensor, hdict):
@@ -96,11 +94,7 @@ def hnet_transform(htensor, hdict):
     Returns:
         hnet_tensor (tensor): tensor of size (B, H) ready to be fed into hypernet
     """
-    hnet_tensor_list = []
-    for hinfo in hdict.values():
-        hvalue = htensor[:,hinfo.index]
-        hnet_tensor_list.append(hvalue)
-    return torch.stack(hnet_tensor_list, dim=1)
+    return HyperparameterTransform(hdict, htensor.device).hnet_transform(htensor)
 
 def compute_entropy(hscale):
     """
@@ -122,17 +116,68 @@ def hparam_transform(htensor, hdict):
     Returns:
         hparam_tensor (tensor): tensor ready to be used as actual hyperparameters
     """
-    hparam_tensor_list = []
-    for hinfo in hdict.values():
-        range_min, range_max = hinfo.range
-        hvalue = htensor[:,hinfo.index]
-        hparam = project(hvalue, range_min, range_max)
+    return HyperparameterTransform(hdict, htensor.device).hparam_transform(htensor)
 
-        if hinfo.discrete:
-            hparam = torch.floor(hparam)
-        hparam_tensor_list.append(hparam)
+class HyperparameterTransform():
+    def __init__(self, hdict, device=None):
+        """
+        Vectorized version of perturb, hnet_transform and hparam_transform. The index of every
+        hyperparameter and masks selecting the columns of each kind of projection are built once,
+        so that all columns are transformed with a fixed number of tensor operations instead of a
+        Python loop over the hyperparameters.
 
-    return torch.stack(hparam_tensor_list, dim=1)
+        Arguments:
+            hdict: dictionary mapping hyperparameter names to relevant info
+            device: device the htensors will be on
+        """
+        hinfos = list(hdict.values())
+        self.index = torch.tensor([hinfo.index for hinfo in hinfos], dtype=torch.long, device=device)
+
+        range_min = torch.tensor([hinfo.range[0] for hinfo in hinfos], device=device)
+        range_max = torch.tensor([hinfo.range[1] for hinfo in hinfos], device=device)
+        has_min, has_max = range_min != -float('inf'), range_max != float('inf')
+        # Same cases as project.
+        self.interval = has_min & has_max
+        self.lower = has_min & ~has_max
+        self.upper = ~has_min & has_max
+        # Infinite bounds are zeroed so that the branches torch.where discards (and their gradients) stay finite.
+        self.range_min = torch.where(has_min, range_min, torch.zeros_like(range_min))
+        self.range_max = torch.where(has_max, range_max, torch.zeros_like(range_max))
+
+        self.discrete = torch.tensor([hinfo.discrete for hinfo in hinfos], device=device)
+        self.minibatch = torch.tensor([hinfo.minibatch for hinfo in hinfos], device=device)
+        self.any_interval, self.any_lower, self.any_upper = \
+            self.interval.any().item(), self.lower.any().item(), self.upper.any().item()
+        self.any_discrete = self.discrete.any().item()
+        self.all_minibatch = self.minibatch.all().item()
+
+    def share_across_batch(self, perturb_htensor):
+        """Gives hyperparameters that can't use minibatched perturbations the perturbation of the first example."""
+        if self.all_minibatch:
+            return perturb_htensor
+        return torch.where(self.minibatch, perturb_htensor, perturb_htensor[:1])
+
+    def perturb(self, htensor, hscale, batch_size):
+        """Same as perturb(htensor, hscale, batch_size, hdict)."""
+        return self.share_across_batch(perturb(htensor, hscale, batch_size))
+
+    def hnet_transform(self, htensor):
+        """Same as hnet_transform(htensor, hdict)."""
+        return htensor.index_select(1, self.index)
+
+    def hparam_transform(self, htensor):
+        """Same as hparam_transform(htensor, hdict)."""
+        hvalue = htensor.index_select(1, self.index)
+        hparam = hvalue
+        if self.any_interval:
+            hparam = torch.where(self.interval, s_sigmoid(hvalue, self.range_min, self.range_max), hparam)
+        if self.any_lower:
+            hparam = torch.where(self.lower, self.range_min + F.softplus(hvalue), hparam)
+        if self.any_upper:
+            hparam = torch.where(self.upper, self.range_max - F.softplus(hvalue), hparam)
+        if self.any_discrete:
+            hparam = torch.where(self.discrete, torch.floor(hparam), hparam)
+        return hparam
 
 def create_hparams(args, cnn_class, device):
     """
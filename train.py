@@ -22,6 +22,7 @@ import data_loaders
 from models import models
 from kfac import KFACOptimizer
 from util import eval_hessian, eval_jacobain, gather_flat_grad, conjugate_gradiant, eval_jacobian_matrix
+from utils.device import add_device_arguments, device_policy
 sys.path.insert(0,'/scratch/gobi1/datasets')
 
 
@@ -77,15 +78,15 @@ parser.add_argument('--save', action='store_true', default=False,
                     help='whether to save current run')
 parser.add_argument('--dataset',type=str, default="MNIST",
                     help='which dataset to train' )
+add_device_arguments(parser)
 args = parser.parse_args()
 
-args.cuda = not args.no_cuda and torch.cuda.is_available()
-use_device = 'cuda:0' if args.cuda else 'cpu'
+policy = device_policy(args, double_backward=True)
+args.cuda = policy.is_cuda
+use_device = policy.device
 
-torch.manual_seed(args.seed)
+policy.manual_seed(args.seed)
 np.random.seed(args.seed)
-if args.cuda:
-    torch.cuda.manual_seed(args.seed)
 
 
 def half_image_noise(image):
@@ -276,10 +277,7 @@ def CG_optimize():
     # TODO(PV): Why is the conversion to double() and back necessary?
     model = model.double()
     model.dropout = Variable(model.dropout.double(), requires_grad=True)
-    if args.cuda:
-        model.weight_decay = Variable(model.weight_decay.double(), requires_grad=True).cuda()
-    else:
-        model.weight_decay = Variable(model.weight_decay.double(), requires_grad=True)
+    model.weight_decay = policy.to(model.weight_decay.detach(), dtype=torch.float64).requires_grad_()
 
     print(model.parameters)
     model.net.eval()
@@ -319,9 +317,7 @@ def CG_optimize():
     for i in range(1):
         for data, target in test_loader:
             data = data.double()
-            if args.cuda:
-                data, target = data.cuda(), target.cuda()
-            data, target = Variable(data), Variable(target)
+            data, target = policy.to(data), policy.to(target)
             output = model(data)
             test_loss += F.cross_entropy(output, target, size_average=False)  # sum up batch loss
 
@@ -342,10 +338,7 @@ def CG_optimize():
     model = model.float()
     model.dropout = Variable(model.dropout.float(), requires_grad=True)
 
-    if args.cuda:
-        model.weight_decay = Variable(model.weight_decay.float(), requires_grad=True).cuda()
-    else:
-        model.weight_decay = Variable(model.weight_decay.float(), requires_grad=True)
+    model.weight_decay = policy.to(model.weight_decay.detach(), dtype=torch.float32).requires_grad_()
 
     return hyper, i, train_loss.item(), test_loss.item()
 
@@ -16,15 +16,21 @@ from torch.optim.lr_scheduler import MultiStepLR
 # Local imports
 import data_loaders
 from models.unet import UNet
+from models.parametric_augment import ParametricAugmentNet
 from models import resnet_cifar
 from models.resnet import ResNet18
-from models.simple_models import Net
+from models.simple_models import Net, ExampleWeightTable
 from models.wide_resnet import WideResNet
 from train_augment_net_multiple import get_id
 from utils.util import gather_flat_grad
+from utils.device import device_policy
+from utils.data_iter import CycleLoader, Prefetcher, with_indices
+from utils.elementary_step import ElementaryStep
+from utils.profiling import PhaseTimer, TraceWindow
 
 
-def saver(epoch, elementary_model, elementary_optimizer, augment_net, reweighting_net, hyper_optimizer, path):
+def saver(epoch, elementary_model, elementary_optimizer, augment_net, reweighting_net, hyper_optimizer, path,
+          reweighting_table=None):
     """
 
     :param epoch:
@@ -34,47 +40,47 @@ def saver(epoch, elementary_model, elementary_optimizer, augment_net, reweightin
     :param reweighting_net:
     :param hyper_optimizer:
     :param path:
+    :param reweighting_table: The per-example weight table, saved if given.
     :return:
     """
+    checkpoint = {
+        'epoch': epoch,
+        'elementary_model_state_dict': elementary_model.state_dict(),
+        'elementary_optimizer_state_dict': elementary_optimizer.state_dict(),
+        'augment_model_state_dict': augment_net.state_dict(),
+        'reweighting_net_state_dict': reweighting_net.state_dict(),
+        'hyper_optimizer_state_dict': hyper_optimizer.state_dict()
+    }
     if 'weight_decay' in elementary_model.__dict__:
-        torch.save({
-            'epoch': epoch,
-            'elementary_model_state_dict': elementary_model.state_dict(),
-            'weight_decay': elementary_model.weight_decay,
-            'elementary_optimizer_state_dict': elementary_optimizer.state_dict(),
-            'augment_model_state_dict': augment_net.state_dict(),
-            'reweighting_net_state_dict': reweighting_net.state_dict(),
-            'hyper_optimizer_state_dict': hyper_optimizer.state_dict()
-        }, path + '/checkpoint.pt')
-    else:
-        torch.save({
-            'epoch': epoch,
-            'elementary_model_state_dict': elementary_model.state_dict(),
-            'elementary_optimizer_state_dict': elementary_optimizer.state_dict(),
-            'augment_model_state_dict': augment_net.state_dict(),
-            'reweighting_net_state_dict': reweighting_net.state_dict(),
-            'hyper_optimizer_state_dict': hyper_optimizer.state_dict()
-        }, path + '/checkpoint.pt')
+        checkpoint['weight_decay'] = elementary_model.weight_decay
+    if reweighting_table is not None:
+        checkpoint['reweighting_table_state_dict'] = reweighting_table.state_dict()
+    torch.save(checkpoint, path + '/checkpoint.pt')
 
 
-def load_baseline_model(args):
+def load_baseline_model(args, policy=None):
     """
 
     :param args:
+    :param policy: DevicePolicy to place the model and loaders with, built from args if None
     :return:
     """
+    if policy is None:
+        policy = device_policy(args, double_backward=True)
     if args.dataset == 'cifar10':
         imsize, in_channel, num_classes = 32, 3, 10
         train_loader, val_loader, test_loader = data_loaders.load_cifar10(args.batch_size, val_split=True,
                                                                           augmentation=args.data_augmentation,
                                                                           subset=[args.train_size, args.val_size,
-                                                                                  args.test_size])
+                                                                                  args.test_size],
+                                                                          pin_memory=policy.pin_memory)
     elif args.dataset == 'cifar100':
         imsize, in_channel, num_classes = 32, 3, 100
         train_loader, val_loader, test_loader = data_loaders.load_cifar100(args.batch_size, val_split=True,
                                                                            augmentation=args.data_augmentation,
                                                                            subset=[args.train_size, args.val_size,
-                                                                                   args.test_size])
+                                                                                   args.test_size],
+                                                                           pin_memory=policy.pin_memory)
     elif args.dataset == 'mnist':
         imsize, in_channel, num_classes = 28, 1, 10
         # num_train = args.train_size
@@ -84,7 +90,8 @@ def load_baseline_model(args):
         from data_loaders import load_mnist
         train_loader, val_loader, test_loader = load_mnist(args.batch_size,
                                                            subset=[args.train_size, args.val_size, args.test_size],
-                                                           num_train=num_train, only_split_train=False)
+                                                           num_train=num_train, only_split_train=False,
+                                                           pin_memory=policy.pin_memory)
     elif args.dataset == 'boston':
         imsize, in_channel, num_classes = 13, 1, 1
         from data_loaders import load_boston
@@ -102,39 +109,44 @@ def load_baseline_model(args):
 
     checkpoint = None
     if args.load_baseline_checkpoint:
-        checkpoint = torch.load(args.load_baseline_checkpoint)
+        checkpoint = torch.load(args.load_baseline_checkpoint, map_location=policy.device)
         cnn.load_state_dict(checkpoint['model_state_dict'])
 
-    model = cnn.cuda()
+    model = policy.module(cnn)
     if args.use_weight_decay:
         if args.weight_decay_all:
             num_p = sum(p.numel() for p in model.parameters())
             weights = np.ones(num_p) * init_l2
-            model.weight_decay = Variable(torch.FloatTensor(weights).cuda(), requires_grad=True)
+            model.weight_decay = policy.tensor(weights, requires_grad=True)
         else:
             weights = init_l2
-            model.weight_decay = Variable(torch.FloatTensor([weights]).cuda(), requires_grad=True)
-        model.weight_decay = model.weight_decay.cuda()
+            model.weight_decay = policy.tensor([weights], requires_grad=True)
     model.train()
     return model, train_loader, val_loader, test_loader, checkpoint
 
 
-def load_finetuned_model(args, baseline_model):
+def load_finetuned_model(args, baseline_model, policy=None):
     """
 
     :param args:
     :param baseline_model:
+    :param policy: DevicePolicy to place the models with, built from args if None
     :return:
     """
+    if policy is None:
+        policy = device_policy(args, double_backward=True)
     # augment_net = Net(0, 0.0, 32, 3, 0.0, num_classes=32**2 * 3, do_res=True)
     if args.dataset == 'mnist':
         imsize, in_channel, num_classes = 28, 1, 10
     else:
         imsize, in_channel, num_classes = 32, 3, 10
-    augment_net = UNet(in_channels=in_channel, n_classes=in_channel, depth=2, wf=3, padding=True, batch_norm=False,
-                       do_noise_channel=True,
-                       up_mode='upconv', use_identity_residual=True)  # TODO(PV): Initialize UNet properly
-    # TODO (JON): DEPTH 1 WORKED WELL.  Changed upconv to upsample.  Use a wf of 2.
+    if args.augment_net_type == 'parametric':
+        augment_net = ParametricAugmentNet(in_channels=in_channel)
+    else:
+        augment_net = UNet(in_channels=in_channel, n_classes=in_channel, depth=2, wf=3, padding=True, batch_norm=False,
+                           do_noise_channel=True,
+                           up_mode='upconv', use_identity_residual=True)  # TODO(PV): Initialize UNet properly
+        # TODO (JON): DEPTH 1 WORKED WELL.  Changed upconv to upsample.  Use a wf of 2.
 
     # This ResNet outputs scalar weights to be applied element-wise to the per-example losses
     from models.simple_models import CNN, Net
@@ -142,7 +154,7 @@ def load_finetuned_model(args, baseline_model):
     # resnet_cifar.resnet20(num_classes=1)
 
     if args.load_finetune_checkpoint:
-        checkpoint = torch.load(args.load_finetune_checkpoint)
+        checkpoint = torch.load(args.load_finetune_checkpoint, map_location=policy.device)
         # temp_baseline_model = baseline_model
         # baseline_model.load_state_dict(checkpoint['elementary_model_state_dict'])
         if 'weight_decay' in checkpoint:
@@ -155,11 +167,71 @@ def load_finetuned_model(args, baseline_model):
         except KeyError:
             pass
 
-    augment_net, reweighting_net, baseline_model = augment_net.cuda(), reweighting_net.cuda(), baseline_model.cuda()
+    augment_net, reweighting_net = policy.module(augment_net), policy.module(reweighting_net)
+    baseline_model = policy.module(baseline_model)
     augment_net.train(), reweighting_net.train(), baseline_model.train()
     return augment_net, reweighting_net, baseline_model
 
 
+def sample_augmentations(augment_net, x, num_samples, max_batch_size=0, class_label=None):
+    """Draws num_samples augmentations of every image in x with batched calls to augment_net.
+
+    The copies of x are stacked into one batch, so each image gets its own noise as in separate calls.  If
+    max_batch_size > 0, at most that many images go through augment_net at once, to bound the memory kept for
+    the backward pass.
+
+    :param augment_net: augmentation network, called as augment_net(x, class_label=...)
+    :param x: (batch, channels, height, width) images
+    :param num_samples: number of augmentations per image
+    :param max_batch_size: maximum number of images per augment_net call, 0 for no limit
+    :param class_label: (batch,) labels passed on to augment_net
+    :return: (num_samples, batch, channels, height, width) augmented images
+    """
+    samples_per_call = num_samples
+    if max_batch_size > 0:
+        samples_per_call = max(1, min(num_samples, max_batch_size // x.shape[0]))
+
+    xs = []
+    for start in range(0, num_samples, samples_per_call):
+        num_chunk = min(samples_per_call, num_samples - start)
+        x_chunk = x.repeat(num_chunk, 1, 1, 1)
+        label_chunk = class_label.repeat(num_chunk) if class_label is not None else None
+        xs.append(augment_net(x_chunk, class_label=label_chunk).view(num_chunk, *x.shape))
+    return torch.cat(xs, dim=0)
+
+
+def tta_predict(model, augment_net, images, num_views, max_batch_size=0):
+    """Averages the model's predictions on images and on num_views augmentations of them.
+
+    The views are stacked into as few model forwards as possible.  If max_batch_size > 0, at most that many images
+    go through augment_net and the model at once.  A model in train mode normalizes over the stacked views with
+    batch norm, not over each view on its own.
+
+    :param model: model to evaluate
+    :param augment_net: augmentation network
+    :param images: (batch, channels, height, width) images
+    :param num_views: number of augmented views per image, besides the image itself
+    :param max_batch_size: maximum number of images per forward, 0 for no limit
+    :return: (batch, outputs) mean prediction over the 1 + num_views views
+    """
+    batch_size = images.shape[0]
+    views_per_call = num_views + 1
+    if max_batch_size > 0:
+        views_per_call = max(1, min(views_per_call, max_batch_size // batch_size))
+
+    pred_sum = 0
+    for start in range(0, num_views + 1, views_per_call):
+        num_chunk = min(views_per_call, num_views + 1 - start)
+        # View 0 is the image itself, the rest are augmented
+        num_augmented = num_chunk - 1 if start == 0 else num_chunk
+        views = [images] if start == 0 else []
+        if num_augmented > 0:
+            views.append(sample_augmentations(augment_net, images, num_augmented).view(-1, *images.shape[1:]))
+        pred = model(torch.cat(views, dim=0))
+        pred_sum = pred_sum + pred.view(num_chunk, batch_size, *pred.shape[1:]).sum(dim=0)
+    return pred_sum / (num_views + 1)
+
+
 def zero_hypergrad(get_hyper_train):
     """
 
@@ -184,7 +256,9 @@ def store_hypergrad(get_hyper_train, total_d_val_loss_d_lambda):
     current_index = 0
     for p in get_hyper_train():
         p_num_params = np.prod(p.shape)
-        p.grad = total_d_val_loss_d_lambda[current_index:current_index + p_num_params].view(p.shape)
+        p_grad = total_d_val_loss_d_lambda[current_index:current_index + p_num_params].view(p.shape)
+        # Keep the gradient in the parameter's layout (e.g. channels-last), so later backward passes accumulate into it
+        p.grad = p_grad if p.is_contiguous() else torch.empty_like(p).copy_(p_grad)
         current_index += p_num_params
 
 
@@ -326,25 +400,34 @@ def cg_batch(A_bmm, B, M_bmm=None, X0=None, rtol=1e-4, atol=0.0, maxiter=10, ver
     return X_k, info
 
 
-def get_models(args):
-    model, train_loader, val_loader, test_loader, checkpoint = load_baseline_model(args)
-    augment_net, reweighting_net, model = load_finetuned_model(args, model)
+def get_models(args, policy=None):
+    if policy is None:
+        policy = device_policy(args, double_backward=True)
+    model, train_loader, val_loader, test_loader, checkpoint = load_baseline_model(args, policy)
+    augment_net, reweighting_net, model = load_finetuned_model(args, model, policy)
     return model, train_loader, val_loader, test_loader, augment_net, reweighting_net, checkpoint
 
 
 def experiment(args):
     if args.do_print: print(args)
     do_simple = args.do_simple
+    policy = device_policy(args, double_backward=True)
+    if args.do_print: print(policy)
     # Setup the random seeds
-    torch.manual_seed(args.seed)
+    policy.manual_seed(args.seed)
     np.random.seed(args.seed)
-    if torch.cuda.is_available():
-        torch.cuda.manual_seed(args.seed)
 
     # Load the baseline model
     args.load_baseline_checkpoint = None  # '/h/lorraine/PycharmProjects/CG_IFT_test/baseline_checkpoints/cifar10_resnet18_sgdm_lr0.1_wd0.0005_aug1.pt'
     # args.load_finetune_checkpoint = None  # TODO: Make it load the augment net if this is provided
-    model, train_loader, val_loader, test_loader, augment_net, reweighting_net, checkpoint = get_models(args)
+    model, train_loader, val_loader, test_loader, augment_net, reweighting_net, checkpoint = get_models(args, policy)
+    reweighting_table = None
+    if args.use_reweighting_table:
+        # A loss weight logit per training example, looked up with the dataset indices the train batches now carry
+        reweighting_table = policy.module(ExampleWeightTable(len(train_loader.dataset)))
+        train_loader = with_indices(train_loader)
+    # Build the upcoming batches on a background thread while the elementary and hyper steps run
+    train_loader, val_loader = Prefetcher(train_loader, args.num_prefetch), Prefetcher(val_loader, args.num_prefetch)
 
     # Load the logger
     from train_augment_net_multiple import load_logger, get_id
@@ -362,17 +445,22 @@ def experiment(args):
             return reweighting_net.parameters()
         elif args.use_weight_decay:
             return [model.weight_decay]
+        elif args.use_reweighting_table:
+            # Only reached with --no_augment_net; otherwise hyper_step appends the table rows to the dense hypers
+            return []  # The table is updated sparsely, by table_optimizer
 
     def get_hyper_train_flat():
         if args.use_augment_net and args.use_reweighting_net:
-            return torch.cat([torch.cat([p.view(-1) for p in augment_net.parameters()]),
-                              torch.cat([p.view(-1) for p in reweighting_net.parameters()])])
+            return torch.cat([torch.cat([p.reshape(-1) for p in augment_net.parameters()]),
+                              torch.cat([p.reshape(-1) for p in reweighting_net.parameters()])])
         elif args.use_reweighting_net:
-            return torch.cat([p.view(-1) for p in reweighting_net.parameters()])
+            return torch.cat([p.reshape(-1) for p in reweighting_net.parameters()])
         elif args.use_augment_net:
-            return torch.cat([p.view(-1) for p in augment_net.parameters()])
+            return torch.cat([p.reshape(-1) for p in augment_net.parameters()])
         elif args.use_weight_decay:
             return model.weight_decay  # TODO: This correct?
+        elif args.use_reweighting_table:
+            return reweighting_table.logits
 
     # Setup the optimizers
     if args.load_baseline_checkpoint is not None:
@@ -393,17 +481,28 @@ def experiment(args):
     scheduler = MultiStepLR(optimizer, milestones=[60, 120, 160], gamma=0.2)  # [60, 120, 160]
     # optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
 
+    # Sparse Adam only updates (and keeps moments for) the table rows of the batch each hyper step sees
+    table_optimizer = None
+    if args.use_reweighting_table:
+        table_optimizer = optim.SparseAdam([reweighting_table.logits], lr=args.reweighting_table_lr)
     use_hyper_scheduler = False
-    hyper_optimizer = optim.RMSprop(get_hyper_train())
-    if not do_simple:
-        hyper_optimizer = optim.SGD(get_hyper_train(), lr=args.lr, momentum=0.9, nesterov=True)
-        use_hyper_scheduler = True
+    if list(get_hyper_train()):
+        hyper_optimizer = optim.RMSprop(get_hyper_train())
+        if not do_simple:
+            hyper_optimizer = optim.SGD(get_hyper_train(), lr=args.lr, momentum=0.9, nesterov=True)
+            use_hyper_scheduler = True
+    else:
+        hyper_optimizer, table_optimizer = table_optimizer, None
     hyper_scheduler = MultiStepLR(hyper_optimizer, milestones=[40, 100, 140], gamma=0.2)
 
     graph_iter = 0
 
-    def train_loss_func(x, y):
-        x, y = x.cuda(), y.cuda()
+    def train_loss_func(x, y, index=None, weight_logits=None):
+        """
+        :param index: dataset indices of the batch, for the per-example weights of reweighting_table
+        :param weight_logits: the reweighting_table rows of index to use, by default they are looked up (detached)
+        """
+        x, y = policy.batch(x, y)
         reg = 0.
 
         if args.use_augment_net and (args.num_neumann_terms >= 0 or args.load_finetune_checkpoint != ''):
@@ -447,6 +546,10 @@ def experiment(args):
                     plt.clf()
 
             xentropy_loss = xentropy_loss * loss_weights
+        if args.use_reweighting_table and index is not None:
+            if weight_logits is None:
+                weight_logits = reweighting_table(policy.to(index)).detach()
+            xentropy_loss = xentropy_loss * F.softmax(weight_logits, dim=0) * x.shape[0]
         graph_iter += 1
 
         if args.use_weight_decay:
@@ -460,6 +563,9 @@ def experiment(args):
         final_loss = xentropy_loss.mean() + reg
         return final_loss, pred
 
+    # The first-order steps may be compiled; hyper_step differentiates through train_loss_func itself
+    elementary_step = ElementaryStep(train_loss_func, optimizer, compile=args.compile_elementary_step)
+
     use_reg = args.use_augment_net and not args.use_reweighting_net
     reg_anneal_epoch = 0
     stop_reg_epoch = 200
@@ -467,7 +573,7 @@ def experiment(args):
         use_reg = False
 
     def val_loss_func(x, y):
-        x, y = x.cuda(), y.cuda()
+        x, y = policy.batch(x, y)
         pred = model(x)
         if args.do_classification:
             xentropy_loss = F.cross_entropy(pred, y)
@@ -477,10 +583,7 @@ def experiment(args):
         reg = 0
         if args.use_augment_net:
             if use_reg:
-                num_sample = 10
-                xs = torch.zeros(num_sample, x.shape[0], x.shape[1], x.shape[2], x.shape[3]).cuda()
-                for i in range(num_sample):
-                    xs[i] = augment_net(x, class_label=y)
+                xs = sample_augmentations(augment_net, x, args.num_aug_samples, args.aug_max_batch_size, class_label=y)
                 xs_diffs = (torch.abs(torch.mean(xs, dim=0) - x))
                 diff_loss = torch.mean(xs_diffs)
                 stds = torch.std(xs, dim=0)
@@ -495,12 +598,16 @@ def experiment(args):
             reg *= 0
         return xentropy_loss + reg
 
-    def test(loader, do_test_augment=True, num_augment=5):
+    def test(loader, do_test_augment=True, num_augment=None):
+        if num_augment is None:
+            num_augment = args.num_tta_views
+        if args.batched_tta:
+            return batched_test(loader, do_test_augment, num_augment)
         # model.eval()  # Change model to 'eval' mode (BN uses moving mean/var).
         correct, total = 0., 0.
         losses = []
         for images, labels in loader:
-            images, labels = images.cuda(), labels.cuda()
+            images, labels = policy.batch(images, labels)
 
             with torch.no_grad():
                 pred = model(images)
@@ -529,7 +636,41 @@ def experiment(args):
         model.train()
         return avg_loss, acc
 
-    def hyper_step(elementary_lr, do_true_inverse=False):
+    def batched_test(loader, do_test_augment, num_augment):
+        """Like test, but with all the views of a batch in one forward, and the statistics kept on the device."""
+        do_test_augment = do_test_augment and args.use_augment_net and (
+                args.num_neumann_terms >= 0 or args.load_finetune_checkpoint != '')
+        num_views = num_augment if do_test_augment else 0
+        loss_sum, correct, total, num_batches = 0, 0, 0, 0
+        start_time = time.time()
+        for images, labels in loader:
+            images, labels = policy.batch(images, labels)
+
+            with torch.no_grad():
+                pred = tta_predict(model, augment_net, images, num_views, args.tta_max_batch_size)
+                if args.do_classification:
+                    loss_sum = loss_sum + F.cross_entropy(pred, labels)
+                    correct = correct + (torch.max(pred, 1)[1] == labels).sum()
+                else:
+                    loss_sum = loss_sum + F.mse_loss(pred, labels)
+            total += labels.size(0)
+            num_batches += 1
+
+        avg_loss = float(loss_sum) / num_batches
+        acc = float(correct) / total if args.do_classification else 0.
+        if args.do_print:
+            elapsed = time.time() - start_time
+            tqdm.write('test: {} images x {} views in {:.2f}s | {:.1f} images/sec'.format(
+                total, num_views + 1, elapsed, total * (num_views + 1) / elapsed))
+        model.train()
+        return avg_loss, acc
+
+    # Persistent batch sources for the hyper steps, so we don't rebuild a loader iterator for every batch
+    hyper_train_batches, hyper_val_batches = CycleLoader(train_loader), CycleLoader(val_loader)
+    phase_timer = PhaseTimer(policy, args.profile_memory, args.sync_phase_timing)
+    trace_window = TraceWindow(args, os.path.join(args.save_dir, test_id, 'traces'), policy)
+
+    def hyper_step(elementary_lr, do_true_inverse=False, timer=None):
         # hyper_step(get_hyper_train, model, val_loss_func, val_loader, old_d_train_loss_d_w, elementary_lr, use_reg, args, train_loader, train_loss_func, elementary_optimizer):
         """Estimate the hypergradient, and take an update with it.
 
@@ -539,66 +680,79 @@ def experiment(args):
         :param val_loader: A generator for input x, output y tuples.
         :param d_train_loss_d_w:  The derivative of the training loss with respect to elementary parameters.
         :param hyper_optimizer: The optimizer which updates the hyperparameters.
+        :param timer: The PhaseTimer recording the phases of the step, phase_timer by default.
         :return: The scalar valued validation loss, the hyperparameter norm, and the hypergradient norm.
         """
+        timer = phase_timer if timer is None else timer
         zero_hypergrad(get_hyper_train)
-        num_weights, num_hypers = sum(p.numel() for p in model.parameters()), sum(p.numel() for p in get_hyper_train())
+        batch = next(hyper_train_batches)
+        x, y = batch[:2]
+        # Only the table rows of this batch are hyperparameters of the step, as a leaf of their own
+        hyper_params, index, weight_rows = list(get_hyper_train()), None, None
+        if reweighting_table is not None:
+            index = policy.to(batch[2])
+            weight_rows = reweighting_table.rows(index)
+            hyper_params.append(weight_rows)
+        num_weights, num_hypers = sum(p.numel() for p in model.parameters()), sum(p.numel() for p in hyper_params)
+        num_dense_hypers = num_hypers - (weight_rows.numel() if weight_rows is not None else 0)
         print(f"num_weights : {num_weights}, num_hypers : {num_hypers}")
 
         # d_train_loss_d_w = gather_flat_grad(d_train_loss_d_w)  # TODO: COmmented this out!
-        d_train_loss_d_w = torch.zeros(num_weights).cuda()
-        model.train(), model.zero_grad()
-        for batch_idx, (x, y) in enumerate(train_loader):
-            train_loss, _ = train_loss_func(x, y)
+        with timer.phase('train_grad'):
+            d_train_loss_d_w = policy.zeros(num_weights)
+            model.train(), model.zero_grad()
+            train_loss, _ = train_loss_func(x, y, index, weight_logits=weight_rows)
             optimizer.zero_grad()
             d_train_loss_d_w += gather_flat_grad(grad(train_loss, model.parameters(), create_graph=True))
-            break
-        optimizer.zero_grad()
+            optimizer.zero_grad()
+        timer.count_hvps(d_train_loss_d_w)
 
         # Compute gradients of the validation loss w.r.t. the weights/hypers
-        d_val_loss_d_theta, direct_grad = torch.zeros(num_weights).cuda(), torch.zeros(num_hypers).cuda()
+        d_val_loss_d_theta, direct_grad = policy.zeros(num_weights), policy.zeros(num_hypers)
         model.train(), model.zero_grad()
-        for batch_idx, (x, y) in enumerate(val_loader):
+        x, y = next(hyper_val_batches)
+        with timer.phase('val_grad'):
             val_loss = val_loss_func(x, y)
             optimizer.zero_grad()
             d_val_loss_d_theta += gather_flat_grad(grad(val_loss, model.parameters(), retain_graph=use_reg))
             if use_reg:
-                direct_grad += gather_flat_grad(grad(val_loss, get_hyper_train(), allow_unused=True))
+                direct_grad[:num_dense_hypers] += gather_flat_grad(grad(val_loss, get_hyper_train(),
+                                                                        allow_unused=True))
                 direct_grad[direct_grad != direct_grad] = 0
-            break
 
         # Initialize the preconditioner and counter
         preconditioner = d_val_loss_d_theta
-        if do_true_inverse:
-            hessian = torch.zeros(num_weights, num_weights).cuda()
-            for i in range(num_weights):
-                hess_row = gather_flat_grad(grad(d_train_loss_d_w[i], model.parameters(), retain_graph=True))
-                hessian[i] = hess_row
-                # hessian[-i] = hess_row
-            '''hessian = hessian.t()
-            final_hessian = torch.zeros(num_weights, num_weights).cuda()
-            for i in range(num_weights):
-                final_hessian[-i] = hessian[i]
-            hessian = final_hessian'''
-            # hessian = hessian  #hessian @ hessian
-            # chol = torch.cholesky(hessian.view(1, num_weights, num_weights))[0] + 1e-3*torch.eye(num_weights).cuda()
-            inv_hessian = torch.pinverse(hessian)
-            # inv_hessian = inv_hessian @ inv_hessian
-            preconditioner = d_val_loss_d_theta @ inv_hessian
-        elif not args.use_cg:
-            preconditioner = neumann_hyperstep_preconditioner(d_val_loss_d_theta, d_train_loss_d_w, elementary_lr,
-                                                              args.num_neumann_terms, model)
-        else:
-            def A_vector_multiply_func(vec):
-                val = gather_flat_grad(grad(d_train_loss_d_w, model.parameters(),
-                                            grad_outputs=vec.view(-1), retain_graph=True))
-                # val_2 = gather_flat_grad(grad(d_train_loss_d_w, model.parameters(), grad_outputs=val.view(-1), retain_graph=True))
-                # return val_2.view(1, -1, 1)
-                return val.view(1, -1, 1)
+        with timer.phase('inverse'):
+            if do_true_inverse:
+                hessian = policy.zeros(num_weights, num_weights)
+                for i in range(num_weights):
+                    hess_row = gather_flat_grad(grad(d_train_loss_d_w[i], model.parameters(), retain_graph=True))
+                    hessian[i] = hess_row
+                    # hessian[-i] = hess_row
+                '''hessian = hessian.t()
+                final_hessian = policy.zeros(num_weights, num_weights)
+                for i in range(num_weights):
+                    final_hessian[-i] = hessian[i]
+                hessian = final_hessian'''
+                # hessian = hessian  #hessian @ hessian
+                # chol = torch.cholesky(hessian.view(1, num_weights, num_weights))[0] + 1e-3*torch.eye(num_weights).cuda()
+                inv_hessian = torch.pinverse(hessian)
+                # inv_hessian = inv_hessian @ inv_hessian
+                preconditioner = d_val_loss_d_theta @ inv_hessian
+            elif not args.use_cg:
+                preconditioner = neumann_hyperstep_preconditioner(d_val_loss_d_theta, d_train_loss_d_w, elementary_lr,
+                                                                  args.num_neumann_terms, model)
+            else:
+                def A_vector_multiply_func(vec):
+                    val = gather_flat_grad(grad(d_train_loss_d_w, model.parameters(),
+                                                grad_outputs=vec.view(-1), retain_graph=True))
+                    # val_2 = gather_flat_grad(grad(d_train_loss_d_w, model.parameters(), grad_outputs=val.view(-1), retain_graph=True))
+                    # return val_2.view(1, -1, 1)
+                    return val.view(1, -1, 1)
 
-            if args.num_neumann_terms > 0:
-                preconditioner, _ = cg_batch(A_vector_multiply_func, d_val_loss_d_theta.view(1, -1, 1),
-                                             maxiter=args.num_neumann_terms)
+                if args.num_neumann_terms > 0:
+                    preconditioner, _ = cg_batch(A_vector_multiply_func, d_val_loss_d_theta.view(1, -1, 1),
+                                                 maxiter=args.num_neumann_terms)
 
         if args.save_hessian and do_true_inverse:
             def save_hessian(hessian, name):
@@ -630,18 +784,18 @@ def experiment(args):
                 name = 'neumann_' + str(args.num_neumann_terms)'''
 
             save_hessian(inv_hessian, name='true_inv')
-            new_hessian = torch.zeros(inv_hessian.shape).cuda()
+            new_hessian = policy.zeros(inv_hessian.shape)
             for param_group in optimizer.param_groups:
                 cur_step_size = param_group['step_size']
                 cur_bias_correction = param_group['bias_correction']
                 print(f'size: {cur_step_size}')
                 break
             for i in range(10):
-                hess_term = torch.eye(inv_hessian.shape[0]).cuda()
-                norm_1, norm_2 = torch.norm(torch.eye(inv_hessian.shape[0]).cuda(), p=2), torch.norm(hessian, p=2)
+                hess_term = torch.eye(inv_hessian.shape[0], device=policy.device)
+                norm_1, norm_2 = torch.norm(torch.eye(inv_hessian.shape[0], device=policy.device), p=2), torch.norm(hessian, p=2)
                 for j in range(i):
                     # norm_2 = torch.norm(hessian@hessian, p=2)
-                    hess_term = hess_term @ (torch.eye(inv_hessian.shape[0]).cuda() - norm_1 / norm_2 * hessian)
+                    hess_term = hess_term @ (torch.eye(inv_hessian.shape[0], device=policy.device) - norm_1 / norm_2 * hessian)
                 new_hessian += hess_term  # (torch.eye(inv_hessian.shape[0]).cuda() - elementary_lr*0.1*hessian)
                 # if (i+1) % 10 == 0 or i == 0:
                 save_hessian(new_hessian, name='neumann_' + str(i))
@@ -649,12 +803,15 @@ def experiment(args):
 
         # compute d / d lambda (partial Lv / partial w * partial Lt / partial w)
         # = (partial Lv / partial w * partial^2 Lt / (partial w partial lambda))
-        indirect_grad = gather_flat_grad(
-            grad(d_train_loss_d_w, get_hyper_train(), grad_outputs=preconditioner.view(-1)))
-        hypergrad = direct_grad + indirect_grad
-
-        zero_hypergrad(get_hyper_train)
-        store_hypergrad(get_hyper_train, -hypergrad)
+        with timer.phase('mixed_grad'):
+            indirect_grad = gather_flat_grad(
+                grad(d_train_loss_d_w, hyper_params, grad_outputs=preconditioner.view(-1)))
+            hypergrad = direct_grad + indirect_grad
+
+            zero_hypergrad(get_hyper_train)
+            store_hypergrad(get_hyper_train, -hypergrad[:num_dense_hypers])
+            if weight_rows is not None:
+                reweighting_table.logits.grad = reweighting_table.sparse_grad(index, -hypergrad[num_dense_hypers:])
         # get_hyper_train()[0].grad = hypergrad
         return val_loss, hypergrad.norm()
 
@@ -666,6 +823,7 @@ def experiment(args):
         print(f"Initial Test Loss: {test_loss, test_acc}")
     iteration = 0
     hypergradient_cos_diff, hypergradient_l2_diff = -1, -1
+    trace_window.start()
     for epoch in range(0, args.num_finetune_epochs):
         reg_anneal_epoch = epoch
         xentropy_loss_avg = 0.
@@ -682,16 +840,13 @@ def experiment(args):
         if do_simple:
             num_tune_hyper = 1
         hyper_num = 0
-        for i, (images, labels) in enumerate(progress_bar):
+        for i, (images, labels, *index) in enumerate(progress_bar):
             if args.do_print:
                 progress_bar.set_description('Finetune Epoch ' + str(epoch))
 
-            images, labels = images.cuda(), labels.cuda()
+            images, labels = policy.batch(images, labels)
             # pred = model(images)
-            optimizer.zero_grad()  # TODO: ADDED
-            xentropy_loss, pred = train_loss_func(images, labels)  # F.cross_entropy(pred, labels)
-            xentropy_loss.backward()  # TODO: ADDED
-            optimizer.step()  # TODO: ADDED
+            xentropy_loss, pred = elementary_step(images, labels, *index)  # F.cross_entropy(pred, labels)
             optimizer.zero_grad()  # TODO: ADDED
             xentropy_loss_avg += xentropy_loss.item()
 
@@ -707,7 +862,7 @@ def experiment(args):
                     if args.do_inverse_compare:
                         approx_hypergradient = get_hyper_train_flat().grad
                         # TODO: Call hyper_step with the true inverse
-                        _, _ = hyper_step(cur_lr, do_true_inverse=True)
+                        _, _ = hyper_step(cur_lr, do_true_inverse=True, timer=PhaseTimer(policy))
                         true_hypergradient = get_hyper_train_flat().grad
                         hypergradient_l2_norm = torch.norm(true_hypergradient - approx_hypergradient, p=2)
                         norm_1, norm_2 = torch.norm(true_hypergradient, p=2), torch.norm(approx_hypergradient, p=2)
@@ -716,7 +871,11 @@ def experiment(args):
                         hypergradient_l2_diff = hypergradient_l2_norm.item()
                         print(f"hypergrad_diff, l2: {hypergradient_l2_norm}, cos: {hypergradient_cos_norm}")
                     # get_hyper_train, model, val_loss_func, val_loader, train_grad, cur_lr, use_reg, args, train_loader, train_loss_func, optimizer)
-                    hyper_optimizer.step()
+                    with phase_timer.phase('hyper_opt'):
+                        hyper_optimizer.step()
+                        if table_optimizer is not None:
+                            table_optimizer.step()
+                    phase_timer.end_step()
 
                     weight_norm = get_hyper_train_flat().norm()
                     total_val_loss += val_loss.item()
@@ -733,6 +892,7 @@ def experiment(args):
             optimizer.step()'''
 
             iteration += 1
+            trace_window.step()
 
             # Calculate running average of accuracy
             if args.do_classification:
@@ -759,7 +919,8 @@ def experiment(args):
                         save_images(images, labels, augment_net, args)
                 if not do_simple or args.do_inverse_compare:
                     if not do_simple:
-                        saver(epoch, model, optimizer, augment_net, reweighting_net, hyper_optimizer, args.save_loc)
+                        saver(epoch, model, optimizer, augment_net, reweighting_net, hyper_optimizer, args.save_loc,
+                              reweighting_table)
                     val_loss, val_acc = test(val_loader)
                     csv_logger.writerow({'epoch': str(epoch),
                                          'train_loss': str(xentropy_loss_avg / (i + 1)), 'train_acc': str(accuracy),
@@ -768,12 +929,14 @@ def experiment(args):
                                          'run_time': time.time() - init_time,
                                          'hypergradient_cos_diff': hypergradient_cos_diff,
                                          'hypergradient_l2_diff': hypergradient_l2_diff,
-                                         'iteration': iteration})
+                                         'iteration': iteration, **phase_timer.row()})
         if use_scheduler:
             scheduler.step(epoch)
         if use_hyper_scheduler:
             hyper_scheduler.step(epoch)
         train_loss = xentropy_loss_avg / (i + 1)
+        if args.do_print:
+            tqdm.write(phase_timer.summary('Finetune epoch {} hyper steps'.format(epoch)))
 
         only_print_final_vals = do_simple
         if not only_print_final_vals:
@@ -789,14 +952,17 @@ def experiment(args):
                                  'test_loss': str(test_loss), 'test_acc': str(test_acc),
                                  'hypergradient_cos_diff': hypergradient_cos_diff,
                                  'hypergradient_l2_diff': hypergradient_l2_diff,
-                                 'run_time': time.time() - init_time, 'iteration': iteration})
+                                 'run_time': time.time() - init_time, 'iteration': iteration,
+                                 **phase_timer.row()})
         else:
             if args.do_print:
                 val_loss, val_acc = test(val_loader, do_test_augment=False)
                 tqdm.write('val loss: {:6.4f} | val acc: {:6.4f}'.format(val_loss, val_acc))
+    trace_window.stop()
     val_loss, val_acc = test(val_loader)
     test_loss, test_acc = test(test_loader)
-    saver(args.num_finetune_epochs, model, optimizer, augment_net, reweighting_net, hyper_optimizer, args.save_loc)
+    saver(args.num_finetune_epochs, model, optimizer, augment_net, reweighting_net, hyper_optimizer, args.save_loc,
+          reweighting_table)
     return train_loss, accuracy, val_loss, val_acc, test_loss, test_acc
 
 
@@ -60,7 +60,7 @@ def save_images(images, labels, augment_net, args):
     save_learned(images[:num_save], is_mnist, num_save, 'image_Original', path=args.save_loc)
 
     num_sample = 10
-    augs = torch.zeros(num_sample, num_save, images.shape[1], images.shape[2], images.shape[3])
+    augs = torch.zeros(num_sample, num_save, images.shape[1], images.shape[2], images.shape[3], device=images.device)
     for i in range(num_sample):
         augs[i] = augment_net(images[:num_save], class_label=labels[:num_save])
 
@@ -70,13 +70,13 @@ def save_images(images, labels, augment_net, args):
     aug_2 = augment_net(images[:num_save], use_zero_noise=True, class_label=labels[:num_save])
     save_learned(aug_2, is_mnist, num_save, 'image_Augment2', path=args.save_loc)
 
-    std_augs = torch.std(augs, dim=0).cuda()
+    std_augs = torch.std(augs, dim=0)
     std_augs = torch.log(std_augs)
     # print(torch.max(std_augs), torch.min(std_augs), torch.std(std_augs), torch.mean(std_augs))
     # std_augs = (std_augs - torch.mean(std_augs)) / torch.std(std_augs)
     save_learned(std_augs, is_mnist, num_save, 'image_AugmentDiff', path=args.save_loc)
 
-    mean_augs = torch.mean(augs, dim=0).cuda()
+    mean_augs = torch.mean(augs, dim=0)
     save_learned(mean_augs - images[:num_save], is_mnist, num_save, 'image_OriginalDiff', path=args.save_loc)
 
 
@@ -98,11 +98,13 @@ def graph_single_args(args, save_loc=None):
     args.data_augmentation = False  # Don't use data augmentation for constructing graphs
 
     from train_augment_net2 import get_models
-    model, train_loader, val_loader, test_loader, augment_net, reweighting_net, checkpoint = get_models(args)
+    from utils.device import device_policy
+    policy = device_policy(args, double_backward=True)
+    model, train_loader, val_loader, test_loader, augment_net, reweighting_net, checkpoint = get_models(args, policy)
 
     progress_bar = tqdm(train_loader)
     for i, (images, labels) in enumerate(progress_bar):
-        images, labels = images.cuda(), labels.cuda()
+        images, labels = policy.batch(images, labels)
 
         save_images(images, labels, augment_net, args)
 
@@ -2,6 +2,9 @@ import argparse
 import copy
 import os
 from utils.csv_logger import CSVLogger
+from utils.device import add_device_arguments
+from utils.elementary_step import add_compile_arguments
+from utils.profiling import PhaseTimer, add_profiling_arguments, add_trace_arguments
 
 
 def make_parser():
@@ -26,8 +29,17 @@ def make_parser():
     parser.add_argument('--data_augmentation', action='store_true', default=True,
                         help='Whether to use data augmentation')
     parser.add_argument('--use_augment_net', action='store_true', default=True, help='Use augmentation network')
+    parser.add_argument('--no_augment_net', action='store_false', dest='use_augment_net',
+                        help='Do not use the augmentation network, e.g. to learn only the per-example loss weights')
+    parser.add_argument('--augment_net_type', type=str, default='unet', choices=['unet', 'parametric'],
+                        help='Augmentation network: a UNet, or per-channel affine, colour and spatial transforms')
     parser.add_argument('--use_reweighting_net', action='store_true', default=False,
                         help='Use loss reweighting network')
+    parser.add_argument('--use_reweighting_table', action='store_true', default=False,
+                        help='Learn a loss weight for every training example, updated sparsely. It is learnt '
+                             'together with the augmentation network unless --no_augment_net is given')
+    parser.add_argument('--reweighting_table_lr', type=float, default=1e-2,
+                        help='Learning rate of the sparse Adam updates of the per-example loss weights')
     parser.add_argument('--use_weight_decay', action='store_true', default=False, help='Use weight_decay')
     parser.add_argument('--weight_decay_all', action='store_true', default=True, help='Use weight_decay')
 
@@ -37,6 +49,9 @@ def make_parser():
     parser.add_argument('--seed', type=int, default=1, help='The random seed to use')
 
     parser.add_argument('--batch_size', type=int, default=128, help='The batch size')
+    parser.add_argument('--num_prefetch', type=int, default=0,
+                        help='Number of batches to load ahead on a background thread (0 disables prefetching). '
+                             'Faster input, but the thread shares the global RNG, so seeded runs are not reproducible')
     parser.add_argument('--lr', type=float, default=0.1, help='Learning rate')
     parser.add_argument('--wdecay', type=float, default=5e-4, help='Amount of weight decay')
     parser.add_argument('--do_diagnostic', action='store_true', default=False,
@@ -53,8 +68,23 @@ def make_parser():
     parser.add_argument('--save_hessian', action='store_true', default=False,
                         help='If we use cross-entropy loss')
 
+    parser.add_argument('--num_aug_samples', type=int, default=10,
+                        help='Number of augmentations per image for the augmentation regularizer')
+    parser.add_argument('--aug_max_batch_size', type=int, default=0,
+                        help='Maximum number of images per augment_net call when sampling augmentations (0 for no limit)')
+    parser.add_argument('--num_tta_views', type=int, default=5,
+                        help='Number of augmented views averaged with each test image')
+    parser.add_argument('--batched_tta', action='store_true', default=False,
+                        help='Evaluate all the views of a test batch in one forward')
+    parser.add_argument('--tta_max_batch_size', type=int, default=0,
+                        help='Maximum number of images per forward with --batched_tta (0 for no limit)')
+
     parser.add_argument('--num_layers', type=int, default=0, help='How many mlp_layers')
     parser.add_argument('--warmup_epochs', type=int, default=-1, help='How many mlp_layers')
+    add_device_arguments(parser)
+    add_compile_arguments(parser)
+    add_profiling_arguments(parser)
+    add_trace_arguments(parser)
     return parser
 
 
@@ -70,6 +100,10 @@ def get_id(args):
     id += f'_reweight:{int(args.use_reweighting_net)}'
     id += f'_presetAug:{int(args.data_augmentation)}'
     id += f'_learnAug:{int(args.use_augment_net)}'
+    if args.use_reweighting_table:
+        id += '_reweightTable:1'
+    if args.augment_net_type != 'unet':
+        id += f'_augNet:{args.augment_net_type}'
     id += f'_cg:{args.use_cg}'
     id += f'_neumann:{int(args.num_neumann_terms)}'
     id += f'_reg:{float(args.reg_weight)}'
@@ -97,7 +131,7 @@ def load_logger(args):
                     'train_loss', 'train_acc',
                     'val_loss', 'val_acc',
                     'test_loss', 'test_acc',
-                    'hypergradient_cos_diff', 'hypergradient_l2_diff'],
+                    'hypergradient_cos_diff', 'hypergradient_l2_diff'] + PhaseTimer.fieldnames(),
         filename=filename)
     return csv_logger, test_id
 
@@ -24,8 +24,11 @@ from torch.optim.lr_scheduler import MultiStepLR
 
 # Local imports
 import data_loaders
-from csv_logger import CSVLogger
-from models import wide_resnet, resnet_cifar, models
+from utils.csv_logger import CSVLogger
+from utils.device import add_device_arguments, device_policy
+from utils.elementary_step import ElementaryStep, add_compile_arguments
+from models import wide_resnet, resnet_cifar
+from models import simple_models as models
 
 
 def cnn_val_loss(config={}, reporter=None, callback=None, return_all=False):
@@ -106,16 +109,17 @@ def cnn_val_loss(config={}, reporter=None, callback=None, return_all=False):
                         help='random seed (default: 11)')
     parser.add_argument('--save_dir', default=config['save_dir'],
                         help='subdirectory of logdir/savedir to save in (default changes to date/time)')
+    add_device_arguments(parser)
+    add_compile_arguments(parser)
 
     args, unknown = parser.parse_known_args()
-    args.cuda = not args.no_cuda and torch.cuda.is_available()
-    device = torch.device("cuda" if args.cuda else "cpu")
+    policy = device_policy(args)
+    args.cuda = policy.is_cuda
+    device = policy.device
     cudnn.benchmark = True  # Should make training should go faster for large models
 
-    torch.manual_seed(args.seed)
+    policy.manual_seed(args.seed)
     np.random.seed(args.seed)
-    if args.cuda:
-        torch.cuda.manual_seed(args.seed)
 
     print(args)
     sys.stdout.flush()
@@ -160,12 +164,14 @@ def cnn_val_loss(config={}, reporter=None, callback=None, return_all=False):
     ###############################################################################
 
     if args.dataset == 'cifar10':
-        train_loader, valid_loader, test_loader = data_loaders.load_cifar10(args, args.batch_size, val_split=True,
-                                                                            augmentation=args.data_augmentation)
+        train_loader, valid_loader, test_loader = data_loaders.load_cifar10(args.batch_size, val_split=True,
+                                                                            augmentation=args.data_augmentation,
+                                                                            pin_memory=policy.pin_memory)
         num_classes = 10
     elif args.dataset == 'cifar100':
-        train_loader, valid_loader, test_loader = data_loaders.load_cifar100(args, args.batch_size, val_split=True,
-                                                                             augmentation=args.data_augmentation)
+        train_loader, valid_loader, test_loader = data_loaders.load_cifar100(args.batch_size, val_split=True,
+                                                                             augmentation=args.data_augmentation,
+                                                                             pin_memory=policy.pin_memory)
         num_classes = 100
     elif args.dataset == 'fashion':
         train_loader, valid_loader, test_loader = data_loaders.load_fashion_mnist(args.batch_size, val_split=True)
@@ -192,7 +198,7 @@ def cnn_val_loss(config={}, reporter=None, callback=None, return_all=False):
         return [{'params': layer.parameters(), 'weight_decay': wdecay} for (layer, wdecay) in
                 zip(module_list, weight_decays)]
 
-    cnn = cnn.to(device)
+    cnn = policy.module(cnn)
     criterion = nn.CrossEntropyLoss()
     # cnn_optimizer = torch.optim.SGD(cnn.parameters(),
     #                                 lr=args.lr,
@@ -204,6 +210,12 @@ def cnn_val_loss(config={}, reporter=None, callback=None, return_all=False):
                                     momentum=args.momentum,
                                     nesterov=True)
 
+    def train_loss_func(images, labels):
+        pred = cnn(images)
+        return criterion(pred, labels), pred
+
+    elementary_step = ElementaryStep(train_loss_func, cnn_optimizer, compile=args.compile_elementary_step)
+
     ###############################################################################
     # Training/Evaluation
     ###############################################################################
@@ -213,7 +225,7 @@ def cnn_val_loss(config={}, reporter=None, callback=None, return_all=False):
         correct = total = loss = 0.
         with torch.no_grad():
             for images, labels in loader:
-                images, labels = images.to(device), labels.to(device)
+                images, labels = policy.batch(images, labels)
                 pred = cnn(images)
                 loss += F.cross_entropy(pred, labels, reduction='sum').item()
                 hard_pred = torch.max(pred, 1)[1]
@@ -243,7 +255,7 @@ def cnn_val_loss(config={}, reporter=None, callback=None, return_all=False):
         progress_bar = tqdm(train_loader)
         for i, (images, labels) in enumerate(progress_bar):
             progress_bar.set_description('Epoch ' + str(epoch))
-            images, labels = images.to(device), labels.to(device)
+            images, labels = policy.batch(images, labels)
 
             if args.inscale > 0:
                 noise = torch.rand(images.size(0), device=device)
@@ -251,12 +263,7 @@ def cnn_val_loss(config={}, reporter=None, callback=None, return_all=False):
                 images = images * scaled_noise[:, None, None, None]
 
             # images = F.dropout(images, p=args.indropout, training=True)  # TODO: Incorporate input dropout
-            cnn.zero_grad()
-            pred = cnn(images)
-
-            xentropy_loss = criterion(pred, labels)
-            xentropy_loss.backward()
-            cnn_optimizer.step()
+            xentropy_loss, pred = elementary_step(images, labels)
 
             running_xentropy += xentropy_loss.item()
 
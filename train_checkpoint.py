@@ -16,10 +16,13 @@ from torchvision import datasets, transforms
 
 # Local imports
 import data_loaders
-from cutout import Cutout
+from cutout import BatchCutout
 from models.resnet import ResNet18
 from models.wide_resnet import WideResNet
 from utils.csv_logger import CSVLogger
+from utils.data_iter import Prefetcher
+from utils.device import add_device_arguments, device_policy
+from utils.elementary_step import ElementaryStep, add_compile_arguments
 
 model_options = ['resnet18', 'wideresnet']
 dataset_options = ['cifar10', 'cifar100']
@@ -31,6 +34,9 @@ parser.add_argument('--model', '-a', default='resnet18',
                     choices=model_options)
 parser.add_argument('--batch_size', type=int, default=128,
                     help='input batch size for training (default: 128)')
+parser.add_argument('--num_prefetch', type=int, default=0,
+                    help='number of batches to load ahead on a background thread (0 disables prefetching); '
+                         'faster input, but the thread shares the global RNG, so seeded runs are not reproducible')
 parser.add_argument('--epochs', type=int, default=200,
                     help='number of epochs to train (default: 20)')
 parser.add_argument('--lr', type=float, default=0.1,
@@ -53,14 +59,15 @@ parser.add_argument('--seed', type=int, default=0,
                     help='random seed (default: 1)')
 parser.add_argument('--save_dir', type=str, default='baseline_checkpoints',
                     help='Base save directory')
+add_device_arguments(parser)
+add_compile_arguments(parser)
 args = parser.parse_args()
 
-args.cuda = not args.no_cuda and torch.cuda.is_available()
+policy = device_policy(args)
+args.cuda = policy.is_cuda
 cudnn.benchmark = True  # Should make training should go faster for large models
 
-torch.manual_seed(args.seed)
-if args.cuda:
-    torch.cuda.manual_seed(args.seed)
+policy.manual_seed(args.seed)
 
 test_id = '{}_{}_{}_lr{}_wd{}_aug{}'.format(args.dataset, args.model, args.optimizer, args.lr, args.wdecay,
                                             int(args.data_augmentation))
@@ -77,27 +84,32 @@ if args.data_augmentation:
     train_transform.transforms.append(transforms.RandomHorizontalFlip())
 train_transform.transforms.append(transforms.ToTensor())
 train_transform.transforms.append(normalize)
-if args.cutout:
-    train_transform.transforms.append(Cutout(n_holes=args.n_holes, length=args.length))
 
 test_transform = transforms.Compose([transforms.ToTensor(), normalize])
 
 if args.dataset == 'cifar10':
     num_classes = 10
     train_loader, val_loader, test_loader = data_loaders.load_cifar10(args.batch_size, val_split=True,
-                                                                      augmentation=args.data_augmentation)
+                                                                      augmentation=args.data_augmentation,
+                                                                      pin_memory=policy.pin_memory)
 elif args.dataset == 'cifar100':
     num_classes = 100
     train_loader, val_loader, test_loader = data_loaders.load_cifar100(args.batch_size, val_split=True,
-                                                                       augmentation=args.data_augmentation)
+                                                                       augmentation=args.data_augmentation,
+                                                                       pin_memory=policy.pin_memory)
+
+train_loader = Prefetcher(train_loader, args.num_prefetch)
 
 if args.model == 'resnet18':
     cnn = ResNet18(num_classes=num_classes)
 elif args.model == 'wideresnet':
     cnn = WideResNet(depth=28, num_classes=num_classes, widen_factor=10, dropRate=0.3)
 
-cnn = cnn.cuda()
-criterion = nn.CrossEntropyLoss().cuda()
+# Cutout is applied to whole batches on the device in the training loop
+batch_cutout = BatchCutout(n_holes=args.n_holes, length=args.length) if args.cutout else None
+
+cnn = policy.module(cnn)
+criterion = nn.CrossEntropyLoss()
 
 if args.optimizer == 'sgdm':
     cnn_optimizer = torch.optim.SGD(cnn.parameters(), lr=args.lr, momentum=0.9, nesterov=True, weight_decay=args.wdecay)
@@ -112,6 +124,14 @@ elif args.optimizer == 'rmsprop':
 
 scheduler = MultiStepLR(cnn_optimizer, milestones=[60, 120, 160], gamma=0.2)
 
+
+def train_loss_func(images, labels):
+    pred = cnn(images)
+    return criterion(pred, labels), pred
+
+
+elementary_step = ElementaryStep(train_loss_func, cnn_optimizer, compile=args.compile_elementary_step)
+
 if not os.path.exists(args.save_dir):
     os.makedirs(args.save_dir)
 
@@ -126,8 +146,7 @@ def test(loader):
     total = 0.
     losses = []
     for images, labels in loader:
-        images = images.cuda()
-        labels = labels.cuda()
+        images, labels = policy.batch(images, labels)
 
         with torch.no_grad():
             pred = cnn(images)
@@ -164,15 +183,11 @@ try:
         for i, (images, labels) in enumerate(progress_bar):
             progress_bar.set_description('Epoch ' + str(epoch))
 
-            images = images.cuda()
-            labels = labels.cuda()
-
-            cnn.zero_grad()
-            pred = cnn(images)
+            images, labels = policy.batch(images, labels)
+            if batch_cutout is not None:
+                images = batch_cutout(images)
 
-            xentropy_loss = criterion(pred, labels)
-            xentropy_loss.backward()
-            cnn_optimizer.step()
+            xentropy_loss, pred = elementary_step(images, labels)
 
             xentropy_loss_avg += xentropy_loss.item()
 
@@ -0,0 +1,180 @@
+import queue
+import threading
+from itertools import islice
+
+from torch.utils.data import DataLoader, RandomSampler
+
+
+class CycleLoader():
+    """Endless source of mini-batches drawn from a DataLoader.
+
+    The hyper steps only need one (or a few) batches at a time.  Creating ``iter(loader)`` for every
+    hyper step re-shuffles the sampler and, when ``num_workers > 0``, spawns a fresh set of worker
+    processes just to read a single batch.  Here the iterator is kept alive between calls and only
+    rebuilt once the loader is exhausted, so that cost is paid once per pass over the data.
+    """
+
+    def __init__(self, loader):
+        self.loader = loader
+        self.iterator = None
+        self.num_passes = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.iterator is None:
+            self.iterator = iter(self.loader)
+        try:
+            return next(self.iterator)
+        except StopIteration:
+            self.num_passes += 1
+            self.iterator = iter(self.loader)
+            return next(self.iterator)
+
+    next = __next__
+
+    def __len__(self):
+        return len(self.loader)
+
+    def take(self, num_batches):
+        """Returns an iterator over the next num_batches batches.
+
+        :param num_batches: The number of batches to draw.
+        :return: An iterator of (x, y) tuples.
+        """
+        return islice(self, num_batches)
+
+    @property
+    def dataset(self):
+        return self.loader.dataset
+
+    @property
+    def batch_size(self):
+        return self.loader.batch_size
+
+
+class Prefetcher():
+    """Wraps a DataLoader so the next few batches are built on a background thread.
+
+    Every pass over the Prefetcher starts a daemon thread which iterates the wrapped loader and fills a
+    queue holding at most num_prefetch batches.  Batch construction then overlaps with the elementary
+    step and the Hessian-vector products of a hyper step, instead of running between them.  Wrapping a
+    Prefetcher in a CycleLoader gives a prefetched, endless batch source.
+
+    Prefetching is off by default: the thread draws shuffling and augmentation randomness from the global RNG
+    while the main thread draws dropout and init randomness from it, so the interleaving (and therefore a
+    seeded run) is no longer reproducible once num_prefetch > 0.
+
+    :param loader: The DataLoader (or any re-iterable) to read batches from.
+    :param num_prefetch: The maximum number of batches held in the queue.  0 disables prefetching.
+    """
+
+    def __init__(self, loader, num_prefetch=0):
+        self.loader = loader
+        self.num_prefetch = num_prefetch
+
+    def __iter__(self):
+        if self.num_prefetch <= 0:
+            return iter(self.loader)
+        return _PrefetchIterator(self.loader, self.num_prefetch)
+
+    def __len__(self):
+        return len(self.loader)
+
+    @property
+    def dataset(self):
+        return self.loader.dataset
+
+    @property
+    def batch_size(self):
+        return self.loader.batch_size
+
+
+class IndexedDataset():
+    """Wraps a dataset so its items are (x, y, index), index being the position of the item in the dataset."""
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __getitem__(self, index):
+        x, y = self.dataset[index]
+        return x, y, index
+
+    def __len__(self):
+        return len(self.dataset)
+
+
+def with_indices(loader):
+    """Returns a DataLoader like loader whose batches are (x, y, index), index holding the dataset indices.
+
+    :param loader: The DataLoader to copy the batch size, shuffling, workers and memory pinning of.
+    :return: A DataLoader over IndexedDataset(loader.dataset).
+    """
+    return DataLoader(IndexedDataset(loader.dataset), batch_size=loader.batch_size,
+                      shuffle=isinstance(loader.sampler, RandomSampler), num_workers=loader.num_workers,
+                      pin_memory=loader.pin_memory, drop_last=loader.drop_last)
+
+
+class _PrefetchIterator():
+    def __init__(self, loader, num_prefetch):
+        self.queue = queue.Queue(maxsize=num_prefetch)
+        self.stop_event = threading.Event()
+        self.finished = False
+        # The thread only holds the queue and the event, so dropping this iterator early stops the thread
+        self.thread = threading.Thread(target=_fill_queue, args=(loader, self.queue, self.stop_event), daemon=True)
+        self.thread.start()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.finished:
+            raise StopIteration
+        item = self.queue.get()
+        if item is _END_OF_DATA:
+            self.close()
+            raise StopIteration
+        if isinstance(item, _PrefetchError):
+            self.close()
+            raise item.error
+        return item
+
+    next = __next__
+
+    def close(self):
+        self.finished = True
+        self.stop_event.set()
+
+    def __del__(self):
+        self.stop_event.set()
+
+
+class _PrefetchError():
+    def __init__(self, error):
+        self.error = error
+
+
+_END_OF_DATA = object()
+
+
+def _put(batch_queue, stop_event, item):
+    # Poll so that a consumer which stops early (e.g. a break) doesn't leave the thread blocked forever
+    while not stop_event.is_set():
+        try:
+            batch_queue.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _fill_queue(loader, batch_queue, stop_event):
+    try:
+        for batch in loader:
+            if not _put(batch_queue, stop_event, batch):
+                return
+    except Exception as e:
+        _put(batch_queue, stop_event, _PrefetchError(e))
+        return
+    _put(batch_queue, stop_event, _END_OF_DATA)
@@ -0,0 +1,77 @@
+import warnings
+
+import torch
+
+
+class CompiledOrEager():
+    """Calls fn through torch.compile, or eagerly if it can't be compiled.
+
+    torch.compile only compiles on the first call, so a missing compiler or an unsupported op shows up there.
+    When the first call fails to compile, a warning is issued and every later call goes straight to fn.  Only
+    compilation errors fall back: those are raised while tracing and compiling, before anything runs, so the
+    eager call that follows does not repeat an update.  Any other error, and every error after the first call,
+    is raised as it is.
+    """
+    compile_errors = (torch._dynamo.exc.BackendCompilerFailed, torch._dynamo.exc.Unsupported,
+                      torch._dynamo.exc.TritonUnavailableError)
+
+    def __init__(self, fn, **compile_kwargs):
+        self.fn = fn
+        self.compiled = torch.compile(fn, **compile_kwargs)
+        self.use_compiled = True
+        self.first_call = True
+
+    def __call__(self, *args, **kwargs):
+        if not self.use_compiled:
+            return self.fn(*args, **kwargs)
+        if not self.first_call:
+            return self.compiled(*args, **kwargs)
+        try:
+            output = self.compiled(*args, **kwargs)
+        except self.compile_errors as e:
+            warnings.warn('Could not compile {}, falling back to eager mode: {}'.format(
+                getattr(self.fn, '__name__', self.fn), e))
+            self.use_compiled = False
+            return self.fn(*args, **kwargs)
+        self.first_call = False
+        return output
+
+
+class ElementaryStep():
+    """A first-order training step: the loss, its backward pass and an optimizer update.
+
+    loss_func does everything up to the scalar loss (moving the batch, augmenting it, the model, the loss and any
+    weight-decay penalty) and returns either the loss or a tuple starting with it.  With compile=True, loss_func
+    and optimizer.step go through torch.compile (the backward pass is compiled along with loss_func).  The hyper
+    steps must keep calling loss_func itself: compiled backward passes do not support create_graph, which the
+    Hessian-vector products need.
+    """
+
+    def __init__(self, loss_func, optimizer, compile=False):
+        """
+        :param loss_func: Function of the batch returning the loss, or a tuple (loss, ...).
+        :param optimizer: The optimizer updating the elementary parameters.
+        :param compile: Whether to compile loss_func and the optimizer update.
+        """
+        self.optimizer = optimizer
+        self.loss_func = loss_func
+        self.optimizer_step = optimizer.step
+        if compile:
+            self.loss_func = CompiledOrEager(loss_func)
+            self.optimizer_step = CompiledOrEager(self.optimizer_step)
+
+    def __call__(self, *batch):
+        """Takes one step on batch, returning the output of loss_func."""
+        self.optimizer.zero_grad()
+        output = self.loss_func(*batch)
+        loss = output[0] if isinstance(output, tuple) else output
+        loss.backward()
+        self.optimizer_step()
+        return output
+
+
+def add_compile_arguments(parser):
+    """Adds the --compile_elementary_step option to an argparse parser."""
+    parser.add_argument('--compile_elementary_step', action='store_true', default=False,
+                        help='Compile the first-order training step with torch.compile (the hyper steps stay eager)')
+    return parser
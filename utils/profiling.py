@@ -0,0 +1,368 @@
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+import torch
+
+from utils.device import as_policy
+
+
+def resident_set_size():
+    """Resident set size of this process in bytes, or None where /proc is not available."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+class PeakMemory():
+    """Context manager measuring how far the memory in use rises above its level on entry, in bytes.
+
+    On a GPU this is the allocator's peak.  On the CPU torch keeps no such statistic, so a background thread samples
+    the resident set size every interval seconds instead: spikes shorter than the interval are missed, and memory the
+    process had already freed back to its allocator is reused without showing up.  peak_bytes is None where neither
+    is available, and total_peak_bytes is the peak itself, including the memory in use on entry.
+
+        with PeakMemory(policy.device) as memory:
+            hypergradient = estimate()
+        print(memory.peak_bytes)
+    """
+
+    def __init__(self, device='cpu', interval=1e-3):
+        """
+        :param device: torch.device or device string the measured code runs on
+        :param interval: seconds between two samples of the resident set size on the CPU
+        """
+        self.device = torch.device(device)
+        self.interval = interval
+        self.peak_bytes = None
+        self.total_peak_bytes = None
+
+    def __enter__(self):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+            torch.cuda.reset_peak_memory_stats(self.device)
+            self._baseline = torch.cuda.memory_allocated(self.device)
+            return self
+
+        self._baseline = resident_set_size()
+        self._peak = self._baseline
+        self._stop = threading.Event()
+        if self._baseline is not None:
+            self._thread = threading.Thread(target=self._sample, daemon=True)
+            self._thread.start()
+        return self
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self._peak = max(self._peak, resident_set_size())
+
+    def __exit__(self, *exc_info):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+            self.total_peak_bytes = torch.cuda.max_memory_allocated(self.device)
+        elif self._baseline is not None:
+            self._stop.set()
+            self._thread.join()
+            self.total_peak_bytes = max(self._peak, resident_set_size())
+        if self.total_peak_bytes is not None:
+            self.peak_bytes = self.total_peak_bytes - self._baseline
+        return False
+
+
+class HVPCounter():
+    """Counts the Hessian-vector products taken through a training gradient built with create_graph=True.
+
+    Every grad or backward call that goes through the gradient runs its hook once, whatever vector it is called
+    with, so the count also includes the final mixed-partial call with respect to the hyperparameters, and each row
+    of an explicit Hessian.
+
+        d_train_loss_d_w = gather_flat_grad(grad(train_loss, model.parameters(), create_graph=True))
+        hvp_counter = HVPCounter(d_train_loss_d_w)
+    """
+
+    def __init__(self, flat_grad):
+        """
+        :param flat_grad: the training gradient, a tensor with a grad_fn
+        """
+        self.count = 0
+        self._handle = flat_grad.register_hook(self._hook)
+
+    def _hook(self, grad):
+        self.count += 1
+
+    def remove(self):
+        self._handle.remove()
+
+
+_SAVED_ATTRIBUTES = {}
+
+
+def _saved_tensors(node):
+    """The tensors an autograd graph node saved for its backward."""
+    names = _SAVED_ATTRIBUTES.get(type(node))
+    if names is None:
+        names = [name for name in dir(node) if name.startswith('_saved_')]
+        if hasattr(type(node), 'saved_tensors'):  # the node of a custom autograd.Function
+            names.append('saved_tensors')
+        _SAVED_ATTRIBUTES[type(node)] = names
+    tensors = []
+    for name in names:
+        try:
+            value = getattr(node, name)
+        except RuntimeError:  # already freed by a backward without retain_graph
+            continue
+        for tensor in value if isinstance(value, (tuple, list)) else (value,):
+            if isinstance(tensor, torch.Tensor):
+                tensors.append(tensor)
+    return tensors
+
+
+def graph_size(output):
+    """Number of tensors saved for backward in the autograd graph of output, and the bytes they hold.
+
+    A training gradient built with create_graph=True keeps the activations of the forward and of the first backward
+    alive for as long as it is.  A tensor is counted every time a node saves it but its storage is only counted once.
+    Leaves which require grad, the parameters and hyperparameters, are left out since they are alive regardless;
+    buffers and batches the graph holds on to are counted.
+
+        saved_tensors, graph_bytes = graph_size(d_train_loss_d_w)
+    """
+    saved_tensors, storage_bytes = 0, {}
+    nodes, stack = set(), [output.grad_fn]
+    while stack:
+        node = stack.pop()
+        if node is None or node in nodes:
+            continue
+        nodes.add(node)
+        for tensor in _saved_tensors(node):
+            if tensor.is_leaf and tensor.requires_grad:
+                continue
+            saved_tensors += 1
+            storage = tensor.untyped_storage()
+            storage_bytes[storage.data_ptr()] = storage.nbytes()
+        stack.extend(next_node for next_node, _ in node.next_functions)
+    return saved_tensors, sum(storage_bytes.values())
+
+
+class PhaseTimer():
+    """Wall time, Hessian-vector products and, optionally, memory of the phases of hyper steps.
+
+    The phases are
+        val_grad    gradients of the validation loss, for the weights and the direct hypergradient
+        train_grad  the training loss gradient, built with create_graph=True
+        inverse     the Neumann, CG, K-FAC or exact inverse-Hessian-vector product
+        mixed_grad  the mixed partial derivative of the training loss, for the hyperparameters
+        hyper_opt   the hyperparameter optimizer step
+    and each is timed with ``with timer.phase('inverse'):``, possibly several times per hyper step.  count_hvps
+    counts the products taken through a training gradient (see HVPCounter), and end_step closes the hyper step.
+
+    With synchronize, the device is synchronized around every phase, so that on a GPU the kernels are timed instead of
+    their launches.  It is off by default since the two waits per phase stall the launch queue and slow the run down;
+    the phase times are then only a lower bound on a GPU.  profile_memory always synchronizes.
+
+    With profile_memory, every phase also runs under PeakMemory, and count_hvps measures the autograd graph of the
+    training gradient with graph_size; a hyper step reports the largest of its graphs.  The summary then breaks the
+    memory down by phase: the largest rise above the memory in use when the phase started, and the largest peak.
+    Both measurements slow the steps down, the graph walk most, so times are only comparable between runs with the
+    same setting.
+
+    row() returns the mean milliseconds of every phase, HVPs, saved tensors and graph MB per hyper step since its last
+    call, along with the peak memory in MB, keyed by fieldnames(), to be merged into a CSV logger row.  summary()
+    returns a table of the hyper steps since its last call, to be printed at the end of an epoch.
+    """
+    phases = ('val_grad', 'train_grad', 'inverse', 'mixed_grad', 'hyper_opt')
+
+    def __init__(self, policy=None, profile_memory=False, synchronize=False):
+        """
+        :param policy: the DevicePolicy or device of the run, to synchronize; None for the CPU
+        :param profile_memory: whether to record the peak memory of the phases and the size of the graphs
+        :param synchronize: whether to synchronize the device around every phase, for exact phase times
+        """
+        self.policy = as_policy(policy) if policy is not None else None
+        self.profile_memory = profile_memory
+        self.synchronize = synchronize or profile_memory
+        self._counters = []
+        self._step_graph = (0, 0)
+        self._row_totals = self._zero_totals()
+        self._summary_totals = self._zero_totals()
+
+    @classmethod
+    def fieldnames(cls):
+        return [phase + '_ms' for phase in cls.phases] + ['hvps', 'peak_mb', 'saved_tensors', 'graph_mb']
+
+    def _zero_totals(self):
+        totals = {phase: 0. for phase in self.phases}
+        totals.update({phase + '_rise': 0 for phase in self.phases})
+        totals.update({phase + '_peak': 0 for phase in self.phases})
+        totals['hvps'], totals['steps'] = 0, 0
+        totals['saved_tensors'], totals['graph_bytes'], totals['peak_bytes'] = 0, 0, 0
+        return totals
+
+    def _synchronize(self):
+        if self.synchronize and self.policy is not None:
+            self.policy.synchronize()
+
+    @contextmanager
+    def phase(self, name):
+        memory = None
+        if self.profile_memory:
+            memory = PeakMemory(self.policy.device if self.policy is not None else 'cpu')
+        self._synchronize()
+        start_time = time.perf_counter()
+        try:
+            with torch.profiler.record_function(name), memory if memory is not None else nullcontext():
+                yield
+        finally:
+            self._synchronize()
+            elapsed = time.perf_counter() - start_time
+            for totals in self._row_totals, self._summary_totals:
+                totals[name] += elapsed
+                if memory is not None and memory.peak_bytes is not None:
+                    totals[name + '_rise'] = max(totals[name + '_rise'], memory.peak_bytes)
+                    totals[name + '_peak'] = max(totals[name + '_peak'], memory.total_peak_bytes)
+                    totals['peak_bytes'] = max(totals['peak_bytes'], memory.total_peak_bytes)
+
+    def count_hvps(self, flat_grad):
+        self._counters.append(HVPCounter(flat_grad))
+        if self.profile_memory:
+            self._step_graph = max(self._step_graph, graph_size(flat_grad), key=lambda graph: graph[1])
+
+    def end_step(self):
+        hvps = 0
+        for counter in self._counters:
+            hvps += counter.count
+            counter.remove()
+        self._counters = []
+        saved_tensors, graph_bytes = self._step_graph
+        self._step_graph = (0, 0)
+        for totals in self._row_totals, self._summary_totals:
+            totals['hvps'] += hvps
+            totals['saved_tensors'] += saved_tensors
+            totals['graph_bytes'] += graph_bytes
+            totals['steps'] += 1
+
+    def row(self):
+        totals, self._row_totals = self._row_totals, self._zero_totals()
+        row = {name: '' for name in self.fieldnames()}
+        if totals['steps'] == 0:
+            return row
+        row.update({phase + '_ms': 1e3 * totals[phase] / totals['steps'] for phase in self.phases})
+        row['hvps'] = totals['hvps'] / totals['steps']
+        if self.profile_memory:
+            row['peak_mb'] = totals['peak_bytes'] / 2 ** 20
+            row['saved_tensors'] = totals['saved_tensors'] / totals['steps']
+            row['graph_mb'] = totals['graph_bytes'] / totals['steps'] / 2 ** 20
+        return row
+
+    def summary(self, title='Hyper steps'):
+        totals, self._summary_totals = self._summary_totals, self._zero_totals()
+        steps = totals['steps']
+        if steps == 0:
+            return '{}: no hyper steps'.format(title)
+        total_time = sum(totals[phase] for phase in self.phases)
+        lines = ['{}: {} hyper steps, {:.1f} ms and {:.1f} HVPs each'.format(
+                     title, steps, 1e3 * total_time / steps, totals['hvps'] / steps)]
+        if self.profile_memory:
+            lines.append('graph of {:.0f} saved tensors holding {:.1f} MB per step, peak memory {:.1f} MB'.format(
+                totals['saved_tensors'] / steps, totals['graph_bytes'] / steps / 2 ** 20,
+                totals['peak_bytes'] / 2 ** 20))
+        header = '{:12s} {:>10s} {:>12s} {:>7s}'.format('phase', 'total s', 'ms per step', 'share')
+        lines.append(header + (' {:>10s} {:>10s}'.format('rise MB', 'peak MB') if self.profile_memory else ''))
+        for phase in self.phases:
+            line = '{:12s} {:10.2f} {:12.2f} {:6.1f}%'.format(
+                phase, totals[phase], 1e3 * totals[phase] / steps, 100 * totals[phase] / max(total_time, 1e-12))
+            if self.profile_memory:
+                line += ' {:10.1f} {:10.1f}'.format(totals[phase + '_rise'] / 2 ** 20,
+                                                    totals[phase + '_peak'] / 2 ** 20)
+            lines.append(line)
+        return '\n'.join(lines)
+
+
+def add_profiling_arguments(parser):
+    """Adds the --profile_memory and --sync_phase_timing options to an argparse parser."""
+    parser.add_argument('--profile_memory', action='store_true', default=False,
+                        help='Record the peak memory of every hyper step phase and the size of the autograd graph '
+                             'kept for the Hessian-vector products')
+    parser.add_argument('--sync_phase_timing', action='store_true', default=False,
+                        help='Synchronize the device around every hyper step phase, so the phase times cover the '
+                             'kernels and not only their launches (slower, implied by --profile_memory)')
+    return parser
+
+
+class TraceWindow():
+    """Runs torch.profiler over a window of training iterations, chosen by the options of add_trace_arguments.
+
+    After skip_first iterations, every cycle waits, warms up and then records active iterations; there are repeat
+    cycles, or as many as the run has with repeat 0.  Each recorded cycle leaves a trace, readable by TensorBoard's
+    profiler plugin and by chrome://tracing or Perfetto, and a table of the ops aggregated over the cycle, sorted by
+    their own time, in trace_dir.  The phases of PhaseTimer show up in the traces as labelled ranges.  Without
+    --profile_trace every method does nothing.
+
+        trace_window = TraceWindow(args, os.path.join(save_dir, 'traces'), policy)
+        trace_window.start()
+        for images, labels in train_loader:
+            ...
+            trace_window.step()
+        trace_window.stop()
+    """
+
+    def __init__(self, args, trace_dir, policy=None):
+        """
+        :param args: parsed arguments with the options of add_trace_arguments
+        :param trace_dir: directory to write the traces and tables to
+        :param policy: the DevicePolicy or device of the run, to also trace the GPU; None for the CPU
+        """
+        self.trace_dir = trace_dir
+        self.profiler = None
+        if not getattr(args, 'profile_trace', False):
+            return
+        is_cuda = policy is not None and as_policy(policy).is_cuda
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if is_cuda:
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.sort_by = 'self_cuda_time_total' if is_cuda else 'self_cpu_time_total'
+        self.row_limit = args.trace_row_limit
+        self.profiler = torch.profiler.profile(
+            activities=activities,
+            schedule=torch.profiler.schedule(skip_first=args.trace_skip_first, wait=args.trace_wait,
+                                             warmup=args.trace_warmup, active=args.trace_active,
+                                             repeat=args.trace_repeat),
+            on_trace_ready=self._trace_ready, record_shapes=True)
+
+    def _trace_ready(self, profiler):
+        os.makedirs(self.trace_dir, exist_ok=True)
+        torch.profiler.tensorboard_trace_handler(self.trace_dir)(profiler)
+        table = profiler.key_averages().table(sort_by=self.sort_by, row_limit=self.row_limit)
+        with open(os.path.join(self.trace_dir, 'key_averages_step{}.txt'.format(profiler.step_num)), 'w') as f:
+            f.write(table)
+
+    def start(self):
+        if self.profiler is not None:
+            self.profiler.start()
+
+    def step(self):
+        if self.profiler is not None:
+            self.profiler.step()
+
+    def stop(self):
+        if self.profiler is not None:
+            self.profiler.stop()
+
+
+def add_trace_arguments(parser):
+    """Adds the options read by TraceWindow to an argparse parser."""
+    parser.add_argument('--profile_trace', action='store_true', default=False,
+                        help='Trace a window of training iterations with torch.profiler into the save directory')
+    parser.add_argument('--trace_skip_first', type=int, default=10,
+                        help='Number of iterations before the first traced cycle')
+    parser.add_argument('--trace_wait', type=int, default=0, help='Number of idle iterations at the start of a cycle')
+    parser.add_argument('--trace_warmup', type=int, default=2,
+                        help='Number of iterations traced but discarded before the active ones of a cycle')
+    parser.add_argument('--trace_active', type=int, default=5, help='Number of iterations recorded per cycle')
+    parser.add_argument('--trace_repeat', type=int, default=1, help='Number of cycles (0 repeats until the run ends)')
+    parser.add_argument('--trace_row_limit', type=int, default=30,
+                        help='Number of ops in the aggregated table of each cycle')
+    return parser
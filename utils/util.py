@@ -5,6 +5,8 @@ import torch
 from torch.autograd import grad
 from torch.autograd import Variable
 
+from utils.device import as_policy
+
 
 def hessian_vector_product(x_grad, vector, model, k):
     v = Variable(vector)
@@ -16,17 +18,14 @@ def hessian_vector_product(x_grad, vector, model, k):
     return A_x.data
 
 
-def conjugate_gradiant(A_grad, b, model, is_cuda, hessian=None):
-    x = torch.DoubleTensor(np.zeros((b.size(0), b.size(1))) + 1)
+def conjugate_gradiant(A_grad, b, model, policy, hessian=None):
+    policy = as_policy(policy)
+    x = policy.to(torch.DoubleTensor(np.zeros((b.size(0), b.size(1))) + 1))
     b_norm = max(b.norm(), 1e-20)
     k = 0
     if hessian is not None:
-        I = torch.DoubleTensor(np.identity(hessian.data.size(0)) * 1e-4)
-        if is_cuda:
-            I = I.cuda()
+        I = policy.to(torch.DoubleTensor(np.identity(hessian.data.size(0)) * 1e-4))
         hessian += I
-    if is_cuda:
-        x = x.cuda()
     if hessian is not None:
         r_i = b - hessian @ x
     else:
@@ -80,17 +79,14 @@ def conjugate_gradiant(A_grad, b, model, is_cuda, hessian=None):
     return best_x, i
 
 
-def preconditioned_conjugate_gradiant(A_grad, b, model, is_cuda, hessian=None):
-    x = torch.DoubleTensor(np.random.normal(size=(b.size(0), b.size(1))))
+def preconditioned_conjugate_gradiant(A_grad, b, model, policy, hessian=None):
+    policy = as_policy(policy)
+    x = policy.to(torch.DoubleTensor(np.random.normal(size=(b.size(0), b.size(1)))))
     if hessian is not None:
-        I = torch.DoubleTensor(np.identity(hessian.data.size(0)) * 1e-4)
-        if is_cuda:
-            I = I.cuda()
+        I = policy.to(torch.DoubleTensor(np.identity(hessian.data.size(0)) * 1e-4))
         hessian += I
     M = scipy.sparse.linalg.spilu(hessian)
-    M = torch.DoubleTensor(M)
-    if is_cuda:
-        x, M = x.cuda(), M.cuda()
+    M = policy.to(torch.DoubleTensor(M))
     if hessian is not None:
         r_i = b - hessian @ x
     else:
@@ -150,14 +146,12 @@ def gather_flat_grad(loss_grad):
     #for g in loss_grad:
     #    g_vector = g.contiguous().view(-1) if cnt == 0 else torch.cat([g_vector, g.contiguous().view(-1)])
     #    cnt = 1
-    return torch.cat([p.view(-1) for p in loss_grad]) #g_vector
+    return torch.cat([p.reshape(-1) for p in loss_grad]) #g_vector
 
 
-def eval_hessian(g_vector, model, is_cuda):
+def eval_hessian(g_vector, model, policy):
     l = g_vector.size(0)
-    hessian = torch.zeros(l, l)
-    if is_cuda:
-        hessian = hessian.cuda()
+    hessian = as_policy(policy).zeros(l, l)
     for idx in range(l):
         grad2rd = grad(g_vector[idx], model.parameters(), retain_graph=True, allow_unused=True)
         cnt = 0
@@ -179,11 +173,10 @@ def test_hessian():
     print(A + A.t())
 
 
-def eval_jacobian(lambd_vector, model, is_cuda):
+def eval_jacobian(lambd_vector, model, policy):
     row_size = lambd_vector.size(0)
     col_size = sum(p.numel() for p in model.parameters() if p.requires_grad)
-    jacobian = torch.zeros(row_size, col_size)
-    if is_cuda: jacobian = jacobian.cuda()
+    jacobian = as_policy(policy).zeros(row_size, col_size)
     for idx in range(row_size):
         if idx % 1000 == 0: print(f"jac id {idx} / {row_size}")
         grad2rd = grad(lambd_vector[idx], model.parameters(), retain_graph=True, allow_unused=True)
@@ -196,7 +189,7 @@ def eval_jacobian(lambd_vector, model, is_cuda):
     return jacobian
 
 
-def eval_jacobian_matrix(lambd_vector, model, is_cuda):
+def eval_jacobian_matrix(lambd_vector, model, policy):
     size = lambd_vector.size(0)
     jacobian = {}
     for idx in range(size):